@@ -0,0 +1,328 @@
+import collections
+import contextlib
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from loguru import logger
+
+from povertymapping.download import PARTIAL_SUFFIXES
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+CACHE_MAX_SIZE_ENV_VAR = "POVERTYMAPPING_CACHE_MAX_SIZE"
+MEMORY_CACHE_MAX_SIZE_ENV_VAR = "POVERTYMAPPING_MEMORY_CACHE_MAX_SIZE"
+DEFAULT_MEMORY_CACHE_MAX_SIZE = "2GB"
+CACHE_INDEX_FILENAME = ".cache_index.json"
+CACHE_LOCK_FILENAME = ".cache_index.lock"
+CACHE_PINS_DIRNAME = ".cache_pins"
+METADATA_SUFFIX = ".metadata.json"
+# Suffixes of in-flight downloads and compressed files, which belong to the entry of the final file
+TRANSIENT_SUFFIXES = PARTIAL_SUFFIXES + (".gz",)
+
+# Entry dirs of the caches of each module, relative to the cache dir they share
+# (e.g. `~/.geowrangler`), so a single budget covers all of them (see `get_cache_manager`)
+CACHE_ENTRY_DIRS = ["osm", "hrsl", "nightlights/global", "nightlights/clip"]
+
+SIZE_UNITS = {"B": 1, "KB": 1e3, "MB": 1e6, "GB": 1e9, "TB": 1e12}
+
+# Serializes index updates between threads of the same process,
+# the lock file in the cache dir serializes them between processes
+_index_lock = threading.Lock()
+
+
+def parse_size(size):
+    """Parse a size budget given as a number of bytes or a string such as '500MB' or '20 GB'.
+    Returns None if size is None or empty."""
+    if size is None or size == "":
+        return None
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?B)?\s*", str(size).upper())
+    if match is None:
+        raise ValueError(f"Invalid cache size {size}, expected e.g. 500MB or 20GB")
+    value, unit = match.groups()
+    return int(float(value) * SIZE_UNITS[unit or "B"])
+
+
+def _pid_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _path_size(path):
+    try:
+        if path.is_dir():
+            return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+        return path.stat().st_size
+    except FileNotFoundError:
+        # removed by another worker in the meantime
+        return 0
+
+
+class CacheManager:
+    """Keeps a file cache within a size budget by evicting the least recently used entries.
+
+    Args:
+        cache_dir: Root directory of the cache, holding the access time index
+        entry_dirs: Directories (relative to `cache_dir`) whose children are the cache entries,
+            a file and its metadata file (e.g. `key.tif` and `key.metadata.json`) being a single entry
+        max_size: Size budget, defaults to the `POVERTYMAPPING_CACHE_MAX_SIZE` env var or no eviction if unset
+    """
+
+    def __init__(self, cache_dir, entry_dirs, max_size=None):
+        self.cache_dir = Path(os.path.expanduser(cache_dir))
+        self.entry_dirs = [self.cache_dir / entry_dir for entry_dir in entry_dirs]
+        if max_size is None:
+            max_size = os.environ.get(CACHE_MAX_SIZE_ENV_VAR)
+        self.max_size = parse_size(max_size)
+        self.index_file = self.cache_dir / CACHE_INDEX_FILENAME
+        self.pins_dir = self.cache_dir / CACHE_PINS_DIRNAME
+
+    def entry_key(self, path):
+        "Get the cache entry key (relative to `cache_dir`) of a cached file or directory, or None if it isn't in the cache"
+        path = Path(os.path.expanduser(path)).absolute()
+        for entry_dir in self.entry_dirs:
+            entry_dir = entry_dir.absolute()
+            if entry_dir in path.parents:
+                entry_name = path.relative_to(entry_dir).parts[0]
+                if entry_name.endswith(METADATA_SUFFIX):
+                    entry_name = entry_name[: -len(METADATA_SUFFIX)]
+                else:
+                    while entry_name.endswith(TRANSIENT_SUFFIXES):
+                        entry_name = os.path.splitext(entry_name)[0]
+                    entry_name = Path(entry_name).stem
+                return (entry_dir / entry_name).relative_to(self.cache_dir).as_posix()
+        return None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with _index_lock:
+            if fcntl is None:
+                yield
+                return
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.cache_dir / CACHE_LOCK_FILENAME, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        if not self.index_file.exists():
+            return {}
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Ignoring unreadable cache index {self.index_file}")
+            return {}
+
+    def _write_index(self, index):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.index_file.with_name(
+            f"{CACHE_INDEX_FILENAME}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(tmp_file, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self.index_file)
+
+    def touch(self, *paths):
+        "Record an access to the cache entries of `paths`"
+        now = time.time()
+        with self._locked():
+            index = self._read_index()
+            for key in map(self.entry_key, paths):
+                if key is not None:
+                    index[key] = now
+            self._write_index(index)
+
+    @contextlib.contextmanager
+    def pin(self, *paths):
+        "Context manager that protects the cache entries of `paths` from eviction"
+        pin_file = self.pins_dir / f"{os.getpid()}_{uuid.uuid4().hex}.json"
+        # Under the lock, so an eviction in progress finishes before the entries are pinned
+        with self._locked():
+            self.pins_dir.mkdir(parents=True, exist_ok=True)
+            with open(pin_file, "w") as f:
+                json.dump([key for key in map(self.entry_key, paths) if key], f)
+        try:
+            yield
+        finally:
+            pin_file.unlink(missing_ok=True)
+
+    def pinned_keys(self):
+        "Get the entry keys pinned by running processes, cleaning up pins of dead processes"
+        pinned = set()
+        if not self.pins_dir.exists():
+            return pinned
+        for pin_file in self.pins_dir.glob("*.json"):
+            pid = int(pin_file.name.split("_")[0])
+            if not _pid_is_running(pid):
+                pin_file.unlink(missing_ok=True)
+                continue
+            try:
+                with open(pin_file) as f:
+                    pinned.update(json.load(f))
+            except (OSError, ValueError):
+                # pin file removed or being written, skip it
+                continue
+        return pinned
+
+    def entries(self):
+        "Get a dict of entry key to the list of paths that make up the entry"
+        entries = {}
+        for entry_dir in self.entry_dirs:
+            if not entry_dir.exists():
+                continue
+            for path in entry_dir.iterdir():
+                entries.setdefault(self.entry_key(path), []).append(path)
+        return entries
+
+    def size(self):
+        "Get the total size in bytes of all cache entries"
+        return sum(
+            _path_size(path) for paths in self.entries().values() for path in paths
+        )
+
+    def evict(self, max_size=None):
+        """Delete the least recently used unpinned entries until the cache fits within `max_size`
+        (defaults to the manager's budget). Returns the list of evicted entry keys."""
+        max_size = self.max_size if max_size is None else parse_size(max_size)
+        if max_size is None:
+            return []
+
+        with self._locked():
+            return self._evict(max_size)
+
+    def _evict(self, max_size):
+        entries = self.entries()
+        sizes = {
+            key: sum(_path_size(path) for path in paths)
+            for key, paths in entries.items()
+        }
+        total_size = sum(sizes.values())
+        if total_size <= max_size:
+            return []
+
+        index = self._read_index()
+        pinned = self.pinned_keys()
+
+        def last_access(key):
+            if key in index:
+                return index[key]
+            return max(
+                (path.stat().st_mtime for path in entries[key] if path.exists()),
+                default=0,
+            )
+
+        evicted = []
+        for key in sorted(entries, key=last_access):
+            if total_size <= max_size:
+                break
+            if key in pinned:
+                continue
+            logger.info(f"Evicting cache entry {key} ({sizes[key] / 1e6:.1f} Mb)")
+            for path in entries[key]:
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink(missing_ok=True)
+            total_size -= sizes[key]
+            index.pop(key, None)
+            evicted.append(key)
+
+        if total_size > max_size:
+            logger.warning(
+                f"Cache {self.cache_dir} is still {total_size / 1e6:.1f} Mb after eviction, over its {max_size / 1e6:.1f} Mb budget, as the remaining entries are pinned"
+            )
+        self._write_index(index)
+        return evicted
+
+
+def get_cache_manager(cache_dir, max_size=None):
+    "Get the `CacheManager` of all the module caches in `cache_dir`, which share one size budget"
+    return CacheManager(cache_dir, CACHE_ENTRY_DIRS, max_size=max_size)
+
+
+def _memory_size(value):
+    if hasattr(value, "memory_usage"):
+        return int(value.memory_usage(deep=True).sum())
+    return sys.getsizeof(value)
+
+
+class MemoryCache:
+    """A thread-safe dict-like cache of dataframes, dropping the least recently used items beyond `max_size`
+    (defaults to the `POVERTYMAPPING_MEMORY_CACHE_MAX_SIZE` env var or `DEFAULT_MEMORY_CACHE_MAX_SIZE`)
+    """
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = os.environ.get(
+                MEMORY_CACHE_MAX_SIZE_ENV_VAR, DEFAULT_MEMORY_CACHE_MAX_SIZE
+            )
+        self.max_size = parse_size(max_size)
+        self._items = collections.OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._items))
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def __getitem__(self, key):
+        with self._lock:
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def __setitem__(self, key, value):
+        size = _memory_size(value)
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            self._sizes[key] = size
+            # The new item is kept even if it doesn't fit on its own
+            while sum(self._sizes.values()) > self.max_size and len(self._items) > 1:
+                oldest = next(iter(self._items))
+                del self._items[oldest]
+                del self._sizes[oldest]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self._sizes.pop(key, None)
+            return self._items.pop(key, default)
+
+    def size(self):
+        "Get the total memory usage in bytes of the cached items"
+        with self._lock:
+            return sum(self._sizes.values())
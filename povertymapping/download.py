@@ -0,0 +1,355 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import IncompleteRead
+from pathlib import Path
+from urllib.error import ContentTooShortError, HTTPError, URLError
+
+from fastcore.net import urlopen
+from loguru import logger
+
+DEFAULT_N_CONNECTIONS = 4
+DEFAULT_PART_SIZE = 32 * 1024 * 1024
+DEFAULT_MAX_RETRIES = 5
+PART_SUFFIX = ".part"
+JOURNAL_SUFFIX = ".part.json"
+PARTIAL_SUFFIXES = (PART_SUFFIX, JOURNAL_SUFFIX, JOURNAL_SUFFIX + ".tmp")
+
+# Transient HTTP errors worth retrying, other HTTP errors are raised right away
+RETRY_HTTP_CODES = [408, 429, 500, 502, 503, 504]
+
+
+class DownloadAuthError(HTTPError):
+    "Raised when the server rejects the credentials of a range request partway through a download"
+
+
+def ranged_urlretrieve(
+    url,
+    filename,
+    headers=None,
+    reporthook=None,
+    timeout=None,
+    chunksize=1024 * 1024,
+    n_connections=DEFAULT_N_CONNECTIONS,
+    part_size=DEFAULT_PART_SIZE,
+    max_retries=DEFAULT_MAX_RETRIES,
+    backoff=1.0,
+    checksum=None,
+    checksum_algorithm="md5",
+    is_auth_failure=None,
+):
+    """Download `url` into `filename` over several concurrent HTTP Range requests, resuming an interrupted
+    download of the same remote file from `{filename}.part`. Returns `(filename, response_headers, response)`.
+
+    Args:
+        max_retries: Retries of each range, with exponential `backoff`
+        checksum: Hex digest (computed with `checksum_algorithm`) the downloaded file is checked against
+        reporthook: Called as `reporthook(bytes_downloaded, 1, total_size)`
+        is_auth_failure: Called with the response headers of a range request that didn't get a 206,
+            to tell a rejected (e.g. expired) access token apart from a server ignoring Range requests
+    Raises:
+        DownloadAuthError: If the credentials are rejected partway through, the download resumes
+            from `{filename}.part` once called again with new credentials
+    """
+    filename = Path(filename)
+    part_file = filename.with_name(filename.name + PART_SUFFIX)
+    journal_file = filename.with_name(filename.name + JOURNAL_SUFFIX)
+
+    size, accepts_ranges, respheaders, fp = _retry(
+        lambda: _probe_url(url, headers=headers, timeout=timeout),
+        max_retries=max_retries,
+        backoff=backoff,
+    )
+
+    if not accepts_ranges or size is None or size == 0:
+        logger.info(f"Retrieving {url} into {filename} over a single connection")
+        written = _retry(
+            lambda: _stream_download(
+                url,
+                part_file,
+                headers=headers,
+                reporthook=reporthook,
+                timeout=timeout,
+                chunksize=chunksize,
+            ),
+            max_retries=max_retries,
+            backoff=backoff,
+        )
+    else:
+        written = _ranged_download(
+            url,
+            part_file,
+            journal_file,
+            size,
+            _remote_version(respheaders),
+            headers=headers,
+            reporthook=reporthook,
+            timeout=timeout,
+            chunksize=chunksize,
+            n_connections=n_connections,
+            part_size=part_size,
+            max_retries=max_retries,
+            backoff=backoff,
+            is_auth_failure=is_auth_failure,
+        )
+
+    _verify_download(
+        part_file,
+        journal_file,
+        size,
+        written,
+        checksum,
+        checksum_algorithm,
+        respheaders,
+    )
+    os.replace(part_file, filename)
+    journal_file.unlink(missing_ok=True)
+    return filename, respheaders, fp
+
+
+def is_partial_download(filename):
+    "Check if `filename` is the partial file or journal of an unfinished `ranged_urlretrieve`"
+    return str(filename).endswith(PARTIAL_SUFFIXES)
+
+
+def _remote_version(respheaders):
+    "Identify the version of the remote file, so a resume never mixes two versions"
+    return respheaders.get("ETag") or respheaders.get("Last-Modified")
+
+
+def _probe_url(url, headers=None, timeout=None):
+    "Request the first byte of `url` to find out its size and whether it supports Range requests"
+    probe_headers = dict(headers or {}, Range="bytes=0-0")
+    with contextlib.closing(
+        urlopen(url, data=None, headers=probe_headers, timeout=timeout)
+    ) as fp:
+        respheaders = fp.info()
+        content_range = respheaders.get("Content-Range", "")
+        match = re.fullmatch(r"bytes 0-0/(\d+)", content_range.strip())
+        if fp.status == 206 and match is not None:
+            return int(match.group(1)), True, respheaders, fp
+        size = respheaders.get("Content-Length")
+        return (int(size) if size is not None else None), False, respheaders, fp
+
+
+def _stream_download(
+    url, dest, headers=None, reporthook=None, timeout=None, chunksize=8192
+):
+    with contextlib.closing(
+        urlopen(url, data=None, headers=headers, timeout=timeout)
+    ) as fp:
+        respheaders = fp.info()
+        with open(dest, "wb") as tfp:
+            size = -1
+            read = 0
+            if "Content-length" in respheaders:
+                size = int(respheaders["Content-Length"])
+            if reporthook:
+                reporthook(read, 1, size)
+            while True:
+                block = fp.read(chunksize)
+                if not block:
+                    break
+                read += len(block)
+                tfp.write(block)
+                if reporthook:
+                    reporthook(read, 1, size)
+
+    if size >= 0 and read < size:
+        raise ContentTooShortError(
+            f"retrieval incomplete: got only {read} out of {size} bytes", respheaders
+        )
+    return read
+
+
+def _ranged_download(
+    url,
+    part_file,
+    journal_file,
+    size,
+    version,
+    headers,
+    reporthook,
+    timeout,
+    chunksize,
+    n_connections,
+    part_size,
+    max_retries,
+    backoff,
+    is_auth_failure=None,
+):
+    ranges = [
+        (start, min(start + part_size, size) - 1) for start in range(0, size, part_size)
+    ]
+    journal = dict(
+        url=url, size=size, part_size=part_size, version=version, done=[], written=0
+    )
+    if (
+        part_file.exists()
+        and journal_file.exists()
+        and part_file.stat().st_size == size
+    ):
+        with open(journal_file) as f:
+            saved_journal = json.load(f)
+        if "written" in saved_journal and all(
+            saved_journal.get(k) == journal[k]
+            for k in ["url", "size", "part_size", "version"]
+        ):
+            journal = saved_journal
+    done = set(journal["done"])
+    if len(done) == 0:
+        with open(part_file, "wb") as f:
+            f.truncate(size)
+    else:
+        logger.info(f"Resuming download of {url}, {len(done)}/{len(ranges)} parts done")
+
+    lock = threading.Lock()
+    downloaded = [
+        sum(end - start + 1 for i, (start, end) in enumerate(ranges) if i in done)
+    ]
+    if reporthook:
+        reporthook(downloaded[0], 1, size)
+
+    def on_progress(nbytes):
+        with lock:
+            downloaded[0] += nbytes
+            if reporthook:
+                reporthook(downloaded[0], 1, size)
+
+    def download_part(part_idx):
+        start, end = ranges[part_idx]
+        written = _retry(
+            lambda: _download_range(
+                url,
+                fd,
+                start,
+                end,
+                headers=headers,
+                timeout=timeout,
+                chunksize=chunksize,
+                on_progress=on_progress,
+                is_auth_failure=is_auth_failure,
+            ),
+            max_retries=max_retries,
+            backoff=backoff,
+        )
+        with lock:
+            journal["done"].append(part_idx)
+            journal["written"] += written
+            _write_journal(journal, journal_file)
+
+    logger.info(
+        f"Retrieving {url} into {part_file} in {len(ranges)} parts over {n_connections} connections"
+    )
+    fd = os.open(part_file, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=n_connections) as executor:
+            pending = [i for i in range(len(ranges)) if i not in done]
+            futures = [executor.submit(download_part, i) for i in pending]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Don't start the remaining parts once one has failed for good
+                executor.shutdown(cancel_futures=True)
+                raise
+    finally:
+        os.close(fd)
+    return journal["written"]
+
+
+def _download_range(
+    url, fd, start, end, headers, timeout, chunksize, on_progress, is_auth_failure=None
+):
+    range_headers = dict(headers or {}, Range=f"bytes={start}-{end}")
+    offset = start
+    try:
+        try:
+            fp = urlopen(url, data=None, headers=range_headers, timeout=timeout)
+        except HTTPError as err:
+            if err.code in (401, 403):
+                raise DownloadAuthError(
+                    url, err.code, f"Credentials rejected for {url}", err.hdrs, None
+                ) from err
+            raise
+        with contextlib.closing(fp):
+            if fp.status != 206:
+                # e.g. a redirect to a login page once the access token expired
+                if is_auth_failure is not None and is_auth_failure(fp.info()):
+                    raise DownloadAuthError(
+                        url, 401, f"Credentials rejected for {url}", fp.info(), None
+                    )
+                raise ValueError(f"Server ignored the Range request for {url}")
+            while offset <= end:
+                block = fp.read(min(chunksize, end - offset + 1))
+                if not block:
+                    break
+                os.pwrite(fd, block, offset)
+                offset += len(block)
+                on_progress(len(block))
+    finally:
+        # Retries start over from the beginning of the range
+        if offset <= end:
+            on_progress(start - offset)
+    if offset <= end:
+        raise ContentTooShortError(
+            f"retrieval incomplete: got only {offset - start} out of {end - start + 1} bytes",
+            None,
+        )
+    return offset - start
+
+
+def _write_journal(journal, journal_file):
+    tmp_file = journal_file.with_name(journal_file.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(journal, f)
+    os.replace(tmp_file, journal_file)
+
+
+def _verify_download(
+    part_file, journal_file, size, written, checksum, checksum_algorithm, respheaders
+):
+    if size is not None and written != size:
+        part_file.unlink(missing_ok=True)
+        journal_file.unlink(missing_ok=True)
+        raise ContentTooShortError(
+            f"retrieval incomplete: got {written} out of {size} bytes", respheaders
+        )
+    if checksum is not None:
+        file_hash = hashlib.new(checksum_algorithm)
+        with open(part_file, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(block)
+        if file_hash.hexdigest() != checksum.lower():
+            part_file.unlink(missing_ok=True)
+            journal_file.unlink(missing_ok=True)
+            raise ValueError(
+                f"{checksum_algorithm} checksum mismatch for {part_file}: expected {checksum}, got {file_hash.hexdigest()}"
+            )
+
+
+def _is_retryable(err):
+    if isinstance(err, HTTPError):
+        return err.code in RETRY_HTTP_CODES
+    return isinstance(
+        err,
+        (URLError, ContentTooShortError, IncompleteRead, ConnectionError, TimeoutError),
+    )
+
+
+def _retry(func, max_retries=DEFAULT_MAX_RETRIES, backoff=1.0):
+    "Call `func`, retrying transient network errors with exponential backoff"
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as err:
+            if attempt == max_retries or not _is_retryable(err):
+                raise
+            wait = backoff * 2**attempt
+            logger.warning(f"Download failed with {err!r}, retrying in {wait}s")
+            time.sleep(wait)
@@ -27,6 +27,10 @@ def generate_features(
     use_aoi_quadkey=False,
     aoi_quadkey_col="quadkey",
     use_hrsl=False,
+    nightlights_cluster_zoom=None,
+    use_ookla_yearly_index=False,
+    use_aoi_bbox=False,
+    use_ookla_quadkey_aggregation=False,
 ) -> pd.DataFrame:
     """Generates the base features for an AOI based on
     OSM, Ookla, and VIIRS (nighttime lights) data
@@ -46,6 +50,16 @@ def generate_features(
         scaled_only (bool, optional): Whether to return only the scaled features or not. Defaults to False.
         features_only (bool, optional): Whether to return only the generated features or not. Defaults to False.
         use_hrsl (bool, optional): Whether to add the HDX HRSL population as a feature or not. Defaults to False.
+        nightlights_cluster_zoom (int, optional): If set, clip the nighttime lights rasters separately for each cluster
+            of touching Bing tiles at this zoom level, recommended for archipelagos (e.g. 8). Defaults to None.
+        use_ookla_yearly_index (bool, optional): Whether to slice the Ookla features from a global yearly index, built once per
+            type and year and shared by all AOIs, recommended for multi-country rollouts. Defaults to False.
+        use_aoi_bbox (bool, optional): Whether to read only the OSM data around the AOI bounds instead of the whole country,
+            recommended for small AOIs (e.g. a province or a set of DHS clusters). Only applies to OSM, the Ookla
+            and nighttime lights data are read as usual. Defaults to False.
+        use_ookla_quadkey_aggregation (bool, optional): Whether to aggregate the Ookla features by quadkey prefix instead of
+            an area overlay when the AOI is a grid of tiles with quadkeys in aoi_quadkey_col. Faster, but the mean Ookla
+            features differ from the overlay, which also counts the slivers of neighbouring tiles. Defaults to False.
 
     Returns:
         aoi (pd.DataFrame): The AOI dataframe with its new features.
@@ -64,33 +78,38 @@ def generate_features(
 
     # Add in OSM features
     aoi = osm.add_osm_poi_features(
-        aoi, country_osm, osm_data_manager, use_cache=use_cache
+        aoi,
+        country_osm,
+        osm_data_manager,
+        use_cache=use_cache,
+        use_aoi_bbox=use_aoi_bbox,
     )
     aoi = osm.add_osm_road_features(
-        aoi, country_osm, osm_data_manager, use_cache=use_cache
+        aoi,
+        country_osm,
+        osm_data_manager,
+        use_cache=use_cache,
+        use_aoi_bbox=use_aoi_bbox,
     )
 
     # Add in Ookla features
-    aoi = ookla.add_ookla_features(
-        aoi,
-        "fixed",
-        ookla_year,
-        ookla_data_manager,
-        use_aoi_quadkey=use_aoi_quadkey,
-        aoi_quadkey_col=aoi_quadkey_col,
-    )
-    aoi = ookla.add_ookla_features(
+    aoi = ookla.add_ookla_multi_features(
         aoi,
-        "mobile",
-        ookla_year,
+        ["fixed", "mobile"],
+        [ookla_year],
         ookla_data_manager,
         use_aoi_quadkey=use_aoi_quadkey,
         aoi_quadkey_col=aoi_quadkey_col,
+        use_yearly_index=use_ookla_yearly_index,
+        use_quadkey_aggregation=use_ookla_quadkey_aggregation,
     )
 
     # Add in the nighttime lights features
     aoi = nightlights.generate_nightlights_feature(
-        aoi, nightlights_year, cache_dir=f"{cache_dir}/nightlights"
+        aoi,
+        nightlights_year,
+        cache_dir=f"{cache_dir}/nightlights",
+        cluster_zoom=nightlights_cluster_zoom,
     )
 
     # Add in the population feature
@@ -12,6 +12,7 @@ from loguru import logger
 import geowrangler.raster_zonal_stats as rzs
 import numpy as np
 import pandas as pd
+from povertymapping.cache import get_cache_manager
 from povertymapping.nightlights import urlretrieve
 from povertymapping.iso3 import get_iso3_code
 
@@ -197,6 +198,7 @@ def get_hrsl_file(
     use_cache=True,
     show_progress=True,
     chunksize=1024 * 1024,
+    cache_max_size=None,
 ):
     unzipped_hrslfile = get_unzipped_hrslfile(
         region,
@@ -205,8 +207,10 @@ def get_hrsl_file(
         demographic=demographic,
         cache_dir=cache_dir,
     )
+    cache = get_cache_manager(unzipped_hrslfile.parent.parent, max_size=cache_max_size)
 
     if unzipped_hrslfile.exists() and use_cache:
+        cache.touch(unzipped_hrslfile)
         return unzipped_hrslfile
 
     zipfile_path = download_hrsl(
@@ -239,6 +243,10 @@ def get_hrsl_file(
         f"HRSL Data: Successfully downloaded and cached for {region} at {zipfile_path}!"
     )
 
+    cache.touch(unzipped_hrslfile)
+    with cache.pin(unzipped_hrslfile):
+        cache.evict()
+
     return unzipped_hrslfile
 
 
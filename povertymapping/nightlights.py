@@ -1,29 +1,61 @@
+import base64
 import contextlib
 import getpass
 import gzip
 import hashlib
 import json
 import os
+import re
 import shutil
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from types import SimpleNamespace
-from urllib.error import ContentTooShortError, HTTPError
+from urllib.error import HTTPError
 from urllib.parse import urlparse
 
 import geowrangler.raster_process as rp
 import geowrangler.raster_zonal_stats as rzs
 import numpy as np
+import pandas as pd
+import rasterio as rio
 import requests
-from fastcore.net import urlclean, urldest, urlopen
+import shapely
+from fastcore.net import urlclean, urldest
 from fastprogress.fastprogress import progress_bar
 from loguru import logger
+from rasterio import features
+from rasterio.enums import Resampling
 from shapely.geometry import box
 
+from povertymapping.cache import CacheManager, get_cache_manager
+from povertymapping.download import (
+    DEFAULT_N_CONNECTIONS,
+    DownloadAuthError,
+    ranged_urlretrieve,
+)
+
 HOME_FOLDER = Path(os.path.expanduser("~"))
 DEFAULT_EOG_CREDS_PATH = HOME_FOLDER / ".eog_creds/eog_access_token.txt"
 EOG_ENV_VAR = "EOG_ACCESS_TOKEN"
+EOG_USERNAME_ENV_VAR = "EOG_USERNAME"
+EOG_PASSWORD_ENV_VAR = "EOG_PASSWORD"
+# Treat tokens expiring within this many seconds as expired so a download
+# doesn't start with a token that runs out midway
+EOG_TOKEN_MIN_VALIDITY = 300
+# The username a cached token belongs to is saved next to it with this suffix
+EOG_TOKEN_USER_SUFFIX = "_USER"
 NIGHTLIGHTS_CACHE_DIR = HOME_FOLDER / ".geowrangler/nightlights"
+NIGHTLIGHTS_CACHE_ENTRY_DIRS = ["global", "clip"]
+# Web mercator latitude limits of the Bing tiles
+MAX_TILE_LATITUDE = 85.05112878
+
+# Credentials from the last `get_eog_access_token` call, kept in memory only,
+# so that downloads can refresh an expired token without user interaction
+_eog_credentials = {}
+_eog_token_lock = threading.Lock()
 
 
 # Retrieve access token
@@ -34,25 +66,165 @@ def get_eog_access_token(
     save_path=DEFAULT_EOG_CREDS_PATH,
     set_env=True,
     env_token_var=EOG_ENV_VAR,
+    use_cache=True,
+    min_validity=EOG_TOKEN_MIN_VALIDITY,
 ):
-    # Get from API if no local cache yet
-    access_token = _get_eog_access_token_from_api(username, password)
-
-    if save_token:
-        logger.info(f"Saving access_token to {save_path}")
-        save_path = Path(os.path.expanduser(save_path))
-        if not save_path.parent.exists():
-            logger.info(f"Creating access token directory {save_path.parent}")
-            save_path.parent.mkdir(mode=510, parents=True, exist_ok=True)
-        with open(save_path, "w") as f:
-            f.write(access_token)
+    """Get an EOG access token, reusing the token in `env_token_var` or `save_path` until it expires.
+
+    Args:
+        use_cache: If False, always request a new token
+        min_validity: Seconds a cached token must still be valid for to be reused
+    """
+    _eog_credentials.update(username=username, password=password)
+
+    with _eog_token_lock:
+        access_token = None
+        if use_cache:
+            access_token = get_cached_eog_access_token(
+                env_var=env_token_var,
+                creds_file=save_path,
+                min_validity=min_validity,
+                username=username,
+            )
+
+        if access_token is None:
+            # Get from API if no valid local cache yet
+            access_token = _get_eog_access_token_from_api(username, password)
+        if save_token:
+            _save_eog_access_token(access_token, save_path, username)
+
     if set_env:
         logger.info(f"Adding access token to environment var {env_token_var}")
-        os.environ[env_token_var] = access_token
+        _set_eog_access_token_env(access_token, env_token_var, username)
 
     return access_token
 
 
+def get_eog_access_token_expiry(access_token):
+    "Get the expiry time (unix timestamp) of an EOG access token (JWT), or None if it can't be read"
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def is_eog_access_token_valid(access_token, min_validity=EOG_TOKEN_MIN_VALIDITY):
+    "Check if an access token is valid for at least `min_validity` seconds, assuming so if its expiry is unreadable"
+    if not access_token:
+        return False
+    expiry = get_eog_access_token_expiry(access_token)
+    if expiry is None:
+        return True
+    return expiry - time.time() > min_validity
+
+
+def get_cached_eog_access_token(
+    env_var=EOG_ENV_VAR,
+    creds_file=DEFAULT_EOG_CREDS_PATH,
+    min_validity=EOG_TOKEN_MIN_VALIDITY,
+    username=None,
+):
+    """Get a valid access token from the environment var or the saved file, or None if there is none.
+    If `username` is set, only a token retrieved for that user is returned."""
+    access_token = os.environ.get(env_var, None)
+    token_user = os.environ.get(env_var + EOG_TOKEN_USER_SUFFIX)
+    if is_eog_access_token_valid(access_token, min_validity=min_validity) and (
+        username is None or token_user == username
+    ):
+        logger.info(f"Using access token from environment var {env_var}")
+        return access_token
+
+    save_path = Path(os.path.expanduser(creds_file))
+    if save_path.exists():
+        with open(save_path) as f:
+            access_token = f.read().strip()
+        if username is not None and _read_eog_token_user(save_path) != username:
+            logger.info(f"Saved access token in {save_path} is for another user")
+            return None
+        if is_eog_access_token_valid(access_token, min_validity=min_validity):
+            logger.info(f"Using access token from saved file {save_path}")
+            return access_token
+        logger.info(f"Saved access token in {save_path} has expired")
+
+    return None
+
+
+def refresh_eog_access_token(
+    env_var=EOG_ENV_VAR,
+    creds_file=DEFAULT_EOG_CREDS_PATH,
+    min_validity=EOG_TOKEN_MIN_VALIDITY,
+    rejected_token=None,
+):
+    """Get a new access token with the credentials of the last `get_eog_access_token` call
+    (or the `EOG_USERNAME` and `EOG_PASSWORD` env vars), or None if there are none.
+    A cached token equal to `rejected_token` is never reused.
+    """
+    username = _eog_credentials.get("username") or os.environ.get(EOG_USERNAME_ENV_VAR)
+    password = _eog_credentials.get("password") or os.environ.get(EOG_PASSWORD_ENV_VAR)
+    if not username or not password:
+        logger.warning(
+            "No EOG credentials available to refresh the access token, please call `get_eog_access_token`"
+        )
+        return None
+
+    with _eog_token_lock:
+        # Another worker may have refreshed the token while we were waiting
+        access_token = get_cached_eog_access_token(
+            env_var=env_var,
+            creds_file=creds_file,
+            min_validity=min_validity,
+            username=username,
+        )
+        if access_token is None or access_token == rejected_token:
+            logger.info("Refreshing EOG access token")
+            access_token = _get_eog_access_token_from_api(username, password)
+            save_path = Path(os.path.expanduser(creds_file))
+            if save_path.exists():
+                _save_eog_access_token(access_token, save_path, username)
+        _set_eog_access_token_env(access_token, env_var, username)
+
+    return access_token
+
+
+def _eog_token_user_path(save_path):
+    return save_path.with_name(save_path.name + EOG_TOKEN_USER_SUFFIX.lower())
+
+
+def _read_eog_token_user(save_path):
+    user_path = _eog_token_user_path(save_path)
+    if not user_path.exists():
+        return None
+    with open(user_path) as f:
+        return f.read().strip()
+
+
+def _set_eog_access_token_env(access_token, env_var, username):
+    os.environ[env_var] = access_token
+    os.environ[env_var + EOG_TOKEN_USER_SUFFIX] = username
+
+
+def _write_atomic(path, text):
+    # Write to a temp file and rename, so parallel workers never read a partial file
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _save_eog_access_token(access_token, save_path, username):
+    logger.info(f"Saving access_token to {save_path}")
+    save_path = Path(os.path.expanduser(save_path))
+    if not save_path.parent.exists():
+        logger.info(f"Creating access token directory {save_path.parent}")
+        save_path.parent.mkdir(mode=510, parents=True, exist_ok=True)
+    # Drop the previous user first, so the new token is never paired with it
+    _eog_token_user_path(save_path).unlink(missing_ok=True)
+    _write_atomic(save_path, access_token)
+    _write_atomic(_eog_token_user_path(save_path), username)
+
+
 def _get_eog_access_token_from_api(username, password):
     params = {
         "client_id": "eogdata_oidc",
@@ -85,47 +257,39 @@ def clear_eog_access_token(
     if clear_file and save_path.exists():
         logger.info(f"Clearing eog access token file {save_file}")
         save_path.unlink()
+        _eog_token_user_path(save_path).unlink(missing_ok=True)
     if clear_env:
         logger.info(f"Clearing eog access token environment var {env_var}")
         os.environ[env_var] = ""
+        os.environ.pop(env_var + EOG_TOKEN_USER_SUFFIX, None)
 
 
-# from https://github.com/fastai/fastcore/blob/86337bad16a65f23c5335286ab73cd4d6425c586/fastcore/net.py#L147
-# add headers to urlwrap call (to allow auth)
 def urlretrieve(
-    url, filename, headers=None, reporthook=None, timeout=None, chunksize=8192
+    url,
+    filename,
+    headers=None,
+    reporthook=None,
+    timeout=None,
+    chunksize=8192,
+    n_connections=DEFAULT_N_CONNECTIONS,
+    checksum=None,
+    is_auth_failure=None,
 ):
-    "Same as `urllib.request.urlretrieve` but also works with `Request` objects"
-    with contextlib.closing(
-        urlopen(url, data=None, headers=headers, timeout=timeout)
-    ) as fp:
-        respheaders = fp.info()
-        logger.info(f"Retrieving {url} into {filename}")
-        with open(filename, "wb") as tfp:
-            size = -1
-            read = 0
-            blocknum = 0
-            if "Content-length" in respheaders:
-                size = int(respheaders["Content-Length"])
-                if size < chunksize:
-                    chunksize = size
-            if reporthook:
-                reporthook(blocknum, chunksize, size)
-            while True:
-                block = fp.read(chunksize)
-                if not block:
-                    break
-                read += len(block)
-                tfp.write(block)
-                blocknum += 1
-                if reporthook:
-                    reporthook(blocknum, chunksize, size)
-
-    if size >= 0 and read < size:
-        raise ContentTooShortError(
-            f"retrieval incomplete: got only {read} out of {size} bytes", respheaders
-        )
-    return filename, respheaders, fp
+    """Same as `urllib.request.urlretrieve` but also works with `Request` objects and `headers` (to allow auth).
+    Large files are downloaded over `n_connections` concurrent Range requests, resuming any
+    interrupted download of `filename` (see `povertymapping.download.ranged_urlretrieve`).
+    """
+    return ranged_urlretrieve(
+        url,
+        filename,
+        headers=headers,
+        reporthook=reporthook,
+        timeout=timeout,
+        chunksize=chunksize,
+        n_connections=n_connections,
+        checksum=checksum,
+        is_auth_failure=is_auth_failure,
+    )
 
 
 def download_url(
@@ -138,8 +302,9 @@ def download_url(
     chunksize=1024 * 1024,
     env_var=EOG_ENV_VAR,
     creds_file=DEFAULT_EOG_CREDS_PATH,
+    n_connections=DEFAULT_N_CONNECTIONS,
 ):
-    "Download `url` to `dest` and show progress"
+    "Download `url` to `dest` over `n_connections` concurrent connections and show progress"
     if show_progress:
         pbar = progress_bar([])
 
@@ -151,41 +316,52 @@ def download_url(
     else:
         reporthook = None
 
+    refresh_token = access_token is None
     if access_token is None:
-        # try getting it from environ
-        if (
-            os.environ.get(env_var, None) is not None
-            and len(os.environ.get(env_var)) > 0
-        ):
-            logger.info(f"Using access token from environment var {env_var}")
-            access_token = os.environ.get(env_var)
-        else:
-            save_path = Path(os.path.expanduser(creds_file))
-            if save_path.exists():
-                logger.info(f"Using access token from saved file {save_path}")
-                with open(save_path) as f:
-                    access_token = f.read()
+        access_token = get_cached_eog_access_token(
+            env_var=env_var, creds_file=creds_file
+        )
+        if access_token is None:
+            access_token = refresh_eog_access_token(
+                env_var=env_var, creds_file=creds_file
+            )
 
+    headers = dict(headers) if headers else {}
     if access_token:
-        auth = "Bearer " + access_token
-        if headers:
-            headers.update(dict(Authorization=auth))
-        else:
-            headers = dict(Authorization=auth)
+        headers.update(Authorization="Bearer " + access_token)
 
     dest = urldest(url, dest)
     if not dest.parent.is_dir():  # parent dir should always exist
         dest.parent.mkdir(parents=True, exist_ok=True)
 
-    nm, resp, fp = urlretrieve(
-        url,
-        filename=dest,
-        headers=headers,
-        reporthook=reporthook,
-        timeout=timeout,
-        chunksize=chunksize,
-    )
-    if "Cache-Control" in resp and "must-revalidate" in resp["Cache-Control"]:
+    def retrieve():
+        try:
+            nm, resp, fp = urlretrieve(
+                url,
+                filename=dest,
+                headers=headers,
+                reporthook=reporthook,
+                timeout=timeout,
+                chunksize=chunksize,
+                n_connections=n_connections,
+                is_auth_failure=_is_eog_auth_failure,
+            )
+        except DownloadAuthError as err:
+            # Rejected partway through, the parts already downloaded are kept
+            return None, err.hdrs, None, True
+        return nm, resp, fp, _is_eog_auth_failure(resp)
+
+    nm, resp, fp, auth_failed = retrieve()
+    if auth_failed and refresh_token:
+        # The token may have been revoked or expired early, retry once with a new one
+        logger.info("EOG rejected the access token, retrying with a refreshed token")
+        access_token = refresh_eog_access_token(
+            env_var=env_var, creds_file=creds_file, rejected_token=access_token
+        )
+        if access_token:
+            headers.update(Authorization="Bearer " + access_token)
+            nm, resp, fp, auth_failed = retrieve()
+    if auth_failed:
         raise HTTPError(
             url,
             401,
@@ -196,6 +372,11 @@ def download_url(
     return nm
 
 
+def _is_eog_auth_failure(resp):
+    # EOG redirects to its login page instead of returning a 401
+    return "Cache-Control" in resp and "must-revalidate" in resp["Cache-Control"]
+
+
 def unzip_eog_gzip(gz_file, dest=None, delete_src=False):
     if gz_file is None:
         raise ValueError("gz_file cannot be empty")
@@ -270,10 +451,33 @@ EOG_VIIRS_DATA_TYPE = SimpleNamespace(
     MEDIAN_MASKED="median_masked",
     MINIMUM="minimum",
 )
-EOG_PRODUCT = SimpleNamespace(ANNUAL="annual")
-EOG_PRODUCT_VERSION = SimpleNamespace(VER21="v21", VER22="v22")
+# Feature column prefix for each VIIRS data type, `avg_rad` kept for the average
+# to match the features of `generate_nightlights_feature`
+EOG_VIIRS_DATA_TYPE_COLUMN = {
+    EOG_VIIRS_DATA_TYPE.AVERAGE: "avg_rad",
+}
+EOG_PRODUCT = SimpleNamespace(ANNUAL="annual", MONTHLY="monthly")
+EOG_PRODUCT_VERSION = SimpleNamespace(VER21="v21", VER22="v22", VER10="v10")
 EOG_COVERAGE = SimpleNamespace(GLOBAL="global")
 
+EOG_MONTHLY_BASE_URL = "https://eogdata.mines.edu/nighttime_light/monthly_notile"
+EOG_MONTHLY_DATA_TYPE = SimpleNamespace(
+    AVERAGE="avg_rade9h",
+    CF_CVG="cf_cvg",
+    CVG="cvg",
+)
+# The processing timestamp in monthly filenames varies per month, so the
+# file is looked up in the monthly directory listing
+MONTHLY_FILE_PATTERN = r"SVDNB_npp_{year}{month:02d}01-\d{{8}}_{coverage}_{vcmcfg}_{version}_c\d+\.{viirs_data_type}\.tif(?:\.gz)?"
+# Seconds the monthly directory listings are cached for, since reprocessed composites get published
+EOG_LISTING_TTL = 3600
+DEFAULT_SEASONS = dict(
+    q1=[1, 2, 3],
+    q2=[4, 5, 6],
+    q3=[7, 8, 9],
+    q4=[10, 11, 12],
+)
+
 
 def make_url(
     year,
@@ -391,18 +595,30 @@ def generate_clipped_raster(
     viirs_unzip_file = viirs_cache_dir / viirs_unzip_filename
     logger.info(f"Using viirs global file as source raster: {viirs_unzip_file}")
 
-    if not viirs_unzip_file.exists():
-        viirs_zip_file = download_url(viirs_url, dest=viirs_cache_dir)
+    cache = get_nightlights_cache(cache_dir)
+    with cache.pin(viirs_unzip_file, viirs_cache_dir / viirs_zipped_filename):
+        if not viirs_unzip_file.exists():
+            viirs_zip_file = download_url(viirs_url, dest=viirs_cache_dir)
 
-        viirs_unzip_file = unzip_eog_gzip(
-            viirs_zip_file, dest=viirs_cache_dir, delete_src=True
+            viirs_unzip_file = unzip_eog_gzip(
+                viirs_zip_file, dest=viirs_cache_dir, delete_src=True
+            )
+        cache.touch(viirs_unzip_file)
+        clipped_raster = clip_raster(
+            viirs_unzip_file.as_posix(), dest.as_posix(), bounds, buffer=0.1
         )
-    clipped_raster = clip_raster(
-        viirs_unzip_file.as_posix(), dest.as_posix(), bounds, buffer=0.1
-    )
     return clipped_raster
 
 
+def get_nightlights_cache(cache_dir=NIGHTLIGHTS_CACHE_DIR, max_size=None):
+    "Get the `CacheManager` of the global and clipped rasters, with a `POVERTYMAPPING_CACHE_MAX_SIZE` budget by default"
+    cache_dir = Path(os.path.expanduser(cache_dir))
+    if cache_dir.name == NIGHTLIGHTS_CACHE_DIR.name:
+        # Share the budget with the other caches next to it, e.g. `~/.geowrangler/osm`
+        return get_cache_manager(cache_dir.parent, max_size=max_size)
+    return CacheManager(cache_dir, NIGHTLIGHTS_CACHE_ENTRY_DIRS, max_size=max_size)
+
+
 def generate_clipped_metadata(
     year,
     bounds,
@@ -450,6 +666,7 @@ def get_clipped_raster(
     cache_dir=NIGHTLIGHTS_CACHE_DIR,
     process_suffix="c202205302300",
     vcmcfg="vcmslcfg",
+    cache_max_size=None,
 ):
     key = make_clip_hash(
         year,
@@ -464,8 +681,10 @@ def get_clipped_raster(
     clip_cache_dir = Path(os.path.expanduser(cache_dir)) / "clip"
     clip_cache_dir.mkdir(parents=True, exist_ok=True)
     clipped_file = clip_cache_dir / f"{key}.tif"
+    cache = get_nightlights_cache(cache_dir, max_size=cache_max_size)
     if clipped_file.exists():
         logger.info(f"Retrieving clipped raster file {clipped_file}")
+        cache.touch(clipped_file)
         return clipped_file
     # generate clipped raster
     clipped_file = generate_clipped_raster(
@@ -476,6 +695,7 @@ def get_clipped_raster(
         version=version,
         product=product,
         coverage=coverage,
+        cache_dir=cache_dir,
         process_suffix=process_suffix,
         vcmcfg=vcmcfg,
     )
@@ -490,6 +710,10 @@ def get_clipped_raster(
         process_suffix,
         vcmcfg,
     )
+    cache.touch(clipped_file)
+    # Keep the cache within its size budget, without evicting the new clip
+    with cache.pin(clipped_file):
+        cache.evict()
     return clipped_file
 
 
@@ -507,7 +731,33 @@ def generate_nightlights_feature(
     func=None,
     column="avg_rad",
     copy=False,
+    cluster_zoom=None,
 ):
+    """Generate nightlights zonal stats features `{column}_{func}` for the AOI.
+
+    Args:
+        cluster_zoom: If set, clip and process each cluster of the AOI (see `get_aoi_clusters`) separately
+    """
+    if cluster_zoom is not None:
+        return apply_per_aoi_cluster(
+            aoi,
+            cluster_zoom,
+            lambda cluster_aoi: generate_nightlights_feature(
+                cluster_aoi,
+                year,
+                viirs_data_type=viirs_data_type,
+                version=version,
+                product=product,
+                coverage=coverage,
+                cache_dir=cache_dir,
+                process_suffix=process_suffix,
+                vcmcfg=vcmcfg,
+                extra_args=extra_args,
+                func=func,
+                column=column,
+            ),
+        )
+
     if year >= 2022:
         version = EOG_PRODUCT_VERSION.VER22
 
@@ -530,13 +780,985 @@ def generate_nightlights_feature(
     )
     if copy:
         aoi = aoi.copy()
-    aoi = rzs.create_raster_zonal_stats(
-        aoi,
-        clipped_raster_file.as_posix(),
-        aggregation=dict(
-            func=func,
-            column=column,
-        ),
-        extra_args=extra_args,
+    with get_nightlights_cache(cache_dir).pin(clipped_raster_file):
+        if is_tile_aligned(aoi.geometry.values, _get_transform(clipped_raster_file)):
+            # Fast path for grids of tiles, e.g. the bing tile rollout grids
+            logger.info(f"Computing tile aligned zonal stats for {len(aoi)} tiles")
+            nodata = extra_args.get("nodata", -999)
+            stack, transform = read_aligned_rasters(
+                [clipped_raster_file],
+                band_num=extra_args.get("band_num", 1),
+                nodata=nodata,
+            )
+            results = compute_tile_zonal_stats(
+                aoi.geometry.bounds.to_numpy(),
+                stack,
+                transform,
+                func,
+                nodata=nodata,
+                all_touched=extra_args.get("all_touched", False),
+            )
+            return aoi.assign(
+                **{
+                    f"{column}_{func_name}": results[:, 0, func_idx]
+                    for func_idx, func_name in enumerate(func)
+                }
+            )
+
+        aoi = rzs.create_raster_zonal_stats(
+            aoi,
+            clipped_raster_file.as_posix(),
+            aggregation=dict(
+                func=func,
+                column=column,
+            ),
+            extra_args=extra_args,
+        )
+    return aoi
+
+
+def _get_transform(raster_file):
+    with rio.open(raster_file) as src:
+        return src.transform
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    "Get the Bing tile x and y indices at `zoom` of arrays of longitudes and latitudes"
+    n_tiles = 2**zoom
+    lon = np.asarray(lon, dtype=np.float64)
+    lat_rad = np.radians(
+        np.clip(
+            np.asarray(lat, dtype=np.float64), -MAX_TILE_LATITUDE, MAX_TILE_LATITUDE
+        )
+    )
+    x = np.floor((lon + 180) / 360 * n_tiles)
+    y = np.floor(
+        (1 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / np.pi) / 2 * n_tiles
+    )
+    return (
+        np.clip(x, 0, n_tiles - 1).astype(np.int64),
+        np.clip(y, 0, n_tiles - 1).astype(np.int64),
+    )
+
+
+def get_aoi_clusters(aoi, cluster_zoom):
+    """Get the cluster label (0 to n_clusters - 1) of each AOI geometry, the clusters being the groups
+    of touching zoom `cluster_zoom` Bing tiles that contain the centers of the geometry bounds.
+    """
+    bounds = aoi.bounds
+    x, y = lonlat_to_tile(
+        (bounds.minx + bounds.maxx) / 2, (bounds.miny + bounds.maxy) / 2, cluster_zoom
+    )
+    tiles, tile_idx = np.unique(np.stack([x, y], axis=1), axis=0, return_inverse=True)
+    tile_lookup = {(tile_x, tile_y): i for i, (tile_x, tile_y) in enumerate(tiles)}
+
+    # Flood fill over the 8-neighbourhood of the occupied tiles
+    labels = np.full(len(tiles), -1)
+    n_clusters = 0
+    for start in range(len(tiles)):
+        if labels[start] >= 0:
+            continue
+        labels[start] = n_clusters
+        to_visit = [start]
+        while to_visit:
+            tile_x, tile_y = tiles[to_visit.pop()]
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    neighbour = tile_lookup.get((tile_x + dx, tile_y + dy))
+                    if neighbour is not None and labels[neighbour] < 0:
+                        labels[neighbour] = n_clusters
+                        to_visit.append(neighbour)
+        n_clusters += 1
+
+    return labels[tile_idx.ravel()]
+
+
+def apply_per_aoi_cluster(aoi, cluster_zoom, generate_feature):
+    """Apply `generate_feature` separately to each cluster of the AOI (see `get_aoi_clusters`)
+    and combine the results back in the original row order and index."""
+    if len(aoi) == 0:
+        return generate_feature(aoi)
+
+    labels = get_aoi_clusters(aoi, cluster_zoom)
+    n_clusters = labels.max() + 1
+    logger.info(
+        f"Generating features for {len(aoi)} geometries in {n_clusters} clusters at zoom level {cluster_zoom}"
+    )
+
+    cluster_results, cluster_positions = [], []
+    for label in range(n_clusters):
+        positions = np.flatnonzero(labels == label)
+        # geowrangler zonal stats merge results on a range index
+        cluster_aoi = aoi.iloc[positions].reset_index(drop=True)
+        cluster_result = generate_feature(cluster_aoi)
+        cluster_result.index = aoi.index[positions]
+        cluster_results.append(cluster_result)
+        cluster_positions.append(positions)
+
+    result = pd.concat(cluster_results)
+    return result.iloc[np.argsort(np.concatenate(cluster_positions))]
+
+
+ZONAL_STATS_FUNCS = dict(
+    min=np.min,
+    max=np.max,
+    mean=np.mean,
+    median=np.median,
+    std=np.std,
+    sum=np.sum,
+    count=np.size,
+)
+
+
+def read_aligned_rasters(raster_files, band_num=1, nodata=-999):
+    """Read a band from each raster onto the pixel grid of the first raster.
+    Returns a (n_rasters, rows, cols) float array and the affine transform of the grid.
+    """
+    layers = []
+    grid_transform, grid_shape, grid_bounds = None, None, None
+    for raster_file in raster_files:
+        with rio.open(raster_file) as src:
+            if grid_transform is None:
+                grid_transform, grid_shape, grid_bounds = (
+                    src.transform,
+                    src.shape,
+                    src.bounds,
+                )
+                layer = src.read(band_num)
+            elif src.transform == grid_transform and src.shape == grid_shape:
+                layer = src.read(band_num)
+            else:
+                logger.info(
+                    f"Resampling {raster_file} onto the grid of {raster_files[0]}"
+                )
+                window = rio.windows.from_bounds(*grid_bounds, transform=src.transform)
+                layer = src.read(
+                    band_num,
+                    window=window,
+                    out_shape=grid_shape,
+                    boundless=True,
+                    fill_value=nodata,
+                    resampling=Resampling.nearest,
+                )
+        layers.append(layer.astype(np.float64))
+    return np.stack(layers), grid_transform
+
+
+def _geometry_pixel_window(geom, transform, shape, all_touched=False):
+    "Get the (row_start, row_stop, col_start, col_stop) pixel ranges covering a geometry"
+    minx, miny, maxx, maxy = geom.bounds
+    (row_a, row_b), (col_a, col_b) = rio.transform.rowcol(
+        transform, [minx, maxx], [maxy, miny], op=float
+    )
+    pad = 1 if all_touched else 0
+    row_start = max(int(np.floor(min(row_a, row_b))) - pad, 0)
+    row_stop = min(int(np.ceil(max(row_a, row_b))) + pad, shape[0])
+    col_start = max(int(np.floor(min(col_a, col_b))) - pad, 0)
+    col_stop = min(int(np.ceil(max(col_a, col_b))) + pad, shape[1])
+    return row_start, row_stop, col_start, col_stop
+
+
+def compute_stacked_zonal_stats(
+    geometries,
+    stack,
+    transform,
+    func,
+    nodata=-999,
+    all_touched=False,
+    valid_mask=None,
+):
+    """Compute the zonal stats in `func` for every layer of `stack`, rasterizing each geometry once.
+
+    Args:
+        valid_mask: Pixels where it is False are ignored, as are `nodata` and NaN pixels
+    Returns:
+        An array of shape (n_geometries, n_layers, n_funcs)
+    """
+    if stack.ndim == 2:
+        stack = stack[np.newaxis, ...]
+    unknown_funcs = [f for f in func if f not in ZONAL_STATS_FUNCS]
+    if len(unknown_funcs) > 0:
+        raise ValueError(f"Unsupported zonal stats functions {unknown_funcs}")
+
+    if is_tile_aligned(geometries, transform):
+        return compute_tile_zonal_stats(
+            shapely.bounds(np.asarray(geometries)),
+            stack,
+            transform,
+            func,
+            nodata=nodata,
+            all_touched=all_touched,
+            valid_mask=valid_mask,
+        )
+
+    return _compute_geometry_zonal_stats(
+        geometries,
+        stack,
+        transform,
+        func,
+        nodata=nodata,
+        all_touched=all_touched,
+        valid_mask=valid_mask,
+    )
+
+
+def _compute_geometry_zonal_stats(
+    geometries, stack, transform, func, nodata, all_touched, valid_mask
+):
+    n_layers, height, width = stack.shape
+    results = np.full((len(geometries), n_layers, len(func)), np.nan)
+    count_idx = [i for i, f in enumerate(func) if f == "count"]
+    results[:, :, count_idx] = 0
+
+    for geom_idx, geom in enumerate(geometries):
+        if geom is None or geom.is_empty:
+            continue
+        row_start, row_stop, col_start, col_stop = _geometry_pixel_window(
+            geom, transform, (height, width), all_touched=all_touched
+        )
+        if row_stop <= row_start or col_stop <= col_start:
+            continue
+        window_transform = rio.windows.transform(
+            rio.windows.Window(
+                col_start, row_start, col_stop - col_start, row_stop - row_start
+            ),
+            transform,
+        )
+        geom_mask = features.geometry_mask(
+            [geom],
+            out_shape=(row_stop - row_start, col_stop - col_start),
+            transform=window_transform,
+            invert=True,
+            all_touched=all_touched,
+        )
+        if valid_mask is not None:
+            geom_mask &= valid_mask[row_start:row_stop, col_start:col_stop]
+        values = stack[:, row_start:row_stop, col_start:col_stop][:, geom_mask]
+        valid = ~np.isnan(values)
+        if nodata is not None:
+            valid &= values != nodata
+        for layer_idx in range(n_layers):
+            layer_values = values[layer_idx][valid[layer_idx]]
+            if layer_values.size == 0:
+                continue
+            for func_idx, func_name in enumerate(func):
+                results[geom_idx, layer_idx, func_idx] = ZONAL_STATS_FUNCS[func_name](
+                    layer_values
+                )
+
+    return results
+
+
+def is_tile_aligned(geometries, transform):
+    "Check if all geometries are axis-aligned rectangles (e.g. Bing tiles) over a north-up raster"
+    if transform.b != 0 or transform.d != 0 or transform.a <= 0 or transform.e >= 0:
+        return False
+    geometries = np.asarray(geometries)
+    if len(geometries) == 0 or shapely.is_missing(geometries).any():
+        return False
+    if not (shapely.get_type_id(geometries) == shapely.GeometryType.POLYGON).all():
+        return False
+    if not (shapely.get_num_coordinates(geometries) == 5).all():
+        return False
+    if (shapely.get_num_interior_rings(geometries) > 0).any():
+        return False
+    bounds = shapely.bounds(geometries)
+    bounds_area = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+    return bool(np.allclose(shapely.area(geometries), bounds_area, rtol=1e-9, atol=0))
+
+
+def _tile_pixel_ranges(bounds, transform, shape, all_touched=False):
+    "Get the pixel row and column ranges covered by each (minx, miny, maxx, maxy) rectangle"
+    cols_min = (bounds[:, 0] - transform.c) / transform.a
+    cols_max = (bounds[:, 2] - transform.c) / transform.a
+    rows_min = (bounds[:, 3] - transform.f) / transform.e
+    rows_max = (bounds[:, 1] - transform.f) / transform.e
+    if all_touched:
+        starts_stops = [
+            np.floor(rows_min),
+            np.ceil(rows_max),
+            np.floor(cols_min),
+            np.ceil(cols_max),
+        ]
+    else:
+        # Pixels whose center falls inside the rectangle
+        starts_stops = [
+            np.ceil(rows_min - 0.5),
+            np.ceil(rows_max - 0.5),
+            np.ceil(cols_min - 0.5),
+            np.ceil(cols_max - 0.5),
+        ]
+    row_start, row_stop, col_start, col_stop = [
+        np.clip(item, 0, limit).astype(np.int64)
+        for item, limit in zip(starts_stops, [shape[0], shape[0], shape[1], shape[1]])
+    ]
+    n_rows = np.maximum(row_stop - row_start, 0)
+    n_cols = np.maximum(col_stop - col_start, 0)
+    return row_start, col_start, n_rows, n_cols
+
+
+def compute_tile_zonal_stats(
+    bounds,
+    stack,
+    transform,
+    func,
+    nodata=-999,
+    all_touched=False,
+    valid_mask=None,
+    max_pixels=16_000_000,
+):
+    """Vectorized zonal stats for axis-aligned rectangles over a north-up raster stack.
+
+    Args:
+        bounds: Array of (minx, miny, maxx, maxy) rows, one per rectangle
+        max_pixels: Approximate number of pixels processed per batch of rectangles
+    Returns:
+        An array of shape (n_rectangles, n_layers, n_funcs)
+    """
+    if stack.ndim == 2:
+        stack = stack[np.newaxis, ...]
+    n_layers, height, width = stack.shape
+    n_tiles = len(bounds)
+    results = np.full((n_tiles, n_layers, len(func)), np.nan)
+
+    row_start, col_start, n_rows, n_cols = _tile_pixel_ranges(
+        np.asarray(bounds, dtype=np.float64),
+        transform,
+        (height, width),
+        all_touched=all_touched,
     )
+    n_pixels = n_rows * n_cols
+    batch_ids = (np.cumsum(n_pixels) - n_pixels) // max_pixels
+    batch_bounds = np.concatenate(
+        [[0], np.flatnonzero(np.diff(batch_ids)) + 1, [n_tiles]]
+    )
+
+    for batch_start, batch_stop in zip(batch_bounds[:-1], batch_bounds[1:]):
+        batch = slice(batch_start, batch_stop)
+        batch_n_pixels = n_pixels[batch]
+        # Enumerate the pixels of each tile, tile labels are sorted by construction
+        labels = np.repeat(np.arange(batch_stop - batch_start), batch_n_pixels)
+        offsets = np.repeat(np.cumsum(batch_n_pixels) - batch_n_pixels, batch_n_pixels)
+        local_idx = np.arange(len(labels)) - offsets
+        tile_n_cols = np.repeat(n_cols[batch], batch_n_pixels)
+        rows = np.repeat(row_start[batch], batch_n_pixels) + local_idx // tile_n_cols
+        cols = np.repeat(col_start[batch], batch_n_pixels) + local_idx % tile_n_cols
+
+        pixel_valid = (
+            valid_mask[rows, cols]
+            if valid_mask is not None
+            else np.ones_like(rows, bool)
+        )
+        for layer_idx in range(n_layers):
+            values = stack[layer_idx, rows, cols]
+            valid = pixel_valid & ~np.isnan(values)
+            if nodata is not None:
+                valid &= values != nodata
+            results[batch, layer_idx, :] = _group_stats(
+                labels[valid], values[valid], batch_stop - batch_start, func
+            )
+
+    return results
+
+
+def _group_stats(labels, values, n_groups, func):
+    "Compute the stats in `func` of `values` grouped by sorted integer `labels`"
+    results = np.full((n_groups, len(func)), np.nan)
+    count = np.bincount(labels, minlength=n_groups)
+    has_values = count > 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = np.bincount(labels, weights=values, minlength=n_groups)
+        mean = total / count
+    group_starts = (np.cumsum(count) - count)[has_values]
+
+    for func_idx, func_name in enumerate(func):
+        if func_name == "count":
+            results[:, func_idx] = count
+        elif func_name == "sum":
+            results[has_values, func_idx] = total[has_values]
+        elif func_name == "mean":
+            results[:, func_idx] = mean
+        elif func_name == "std":
+            deviations = values - mean[labels]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                variance = (
+                    np.bincount(labels, weights=deviations**2, minlength=n_groups)
+                    / count
+                )
+            results[:, func_idx] = np.sqrt(variance)
+        elif func_name in ["min", "max"] and len(values) > 0:
+            reduce = np.minimum if func_name == "min" else np.maximum
+            results[has_values, func_idx] = reduce.reduceat(values, group_starts)
+        elif func_name == "median" and len(values) > 0:
+            sorted_values = values[np.lexsort((values, labels))]
+            group_count = count[has_values]
+            lower = sorted_values[group_starts + (group_count - 1) // 2]
+            upper = sorted_values[group_starts + group_count // 2]
+            results[has_values, func_idx] = (lower + upper) / 2
+
+    return results
+
+
+def compute_trend_slope(values, x):
+    "Least squares slope of each row of `values` against `x`, ignoring NaN entries (NaN if less than two)"
+    x = np.broadcast_to(np.asarray(x, dtype=np.float64), values.shape)
+    valid = ~np.isnan(values)
+    n_valid = valid.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = np.where(valid, x, 0).sum(axis=1) / n_valid
+        y_mean = np.where(valid, values, 0).sum(axis=1) / n_valid
+        x_dev = np.where(valid, x - x_mean[:, np.newaxis], 0)
+        y_dev = np.where(valid, values - y_mean[:, np.newaxis], 0)
+        slope = (x_dev * y_dev).sum(axis=1) / (x_dev**2).sum(axis=1)
+    slope[n_valid < 2] = np.nan
+    return slope
+
+
+def generate_nightlights_timeseries_feature(
+    aoi,
+    years,
+    viirs_data_type=EOG_VIIRS_DATA_TYPE.AVERAGE,
+    version=EOG_PRODUCT_VERSION.VER21,
+    product=EOG_PRODUCT.ANNUAL,
+    coverage=EOG_COVERAGE.GLOBAL,
+    cache_dir=NIGHTLIGHTS_CACHE_DIR,
+    process_suffix="c202205302300",
+    vcmcfg="vcmslcfg",
+    extra_args=None,
+    func=None,
+    column="avg_rad",
+    trend=True,
+    trend_func="mean",
+    copy=False,
+    cluster_zoom=None,
+):
+    """Generate nightlights features `{column}_{year}_{func}` for several years in a single zonal pass.
+
+    Args:
+        trend: If True, also add the `{column}_{trend_func}_slope` (change per year) and
+            `{column}_{trend_func}_change` (last minus first available year) features.
+            `trend_func` does not need to be in `func`, the yearly features are only added for `func`
+        cluster_zoom: See `generate_nightlights_feature`
+    """
+    if cluster_zoom is not None:
+        return apply_per_aoi_cluster(
+            aoi,
+            cluster_zoom,
+            lambda cluster_aoi: generate_nightlights_timeseries_feature(
+                cluster_aoi,
+                years,
+                viirs_data_type=viirs_data_type,
+                version=version,
+                product=product,
+                coverage=coverage,
+                cache_dir=cache_dir,
+                process_suffix=process_suffix,
+                vcmcfg=vcmcfg,
+                extra_args=extra_args,
+                func=func,
+                column=column,
+                trend=trend,
+                trend_func=trend_func,
+            ),
+        )
+
+    years = sorted(int(year) for year in years)
+    if len(years) == 0:
+        raise ValueError("years cannot be empty")
+
+    if extra_args is None:
+        extra_args = dict(band_num=1, nodata=-999)
+
+    if func is None:
+        func = ["min", "max", "mean", "median", "std"]
+
+    # The trend is computed from the trend_func stats, which only get columns if requested
+    stat_funcs = list(func)
+    if trend and trend_func not in stat_funcs:
+        stat_funcs.append(trend_func)
+
+    cache = get_nightlights_cache(cache_dir)
+    clipped_raster_files = []
+    with contextlib.ExitStack() as pins:
+        for year in years:
+            year_version = EOG_PRODUCT_VERSION.VER22 if year >= 2022 else version
+            clipped_raster_file = get_clipped_raster(
+                year,
+                aoi.total_bounds,
+                viirs_data_type=viirs_data_type,
+                version=year_version,
+                product=product,
+                coverage=coverage,
+                cache_dir=cache_dir,
+                process_suffix=process_suffix,
+                vcmcfg=vcmcfg,
+            )
+            # Keep earlier years from being evicted while the later years are clipped
+            pins.enter_context(cache.pin(clipped_raster_file))
+            clipped_raster_files.append(clipped_raster_file)
+
+        nodata = extra_args.get("nodata", -999)
+        stack, transform = read_aligned_rasters(
+            clipped_raster_files, band_num=extra_args.get("band_num", 1), nodata=nodata
+        )
+    logger.info(
+        f"Computing zonal stats for {len(aoi)} geometries over {len(years)} years"
+    )
+    results = compute_stacked_zonal_stats(
+        aoi.geometry.values,
+        stack,
+        transform,
+        stat_funcs,
+        nodata=nodata,
+        all_touched=extra_args.get("all_touched", False),
+    )
+
+    if copy:
+        aoi = aoi.copy()
+    for year_idx, year in enumerate(years):
+        for func_idx, func_name in enumerate(func):
+            aoi[f"{column}_{year}_{func_name}"] = results[:, year_idx, func_idx]
+
+    if trend:
+        trend_values = results[:, :, stat_funcs.index(trend_func)]
+        aoi[f"{column}_{trend_func}_slope"] = compute_trend_slope(trend_values, years)
+        first_valid = np.argmax(~np.isnan(trend_values), axis=1)
+        last_valid = (
+            trend_values.shape[1]
+            - 1
+            - np.argmax(~np.isnan(trend_values[:, ::-1]), axis=1)
+        )
+        rows = np.arange(len(trend_values))
+        aoi[f"{column}_{trend_func}_change"] = (
+            trend_values[rows, last_valid] - trend_values[rows, first_valid]
+        )
+
+    return aoi
+
+
+def generate_nightlights_multitype_feature(
+    aoi,
+    year,
+    viirs_data_types=None,
+    version=EOG_PRODUCT_VERSION.VER21,
+    product=EOG_PRODUCT.ANNUAL,
+    coverage=EOG_COVERAGE.GLOBAL,
+    cache_dir=NIGHTLIGHTS_CACHE_DIR,
+    process_suffix="c202205302300",
+    vcmcfg="vcmslcfg",
+    extra_args=None,
+    func=None,
+    columns=None,
+    lit_mask=False,
+    min_cf_cvg=None,
+    copy=False,
+    cluster_zoom=None,
+):
+    """Generate nightlights features `{column}_{func}` for several VIIRS data types in a single zonal pass.
+
+    Args:
+        columns: Feature column of each data type, defaults to `EOG_VIIRS_DATA_TYPE_COLUMN` or the data type name
+        lit_mask: If True, only use the pixels flagged as lit in the `lit_mask` data type
+        min_cf_cvg: If set, only use the pixels with at least that many cloud-free observations (`cf_cvg` data type)
+        cluster_zoom: See `generate_nightlights_feature`
+    """
+    if cluster_zoom is not None:
+        return apply_per_aoi_cluster(
+            aoi,
+            cluster_zoom,
+            lambda cluster_aoi: generate_nightlights_multitype_feature(
+                cluster_aoi,
+                year,
+                viirs_data_types=viirs_data_types,
+                version=version,
+                product=product,
+                coverage=coverage,
+                cache_dir=cache_dir,
+                process_suffix=process_suffix,
+                vcmcfg=vcmcfg,
+                extra_args=extra_args,
+                func=func,
+                columns=columns,
+                lit_mask=lit_mask,
+                min_cf_cvg=min_cf_cvg,
+            ),
+        )
+
+    if year >= 2022:
+        version = EOG_PRODUCT_VERSION.VER22
+
+    if viirs_data_types is None:
+        viirs_data_types = [EOG_VIIRS_DATA_TYPE.AVERAGE]
+    viirs_data_types = list(viirs_data_types)
+
+    if extra_args is None:
+        extra_args = dict(band_num=1, nodata=-999)
+
+    if func is None:
+        func = ["min", "max", "mean", "median", "std"]
+
+    if columns is None:
+        columns = {}
+    columns = {
+        data_type: columns.get(
+            data_type, EOG_VIIRS_DATA_TYPE_COLUMN.get(data_type, data_type)
+        )
+        for data_type in viirs_data_types
+    }
+
+    mask_data_types = []
+    if lit_mask:
+        mask_data_types.append(EOG_VIIRS_DATA_TYPE.LIT_MASK)
+    if min_cf_cvg is not None:
+        mask_data_types.append(EOG_VIIRS_DATA_TYPE.CF_CVG)
+    raster_data_types = viirs_data_types + [
+        data_type for data_type in mask_data_types if data_type not in viirs_data_types
+    ]
+
+    cache = get_nightlights_cache(cache_dir)
+    clipped_raster_files = []
+    with contextlib.ExitStack() as pins:
+        for data_type in raster_data_types:
+            clipped_raster_file = get_clipped_raster(
+                year,
+                aoi.total_bounds,
+                viirs_data_type=data_type,
+                version=version,
+                product=product,
+                coverage=coverage,
+                cache_dir=cache_dir,
+                process_suffix=process_suffix,
+                vcmcfg=vcmcfg,
+            )
+            pins.enter_context(cache.pin(clipped_raster_file))
+            clipped_raster_files.append(clipped_raster_file)
+
+        nodata = extra_args.get("nodata", -999)
+        stack, transform = read_aligned_rasters(
+            clipped_raster_files, band_num=extra_args.get("band_num", 1), nodata=nodata
+        )
+
+    valid_mask = np.ones(stack.shape[1:], dtype=bool)
+    if lit_mask:
+        lit_mask_layer = stack[raster_data_types.index(EOG_VIIRS_DATA_TYPE.LIT_MASK)]
+        valid_mask &= lit_mask_layer > 0
+    if min_cf_cvg is not None:
+        cf_cvg_layer = stack[raster_data_types.index(EOG_VIIRS_DATA_TYPE.CF_CVG)]
+        valid_mask &= cf_cvg_layer >= min_cf_cvg
+
+    logger.info(
+        f"Computing zonal stats for {len(aoi)} geometries over data types {viirs_data_types}"
+    )
+    results = compute_stacked_zonal_stats(
+        aoi.geometry.values,
+        stack[: len(viirs_data_types)],
+        transform,
+        func,
+        nodata=nodata,
+        all_touched=extra_args.get("all_touched", False),
+        valid_mask=valid_mask,
+    )
+
+    if copy:
+        aoi = aoi.copy()
+    for data_type_idx, data_type in enumerate(viirs_data_types):
+        for func_idx, func_name in enumerate(func):
+            aoi[f"{columns[data_type]}_{func_name}"] = results[
+                :, data_type_idx, func_idx
+            ]
+
+    return aoi
+
+
+def make_monthly_dir_url(
+    year,
+    month,
+    ntlights_base_url=EOG_MONTHLY_BASE_URL,
+    version=EOG_PRODUCT_VERSION.VER10,
+    vcmcfg="vcmslcfg",
+):
+    "Get the url of the EOG directory containing the monthly composites for a year and month"
+    return f"{ntlights_base_url}/{version}/{year}/{year}{month:02d}/{vcmcfg}/"
+
+
+# The (fetch time, listing) of the EOG directories, by url
+_eog_listings = {}
+
+
+def _list_eog_directory(dir_url):
+    "Get the listing of an EOG directory, cached for `EOG_LISTING_TTL` seconds"
+    cached = _eog_listings.get(dir_url)
+    if cached is not None and time.monotonic() - cached[0] < EOG_LISTING_TTL:
+        return cached[1]
+    response = requests.get(dir_url)
+    if response.status_code == 404:
+        raise ValueError(f"No EOG data found at {dir_url}")
+    response.raise_for_status()
+    _eog_listings[dir_url] = (time.monotonic(), response.text)
+    return response.text
+
+
+def make_monthly_url(
+    year,
+    month,
+    viirs_data_type=EOG_MONTHLY_DATA_TYPE.AVERAGE,
+    ntlights_base_url=EOG_MONTHLY_BASE_URL,
+    version=EOG_PRODUCT_VERSION.VER10,
+    coverage=EOG_COVERAGE.GLOBAL,
+    vcmcfg="vcmslcfg",
+):
+    "Get the url of the latest processed monthly VIIRS DNB composite from the directory listing of the month"
+    if month < 1 or month > 12:
+        raise ValueError(f"Invalid month {month}")
+    dir_url = make_monthly_dir_url(
+        year,
+        month,
+        ntlights_base_url=ntlights_base_url,
+        version=version,
+        vcmcfg=vcmcfg,
+    )
+    pattern = MONTHLY_FILE_PATTERN.format(
+        year=year,
+        month=month,
+        coverage=coverage,
+        vcmcfg=vcmcfg,
+        version=version,
+        viirs_data_type=re.escape(viirs_data_type),
+    )
+    filenames = sorted(set(re.findall(pattern, _list_eog_directory(dir_url))))
+    if len(filenames) == 0:
+        raise ValueError(
+            f"No monthly {viirs_data_type} EOG data for {year}-{month:02d} at {dir_url}"
+        )
+    return dir_url + filenames[-1]
+
+
+def get_clipped_monthly_raster_file(
+    year,
+    month,
+    bounds,
+    viirs_data_type=EOG_MONTHLY_DATA_TYPE.AVERAGE,
+    version=EOG_PRODUCT_VERSION.VER10,
+    coverage=EOG_COVERAGE.GLOBAL,
+    cache_dir=NIGHTLIGHTS_CACHE_DIR,
+    vcmcfg="vcmslcfg",
+):
+    "Get the path of the clipped raster of a monthly VIIRS DNB composite in the cache"
+    key = make_clip_hash(
+        f"{year}{month:02d}",
+        bounds,
+        viirs_data_type,
+        version,
+        EOG_PRODUCT.MONTHLY,
+        coverage,
+        "",
+        vcmcfg,
+    )
+    return Path(os.path.expanduser(cache_dir)) / "clip" / f"{key}.tif"
+
+
+def get_clipped_monthly_raster(
+    year,
+    month,
+    bounds,
+    viirs_data_type=EOG_MONTHLY_DATA_TYPE.AVERAGE,
+    version=EOG_PRODUCT_VERSION.VER10,
+    coverage=EOG_COVERAGE.GLOBAL,
+    cache_dir=NIGHTLIGHTS_CACHE_DIR,
+    vcmcfg="vcmslcfg",
+    keep_global=False,
+    show_progress=False,
+):
+    """Get the clipped raster of a monthly VIIRS DNB composite, generating it if it isn't cached yet.
+    The global raster is deleted once clipped unless `keep_global` is True.
+    """
+    month_id = f"{year}{month:02d}"
+    product = EOG_PRODUCT.MONTHLY
+    clipped_file = get_clipped_monthly_raster_file(
+        year, month, bounds, viirs_data_type, version, coverage, cache_dir, vcmcfg
+    )
+    clip_cache_dir = clipped_file.parent
+    clip_cache_dir.mkdir(parents=True, exist_ok=True)
+    cache = get_nightlights_cache(cache_dir)
+    if clipped_file.exists():
+        logger.info(f"Retrieving clipped monthly raster file {clipped_file}")
+        cache.touch(clipped_file)
+        return clipped_file
+
+    viirs_cache_dir = Path(os.path.expanduser(cache_dir)) / "global"
+    viirs_cache_dir.mkdir(parents=True, exist_ok=True)
+    viirs_url = make_monthly_url(
+        year,
+        month,
+        viirs_data_type=viirs_data_type,
+        version=version,
+        coverage=coverage,
+        vcmcfg=vcmcfg,
+    )
+    viirs_filename = Path(os.path.basename(urlparse(viirs_url).path)).name
+    viirs_file = viirs_cache_dir / viirs_filename.removesuffix(".gz")
+
+    with cache.pin(viirs_file, viirs_cache_dir / viirs_filename):
+        if not viirs_file.exists():
+            viirs_download = download_url(
+                viirs_url, dest=viirs_cache_dir, show_progress=show_progress
+            )
+            if viirs_download.suffix == ".gz":
+                viirs_file = unzip_eog_gzip(
+                    viirs_download, dest=viirs_cache_dir, delete_src=True
+                )
+        clip_raster(viirs_file.as_posix(), clipped_file.as_posix(), bounds, buffer=0.1)
+
+    if keep_global:
+        cache.touch(viirs_file)
+    else:
+        logger.info(f"Deleting global monthly raster {viirs_file}")
+        viirs_file.unlink(missing_ok=True)
+
+    generate_clipped_metadata(
+        month_id,
+        bounds,
+        viirs_data_type,
+        version,
+        product,
+        coverage,
+        clip_cache_dir,
+        "",
+        vcmcfg,
+    )
+    cache.touch(clipped_file)
+    with cache.pin(clipped_file):
+        cache.evict()
+    return clipped_file
+
+
+def generate_monthly_nightlights_feature(
+    aoi,
+    year,
+    months=None,
+    seasons=None,
+    version=EOG_PRODUCT_VERSION.VER10,
+    coverage=EOG_COVERAGE.GLOBAL,
+    cache_dir=NIGHTLIGHTS_CACHE_DIR,
+    vcmcfg="vcmslcfg",
+    extra_args=None,
+    column="avg_rad",
+    min_cf_cvg=1,
+    n_workers=4,
+    keep_global=False,
+    copy=False,
+):
+    """Generate annual and seasonal nightlights features from the monthly VIIRS DNB composites.
+
+    Features are `{column}_{year}_{period}_mean`, `_max` (of the monthly mean radiance) and `_cvg_weighted_mean`
+    (monthly mean radiance weighted by the cloud-free coverage), where period is a season name, or `annual`
+    for all of `months` if they are the 12 months of the year (`all_months` otherwise).
+
+    Args:
+        seasons: Dict of season name to list of months, e.g. `DEFAULT_SEASONS`
+        min_cf_cvg: Pixels with less cloud-free observations are ignored
+        n_workers: Number of months downloaded and clipped concurrently
+    """
+    if months is None:
+        months = list(range(1, 13))
+    if seasons is None:
+        seasons = {}
+
+    if extra_args is None:
+        extra_args = dict(band_num=1, nodata=-999)
+    nodata = extra_args.get("nodata", -999)
+
+    all_months_period = (
+        "annual" if sorted(months) == list(range(1, 13)) else "all_months"
+    )
+    periods = {all_months_period: list(months), **seasons}
+    n_geoms, n_periods = len(aoi), len(periods)
+    rad_sum = np.zeros((n_geoms, n_periods))
+    rad_count = np.zeros((n_geoms, n_periods))
+    rad_max = np.full((n_geoms, n_periods), -np.inf)
+    weighted_sum = np.zeros((n_geoms, n_periods))
+    weight_sum = np.zeros((n_geoms, n_periods))
+
+    data_types = [EOG_MONTHLY_DATA_TYPE.AVERAGE, EOG_MONTHLY_DATA_TYPE.CF_CVG]
+
+    def get_month_rasters(month):
+        return [
+            get_clipped_monthly_raster(
+                year,
+                month,
+                aoi.total_bounds,
+                viirs_data_type=data_type,
+                version=version,
+                coverage=coverage,
+                cache_dir=cache_dir,
+                vcmcfg=vcmcfg,
+                keep_global=keep_global,
+            )
+            for data_type in data_types
+        ]
+
+    cache = get_nightlights_cache(cache_dir)
+    geometries = aoi.geometry.values
+    with contextlib.ExitStack() as pins, ThreadPoolExecutor(
+        max_workers=n_workers
+    ) as executor:
+        # Keep the clips of every month from being evicted by the later months until reduced
+        for month in months:
+            for data_type in data_types:
+                clipped_file = get_clipped_monthly_raster_file(
+                    year,
+                    month,
+                    aoi.total_bounds,
+                    data_type,
+                    version,
+                    coverage,
+                    cache_dir,
+                    vcmcfg,
+                )
+                pins.enter_context(cache.pin(clipped_file))
+        futures = {executor.submit(get_month_rasters, month): month for month in months}
+        for future in as_completed(futures):
+            month = futures[future]
+            logger.info(f"Reducing monthly nightlights for {year}-{month:02d}")
+            stack, transform = read_aligned_rasters(
+                future.result(), band_num=extra_args.get("band_num", 1), nodata=nodata
+            )
+            valid_mask = stack[1] >= min_cf_cvg
+            month_stats = compute_stacked_zonal_stats(
+                geometries,
+                stack,
+                transform,
+                ["mean"],
+                nodata=nodata,
+                all_touched=extra_args.get("all_touched", False),
+                valid_mask=valid_mask,
+            )
+            del stack
+            month_rad, month_cvg = month_stats[:, 0, 0], month_stats[:, 1, 0]
+            has_rad = ~np.isnan(month_rad)
+            for period_idx, period_months in enumerate(periods.values()):
+                if month not in period_months:
+                    continue
+                rad_sum[has_rad, period_idx] += month_rad[has_rad]
+                rad_count[has_rad, period_idx] += 1
+                rad_max[has_rad, period_idx] = np.maximum(
+                    rad_max[has_rad, period_idx], month_rad[has_rad]
+                )
+                weighted_sum[has_rad, period_idx] += (
+                    month_rad[has_rad] * month_cvg[has_rad]
+                )
+                weight_sum[has_rad, period_idx] += month_cvg[has_rad]
+
+    if copy:
+        aoi = aoi.copy()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for period_idx, period in enumerate(periods):
+            prefix = f"{column}_{year}_{period}"
+            no_data = rad_count[:, period_idx] == 0
+            aoi[f"{prefix}_mean"] = rad_sum[:, period_idx] / rad_count[:, period_idx]
+            aoi[f"{prefix}_max"] = np.where(no_data, np.nan, rad_max[:, period_idx])
+            aoi[f"{prefix}_cvg_weighted_mean"] = (
+                weighted_sum[:, period_idx] / weight_sum[:, period_idx]
+            )
+
     return aoi
@@ -1,20 +1,88 @@
 import os
 import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import hashlib
+import json
+import re
+from urllib.error import HTTPError
 import numpy as np
 
 import pandas as pd
 import geopandas as gpd
-from geowrangler import grids
 import geowrangler.area_zonal_stats as azs
-from geowrangler.datasets.ookla import download_ookla_file, OoklaFile, list_ookla_files
+from geowrangler.datasets.ookla import OoklaFile, list_ookla_files
+from geowrangler.datasets.utils import make_report_hook
 
 from loguru import logger
 
 from povertymapping import settings
+from povertymapping.cache import MemoryCache
+from povertymapping.download import is_partial_download
+from povertymapping.nightlights import urlretrieve
+import functools
 import gc
+import itertools
+import operator
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
+import shapely
+
+
+# Zoom level of the Ookla tiles
+OOKLA_ZOOM_LEVEL = 16
+# Maximum number of quadkey ranges pushed down as parquet filters
+DEFAULT_MAX_QUADKEY_RANGES = 512
+
+# Quadkey zoom level of the blocks of the processed Ookla cache
+OOKLA_CACHE_BLOCK_ZOOM = 8
+
+# Quadkey zoom level of the partitions of the yearly index
+DEFAULT_INDEX_PARTITION_ZOOM = 2
+DEFAULT_INDEX_ROW_GROUP_SIZE = 50000
+# Number of quarterly Ookla files downloaded or read concurrently
+DEFAULT_N_QUARTER_WORKERS = 4
+# Hive partitioning of the repartitioned quarterly Ookla files (see `repartition_ookla_file`)
+OOKLA_STORE_PARTITION_COL = "quadkey_prefix"
+DEFAULT_STORE_PARTITION_ZOOM = 5
+DEFAULT_STORE_ROW_GROUP_SIZE = 50000
+
+# Aggregations of the quarterly Ookla data into yearly features per quadkey (see `aggregate_ookla_yearly`)
+DEFAULT_OOKLA_YEARLY_AGGREGATIONS = [
+    dict(column="avg_d_kbps", func="mean", output="mean_avg_d_kbps"),
+    dict(column="avg_u_kbps", func="mean", output="mean_avg_u_kbps"),
+    dict(column="avg_lat_ms", func="mean", output="mean_avg_lat_ms"),
+    dict(column="tests", func="mean", output="mean_num_tests"),
+    dict(column="devices", func="mean", output="mean_num_devices"),
+]
+# Functions supported by the yearly aggregations, besides percentiles such as "p90"
+OOKLA_YEARLY_FUNCS = [
+    "mean",
+    "sum",
+    "min",
+    "max",
+    "median",
+    "std",
+    "count",
+    "weighted_mean",
+]
+# Functions supported by the aggregations of the yearly features to the AOI,
+# besides percentiles for quadkey AOIs aggregated by quadkey prefix
+OOKLA_AOI_FUNCS = ["mean", "sum", "min", "max", "count", "weighted_mean"]
+
+# Columns of the Ookla data used by add_ookla_features
+OOKLA_FEATURE_COLUMNS = [
+    "quadkey",
+    "tile",
+    "avg_d_kbps",
+    "avg_u_kbps",
+    "avg_lat_ms",
+    "tests",
+    "devices",
+]
 
 
 def get_OoklaFile(filename):
@@ -33,8 +101,20 @@ class OoklaDataManager:
 
     DEFAULT_CACHE_DIR = "~/.geowrangler"
 
-    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
-        self.data_cache = {}
+    def __init__(
+        self,
+        cache_dir=DEFAULT_CACHE_DIR,
+        repartition_store=False,
+        memory_cache_max_size=None,
+    ):
+        """Create a manager caching the Ookla data in `cache_dir` and in RAM.
+
+        Args:
+            repartition_store: If True, repartition the downloaded quarterly files by quadkey prefix (see `repartition_ookla_file`)
+            memory_cache_max_size: Size budget of the data kept in RAM (see `MemoryCache`)
+        """
+        self.data_cache = MemoryCache(memory_cache_max_size)
+        self.repartition_store = repartition_store
         self.cache_dir = os.path.expanduser(cache_dir)
         self.processed_cache_dir = os.path.join(self.cache_dir, "ookla", "processed")
         Path(self.processed_cache_dir).mkdir(parents=True, exist_ok=True)
@@ -57,155 +137,331 @@ class OoklaDataManager:
         return_geometry=False,
         use_aoi_quadkey=False,
         aoi_quadkey_col="quadkey",
+        columns=None,
+        aoi_quadkeys=None,
     ):
-        "Load Ookla data across all quarters for a specified aoi, type (fixed, mobile) and year"
-
-        # Generate hash from aoi, type_, and year, which will act as a hash key for the cache
-        aoi_bounds = aoi.total_bounds
-        data_tuple = (
-            np.array2string(aoi_bounds, precision=6),
-            str(type_),
-            str(year),
-            str(return_geometry),
-            str(use_aoi_quadkey),
-            str(aoi_quadkey_col),
-        )
-        m = hashlib.md5()
-        for item in data_tuple:
-            m.update(item.encode())
-        data_key = m.hexdigest()
+        """Load Ookla data across all quarters for a specified aoi, type (fixed, mobile) and year.
+        Processed data is cached in zoom `OOKLA_CACHE_BLOCK_ZOOM` quadkey blocks (plus GeoParquet copies
+        for `return_geometry`), and only the missing blocks are read from the global files.
+        """
+        if aoi_quadkeys is None:
+            aoi_quadkeys = get_aoi_filter_quadkeys(
+                aoi, use_aoi_quadkey, aoi_quadkey_col
+            )
+        blocks = quadkey_blocks(aoi_quadkeys, OOKLA_CACHE_BLOCK_ZOOM)
+        block_dir = os.path.join(self.processed_cache_dir, str(type_), str(year))
+        if return_geometry and columns is not None and "tile" not in columns:
+            columns = [*columns, "tile"]
 
-        # Get from RAM cache if already available
-        logger.debug(f"Contents of data cache: {list(self.data_cache.keys())}")
-        if data_key in self.data_cache:
-            logger.debug(
-                f"Ookla data for aoi, {type_} {year} (key: {data_key}) found in cache."
+        def ram_cache_key(block):
+            return (
+                str(type_),
+                str(year),
+                block,
+                None if columns is None else tuple(columns),
+                return_geometry,
             )
-            return self.data_cache[data_key]
 
-        ## Get cached data from filesystem if saved
-        cached_file_path = (
-            os.path.join(self.processed_cache_dir, f"{data_key}.geojson")
-            if return_geometry
-            else os.path.join(self.processed_cache_dir, f"{data_key}.csv")
-        )
+        def block_path(block):
+            return os.path.join(block_dir, f"{block}.parquet")
 
-        cached_data_available = os.path.exists(cached_file_path)
+        if use_cache:
+            missing_blocks = [
+                block
+                for block in blocks
+                if ram_cache_key(block) not in self.data_cache
+                and not os.path.exists(block_path(block))
+            ]
+        else:
+            missing_blocks = blocks
         logger.info(
-            f"Cached data available at {cached_file_path}? {cached_data_available}"
+            f"Ookla Data: {len(blocks) - len(missing_blocks)}/{len(blocks)} quadkey blocks for aoi, {type_} {year} found in cache at {block_dir}"
         )
 
-        if cached_data_available:
-            logger.debug(
-                f"Processed Ookla data for aoi, {type_} {year} (key: {data_key}) found in filesystem. Loading in cache."
-            )
-            if not return_geometry:
-                df = pd.read_csv(cached_file_path)
-                self.data_cache[data_key] = df
-                return df
-            else:
-                gdf = gpd.read_file(cached_file_path, driver="GeoJSON")
-                self.data_cache[data_key] = gdf
-                return gdf
+        if len(missing_blocks) > 0:
+            self._process_blocks(type_, year, missing_blocks, block_dir, use_cache)
 
-        logger.debug("No cached data found. Processing Ookla data from scratch.")
+        # NOTE: Since there will be groupby operations in processing, we don't return
+        #       a geodataframe by default since it does not work well with aggregations
+        #       by quadkey.
+        block_df_list = []
+        for block in blocks:
+            key = ram_cache_key(block)
+            block_df = self.data_cache.get(key)
+            if block_df is None:
+                if return_geometry:
+                    block_df = _read_geo_block(block_path(block), columns)
+                else:
+                    block_df = pd.read_parquet(block_path(block), columns=columns)
+                self.data_cache[key] = block_df
+            block_df_list.append(block_df)
+
+        df = pd.concat(block_df_list, ignore_index=True)
+        df = _filter_quadkey_df(df, aoi_quadkeys, "quadkey")
+        if return_geometry:
+            df = gpd.GeoDataFrame(df, geometry="geometry", crs="epsg:4326")
+        return df
 
-        # Otherwise, load from raw file and add to RAM cache
+    def _process_blocks(self, type_, year, blocks, block_dir, use_cache=True):
+        "Read the Ookla data of the quadkey `blocks` across all quarters from the global files and cache them"
+        logger.debug(
+            f"Processing {len(blocks)} quadkey blocks for {type_} {year} from the global Ookla data."
+        )
         type_year_cache_dir = download_ookla_year_data(
             type_,
             year,
             cache_dir=self.cache_dir,
             use_cache=use_cache,
+            repartition=self.repartition_store,
         )
 
-        # If use_quadkey. we'll get quadkeys from the input to determine what Ookla data to save
-        if use_aoi_quadkey:
+        # Combine quarterly data for the specified year, filtered to the blocks using quadkey
+        ## Only read the parts of the global Ookla parquet files that
+        ## fall within the blocks to circumvent memory issues
+        quarter_df_list = read_ookla_quarters(type_year_cache_dir, blocks)
+
+        logger.debug(
+            f"Concatenating quarterly Ookla data for {type_} and {year} into one dataframe"
+        )
+        df = pd.concat(quarter_df_list, ignore_index=True)
+        del quarter_df_list
+        gc.collect()
+
+        # Write every block, including empty ones, so they are known to be processed
+        Path(block_dir).mkdir(parents=True, exist_ok=True)
+        block_groups = df.groupby(df["quadkey"].str[:OOKLA_CACHE_BLOCK_ZOOM]).indices
+        for block in blocks:
+            block_df = df.iloc[block_groups.get(block, [])]
+            block_path = os.path.join(block_dir, f"{block}.parquet")
+            _write_processed_ookla_cache(block_df, block_path)
+            # The GeoParquet copy is regenerated from the new block when needed
+            Path(_geo_block_path(block_path)).unlink(missing_ok=True)
+            for key in self.data_cache:
+                if key[:3] == (str(type_), str(year), block):
+                    self.data_cache.pop(key, None)
+
+    def load_type_year_index(
+        self,
+        aoi,
+        type_,
+        year,
+        use_cache=True,
+        use_aoi_quadkey=False,
+        aoi_quadkey_col="quadkey",
+        aoi_quadkeys=None,
+        aggregations=None,
+    ):
+        """Load the yearly aggregated Ookla data of an aoi, type (fixed, mobile) and year from the global yearly index,
+        building the index first if needed
+        """
+        if aoi_quadkeys is None:
+            aoi_quadkeys = get_aoi_filter_quadkeys(
+                aoi, use_aoi_quadkey, aoi_quadkey_col
+            )
+        m = hashlib.md5()
+        for quadkey in sorted(aoi_quadkeys):
+            m.update(quadkey.encode())
+        m.update(json.dumps(aggregations).encode())
+        data_key = ("index", str(type_), str(year), m.hexdigest())
+        if data_key in self.data_cache:
             logger.debug(
-                f"use_quadkey = True. Using columns in {aoi_quadkey_col} to pull intersecting Ookla data."
+                f"Ookla yearly index data for aoi, {type_} {year} found in cache."
             )
-            input_aoi_quadkeys = aoi[aoi_quadkey_col].to_list()
-            input_aoi_quadkeys = [str(x) for x in input_aoi_quadkeys]
-
-            # Check if zoom level is the same across all items in list
-            input_aoi_quadkeys_iter = iter(input_aoi_quadkeys)
-            first_key_zoom_lvl = len(next(input_aoi_quadkeys_iter))
-            if not all(
-                len(key) == first_key_zoom_lvl for key in input_aoi_quadkeys_iter
-            ):
-                raise ValueError(
-                    f"Not all items in aoi_quadkey_col = {aoi_quadkey_col} are of the same zoom level."
-                )
+            return self.data_cache[data_key]
 
-            input_aoi_quadkey_zoom_lvl = first_key_zoom_lvl
-            logger.debug(
-                f"Quadkeys in {aoi_quadkey_col} are at zoom level {input_aoi_quadkey_zoom_lvl}."
+        index_dir = build_ookla_yearly_index(
+            type_,
+            year,
+            cache_dir=self.cache_dir,
+            use_cache=use_cache,
+            aggregations=aggregations,
+            repartition=self.repartition_store,
+        )
+        df = _read_and_filter_quadkey_parquet_file(index_dir, aoi_quadkeys, "quadkey")
+        self.data_cache[data_key] = df
+        return df
+
+
+def get_aoi_filter_quadkeys(aoi, use_aoi_quadkey, aoi_quadkey_col):
+    "Get the quadkeys used to pull the Ookla data intersecting the aoi"
+    # If use_quadkey. we'll get quadkeys from the input to determine what Ookla data to save
+    if use_aoi_quadkey:
+        logger.debug(
+            f"use_quadkey = True. Using columns in {aoi_quadkey_col} to pull intersecting Ookla data."
+        )
+        aoi_quadkeys = aoi[aoi_quadkey_col].to_list()
+        aoi_quadkeys = [str(x) for x in aoi_quadkeys]
+
+        # Check if zoom level is the same across all items in list
+        aoi_quadkeys_iter = iter(aoi_quadkeys)
+        first_key_zoom_lvl = len(next(aoi_quadkeys_iter))
+        if not all(len(key) == first_key_zoom_lvl for key in aoi_quadkeys_iter):
+            raise ValueError(
+                f"Not all items in aoi_quadkey_col = {aoi_quadkey_col} are of the same zoom level."
             )
 
-        # Else, generate the bing tile quadkeys that intersect with the input aoi
+        input_aoi_quadkey_zoom_lvl = first_key_zoom_lvl
+        logger.debug(
+            f"Quadkeys in {aoi_quadkey_col} are at zoom level {input_aoi_quadkey_zoom_lvl}."
+        )
+
+    # Else, generate the bing tile quadkeys that cover the input aoi, coarser where the aoi contains whole tiles
+    else:
+        logger.debug(
+            f"Generating quadkeys based on input aoi geometry to pull intersecting Ookla data."
+        )
+        aoi_quadkeys = quadkey_covering(
+            aoi.to_crs("epsg:4326").unary_union, OOKLA_ZOOM_LEVEL
+        )
+        logger.debug(f"Covered the aoi with {len(aoi_quadkeys)} quadkeys.")
+
+    return aoi_quadkeys
+
+
+def quadkey_covering(geometry, zoom=OOKLA_ZOOM_LEVEL):
+    """Get the sorted quadkeys covering a geometry (in EPSG:4326), with the same zoom `zoom` tiles as
+    `grids.BingTileGridGenerator(zoom)` but the tiles fully within the geometry kept at the coarsest zoom level possible
+    """
+    shapely.prepare(geometry)
+    covering = []
+    candidates = np.array(list("0123"))
+    for level in range(1, zoom + 1):
+        if len(candidates) == 0:
+            break
+        tiles = _quadkey_boxes(candidates)
+        intersects = shapely.intersects(geometry, tiles)
+        contained = intersects & shapely.contains(geometry, tiles)
+        covering.append(candidates[contained])
+        partial = candidates[intersects & ~contained]
+        if level == zoom:
+            covering.append(partial)
         else:
-            logger.debug(
-                f"Generating quadkeys based on input aoi geometry to pull intersecting Ookla data."
-            )
-            bing_tile_grid_generator_no_geom = grids.BingTileGridGenerator(
-                16, return_geometry=False
+            candidates = np.char.add(
+                np.repeat(partial, 4), np.tile(np.array(list("0123")), len(partial))
             )
-            aoi_quadkeys = bing_tile_grid_generator_no_geom.generate_grid(aoi)[
-                "quadkey"
-            ].tolist()
+    return compact_quadkeys(np.concatenate(covering))
 
-        # Combine quarterly data for the specified year, filtered to the aoi using quadkey
-        # Quarter is inferred from the Ookla filename
-        quarter_df_list = []
 
-        for ookla_filename in sorted(os.listdir(type_year_cache_dir)):
-            quarter = int(getattr(get_OoklaFile(ookla_filename), "quarter"))
-            ookla_quarter_filepath = os.path.join(type_year_cache_dir, ookla_filename)
-            logger.debug(
-                f"Ookla data for aoi, {type_} {year} {quarter} being loaded from {ookla_quarter_filepath}"
+def _quadkey_boxes(quadkeys):
+    "Get the EPSG:4326 polygons of quadkeys at the same zoom level"
+    x, y = quadkey_to_tile_xy(quadkeys)
+    n = 2.0 ** len(quadkeys[0])
+
+    def tile_lat(tile_y):
+        return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * tile_y / n))))
+
+    return shapely.box(
+        x / n * 360 - 180, tile_lat(y + 1), (x + 1) / n * 360 - 180, tile_lat(y)
+    )
+
+
+def compact_quadkeys(quadkeys):
+    "Replace every complete set of 4 sibling quadkeys by their parent, recursively. Returns a sorted list of quadkeys."
+    quadkeys = pd.Series(pd.unique(pd.Series(quadkeys, dtype=str)), dtype=str)
+    if len(quadkeys) == 0:
+        return []
+    for level in range(quadkeys.str.len().max(), 0, -1):
+        parents = quadkeys.str[:-1].where(quadkeys.str.len() == level)
+        counts = parents.value_counts()
+        complete = counts.index[counts == 4]
+        if len(complete) > 0:
+            quadkeys = pd.concat(
+                [quadkeys[~parents.isin(complete)], pd.Series(complete, dtype=str)],
+                ignore_index=True,
             )
+    return sorted(quadkeys)
+
 
-            ## When using quadkey optimizations read and filter Ookla parquet
-            ## in batches to circumvent memory issues
-            ## Read: https://stackoverflow.com/questions/59098785/is-it-possible-to-read-parquet-files-in-chunks
-            if use_aoi_quadkey:
-                quarter_df = _read_and_filter_quadkey_parquet_file(
-                    ookla_quarter_filepath, input_aoi_quadkeys, "quadkey"
+def quadkey_blocks(quadkeys, block_zoom=OOKLA_CACHE_BLOCK_ZOOM):
+    "Get the sorted quadkeys at zoom level `block_zoom` of the blocks that contain or are contained in `quadkeys`"
+    blocks = set()
+    for quadkey in set(map(str, quadkeys)):
+        if len(quadkey) >= block_zoom:
+            blocks.add(quadkey[:block_zoom])
+        else:
+            blocks.update(
+                quadkey + "".join(suffix)
+                for suffix in itertools.product(
+                    "0123", repeat=block_zoom - len(quadkey)
                 )
-            else:
-                quarter_df = pd.read_parquet(ookla_quarter_filepath)
-                quarter_df = quarter_df[quarter_df["quadkey"].isin(aoi_quadkeys)]
+            )
+    return sorted(blocks)
 
-            quarter_df["quarter"] = quarter
-            quarter_df_list.append(quarter_df)
 
-            # Free memory after processing
-            del quarter_df
+def _write_processed_ookla_cache(df, cached_file_path):
+    # Write to a temp file first so readers never see a partially written block
+    tmp_file_path = f"{cached_file_path}.{os.getpid()}.tmp"
+    df.to_parquet(tmp_file_path, index=False, compression="zstd")
+    os.replace(tmp_file_path, cached_file_path)
 
-        logger.debug(
-            f"Concatenating quarterly Ookla data for {type_} and {year} into one dataframe"
+
+def _geo_block_path(block_path):
+    return block_path.replace(".parquet", ".geo.parquet")
+
+
+def _read_geo_block(block_path, columns=None):
+    "Read a processed block with the tiles as geometries, from its GeoParquet copy (created on first use)"
+    geo_block_path = _geo_block_path(block_path)
+    if not os.path.exists(geo_block_path):
+        df = pd.read_parquet(block_path)
+        gdf = gpd.GeoDataFrame(
+            df, geometry=gpd.GeoSeries.from_wkt(df["tile"], crs="epsg:4326")
         )
-        df = pd.concat(quarter_df_list, ignore_index=True)
-        del quarter_df_list
-        gc.collect()
+        _write_processed_ookla_cache(gdf, geo_block_path)
+    if columns is not None and "geometry" not in columns:
+        columns = [*columns, "geometry"]
+    return gpd.read_parquet(geo_block_path, columns=columns)
 
-        # NOTE: Since there will be groupby operations in processing, we don't return
-        #       a geodataframe by default since it does not work well with aggregations
-        #       by quadkey.
-        if not return_geometry:
-            self.data_cache[data_key] = df
-            df.to_csv(cached_file_path, index=False)
-            return df
-        else:
-            logger.debug(f"Converting Ookla data into geodataframe")
-            gdf = gpd.GeoDataFrame(df, geometry=gpd.GeoSeries.from_wkt(df["tile"]))
-            self.data_cache[data_key] = gdf
-            gdf.to_file(cached_file_path, driver="GeoJSON")
-            return gdf
 
+def _download_ookla_file(
+    type_, year, quarter, directory="data/", overwrite=False, show_progress=True
+):
+    """Download ookla file to path.
+    Modified from geowrangler.datasets.ookla.download_ookla_file() to use resumable ranged downloads.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    ookla_info = list_ookla_files()
+    key = OoklaFile(type_, str(year), str(quarter))
+    if key not in ookla_info:
+        raise ValueError(
+            f"{key} not found in ookla. Run list_ookla_data() to learn more about available files"
+        )
+    fname = ookla_info[key]
+    url = f"https://ookla-open-data.s3.us-west-2.amazonaws.com/parquet/performance/type={type_}/year={year}/quarter={quarter}/{fname}"
+    filepath = Path(directory) / fname
+    if not filepath.exists() or overwrite:
+        try:
+            filepath, _, _ = urlretrieve(
+                url,
+                filepath,
+                reporthook=make_report_hook(show_progress),
+                chunksize=1024 * 1024,
+            )
+        except HTTPError as err:
+            if err.code == 404:
+                logger.warning(
+                    f"No url found for type {type_} year {year} and {quarter} : {url} "
+                )
+                return None
+            else:
+                raise err
+
+    return filepath
 
-def download_ookla_year_data(type_, year, cache_dir, use_cache=True):
 
-    "Download ookla data for a specifed type (fixed or mobile) and year. Data for all 4 quarters will be downloaded."
+def download_ookla_year_data(
+    type_,
+    year,
+    cache_dir,
+    use_cache=True,
+    n_workers=DEFAULT_N_QUARTER_WORKERS,
+    repartition=False,
+):
+    """Download ookla data for a specifed type (fixed or mobile) and year. Data for all 4 quarters will be downloaded,
+    with up to `n_workers` quarters downloaded concurrently.
+    If `repartition`, each quarterly file is repartitioned by quadkey prefix (see `repartition_ookla_file`).
+    """
 
     # Determine number of expected data for type_ and year, specified by OoklaFile(type, year, quarter)
     available_ookla_files = list_ookla_files()
@@ -229,10 +485,15 @@ def download_ookla_year_data(type_, year, cache_dir, use_cache=True):
 
     # Check if the cached data is valid. Otherwise, we have to re-download.
     # For Ookla, we need to check if we've downloaded all expected files for that year.
-    cached_data_available = (
-        os.path.exists(type_year_cache_dir)
-        and len(os.listdir(type_year_cache_dir)) == num_expected_ookla_files
-    )
+    # Unfinished downloads don't count, they are resumed below.
+    cached_filenames, partial_filenames = [], []
+    if os.path.exists(type_year_cache_dir):
+        for filename in os.listdir(type_year_cache_dir):
+            if is_partial_download(filename):
+                partial_filenames.append(filename)
+            else:
+                cached_filenames.append(filename)
+    cached_data_available = len(cached_filenames) == num_expected_ookla_files
 
     logger.info(
         f"Ookla Data: Cached data available for {type_} and {year} at {type_year_cache_dir}? {cached_data_available}"
@@ -243,29 +504,161 @@ def download_ookla_year_data(type_, year, cache_dir, use_cache=True):
         logger.info(
             f"Ookla Data: Re-initializing Ookla type/year cache dir at {type_year_cache_dir}..."
         )
-        # Re-create the country cache dir and start over to fix any corrupted states
-        shutil.rmtree(type_year_cache_dir, ignore_errors=True)
+        # Re-create the type/year cache dir and start over to fix any corrupted states,
+        # unless there are interrupted downloads to resume
+        if not use_cache or len(partial_filenames) == 0:
+            shutil.rmtree(type_year_cache_dir, ignore_errors=True)
         Path(type_year_cache_dir).mkdir(parents=True, exist_ok=True)
 
         # This downloads a parquet file to the type_year_dir for each quarter
-        for quarter in range(1, num_expected_ookla_files + 1, 1):
+        def download_quarter(quarter):
             logger.info(
                 f"Ookla Data: Downloading Ookla parquet file for quarter {quarter}..."
             )
-            download_path = download_ookla_file(
+            return _download_ookla_file(
                 type_=type_,
                 year=year,
-                quarter=str(quarter),
+                quarter=quarter,
                 directory=type_year_cache_dir,
             )
 
+        quarters = [ookla_file.quarter for ookla_file in expected_ookla_files]
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # list() re-raises the first failed download
+            list(executor.map(download_quarter, quarters))
+
         logger.info(
             f"Ookla Data: Successfully downloaded and cached Ookla data for {type_} and {year} at {type_year_cache_dir}!"
         )
 
+    if repartition:
+        # Files already repartitioned are directories
+        ookla_filepaths = [
+            os.path.join(type_year_cache_dir, ookla_filename)
+            for ookla_filename in sorted(os.listdir(type_year_cache_dir))
+            if os.path.isfile(os.path.join(type_year_cache_dir, ookla_filename))
+            and not is_partial_download(ookla_filename)
+        ]
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(repartition_ookla_file, ookla_filepaths))
+
     return type_year_cache_dir
 
 
+def repartition_ookla_file(
+    filepath,
+    partition_zoom=DEFAULT_STORE_PARTITION_ZOOM,
+    row_group_size=DEFAULT_STORE_ROW_GROUP_SIZE,
+):
+    """Rewrite a global Ookla parquet file in place as a Hive partitioned dataset directory keyed by the
+    zoom `partition_zoom` quadkey prefix (`quadkey_prefix=0123.../part-0.parquet`), each partition sorted by quadkey
+    """
+    logger.info(
+        f"Ookla Data: Repartitioning {filepath} by zoom {partition_zoom} quadkey prefix..."
+    )
+    # Write to a temp dir first so an interrupted run keeps the original file, and
+    # the temp dir is removed. It is created next to the type/year dir, whose listing
+    # only holds the quarterly files.
+    type_year_dir, filename = os.path.split(os.path.abspath(filepath))
+    parquet_file = pq.ParquetFile(filepath)
+    schema = parquet_file.schema_arrow.append(
+        pa.field(OOKLA_STORE_PARTITION_COL, pa.string())
+    )
+
+    def batches_with_prefix():
+        for batch in parquet_file.iter_batches(batch_size=row_group_size):
+            prefix = pc.utf8_slice_codeunits(batch.column("quadkey"), 0, partition_zoom)
+            yield pa.RecordBatch.from_arrays([*batch.columns, prefix], schema=schema)
+
+    with tempfile.TemporaryDirectory(
+        prefix=f".{os.path.basename(type_year_dir)}_{filename}.",
+        dir=os.path.dirname(type_year_dir),
+    ) as tmp_root:
+        tmp_dir = os.path.join(tmp_root, filename)
+        ds.write_dataset(
+            batches_with_prefix(),
+            tmp_dir,
+            schema=schema,
+            format="parquet",
+            partitioning=_ookla_store_partitioning(),
+            max_partitions=4**partition_zoom,
+        )
+        for partition_name in os.listdir(tmp_dir):
+            partition_dir = os.path.join(tmp_dir, partition_name)
+            table = pq.read_table(partition_dir).sort_by("quadkey")
+            for part_filename in os.listdir(partition_dir):
+                os.remove(os.path.join(partition_dir, part_filename))
+            pq.write_table(
+                table,
+                os.path.join(partition_dir, "part-0.parquet"),
+                row_group_size=row_group_size,
+                compression="zstd",
+            )
+            del table
+
+        os.remove(filepath)
+        os.replace(tmp_dir, filepath)
+    logger.info(f"Ookla Data: Successfully repartitioned {filepath}!")
+    return filepath
+
+
+def _ookla_store_partitioning():
+    return ds.partitioning(
+        pa.schema([(OOKLA_STORE_PARTITION_COL, pa.string())]), flavor="hive"
+    )
+
+
+def _ookla_store_partition_zoom(parquet_file):
+    "Get the partition zoom level of a repartitioned Ookla file, or None for other parquet files"
+    if not os.path.isdir(parquet_file):
+        return None
+    for name in os.listdir(parquet_file):
+        if name.startswith(f"{OOKLA_STORE_PARTITION_COL}="):
+            return len(name.split("=", 1)[1])
+    return None
+
+
+def list_ookla_quarter_files(type_year_cache_dir):
+    "Get the `(quarter, filepath)` of each quarterly Ookla file in `type_year_cache_dir`, in filename order"
+    quarter_filepaths = []
+    for ookla_filename in sorted(os.listdir(type_year_cache_dir)):
+        ookla_file = get_OoklaFile(ookla_filename)
+        if ookla_file is None or is_partial_download(ookla_filename):
+            logger.debug(f"Ookla Data: Skipping {ookla_filename}, not an Ookla file")
+            continue
+        quarter_filepaths.append(
+            (
+                int(ookla_file.quarter),
+                os.path.join(type_year_cache_dir, ookla_filename),
+            )
+        )
+    return quarter_filepaths
+
+
+def read_ookla_quarters(
+    type_year_cache_dir,
+    quadkeys,
+    columns=None,
+    n_workers=DEFAULT_N_QUARTER_WORKERS,
+):
+    """Read the Ookla data within `quadkeys` from each quarterly file in `type_year_cache_dir`, `n_workers` files at a time.
+    Returns one dataframe per quarter in filename order, with the quarter in an int8 `quarter` column.
+    """
+    quarter_filepaths = list_ookla_quarter_files(type_year_cache_dir)
+
+    def read_quarter(quarter_filepath):
+        quarter, filepath = quarter_filepath
+        logger.debug(f"Ookla data for quarter {quarter} being loaded from {filepath}")
+        quarter_df = _read_and_filter_quadkey_parquet_file(
+            filepath, quadkeys, "quadkey", columns=columns
+        )
+        quarter_df["quarter"] = np.int8(quarter)
+        return quarter_df
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(read_quarter, quarter_filepaths))
+
+
 def add_ookla_features(
     aoi,
     type_,
@@ -276,62 +669,192 @@ def add_ookla_features(
     aoi_quadkey_col="quadkey",
     metric_crs="epsg:3123",
     inplace=False,
+    use_yearly_index=False,
+    use_quadkey_aggregation=False,
+    yearly_aggregations=None,
+    aoi_aggregations=None,
 ):
-    """Generates yearly aggregate features for the AOI based on Ookla data for a given type (fixed, mobile) and year."""
-
-    ookla = ookla_data_manager.load_type_year_data(
+    """Generates yearly aggregate features for the AOI based on Ookla data for a given type (fixed, mobile) and year.
+    If `use_yearly_index` is True, the features are sliced from a global yearly index
+    built once per type and year (see `build_ookla_yearly_index`), which is faster when
+    processing several AOIs or countries.
+    If `use_quadkey_aggregation` is True and the AOI is a grid of tiles with quadkeys in `aoi_quadkey_col`
+    (at zoom level 16 or coarser), the features are aggregated by quadkey prefix instead of an area overlay.
+    This is faster, but the overlay also counts the slivers of the neighbouring Ookla tiles along the edges
+    of each AOI tile, so only the `sum` and `weighted_mean` features are the same on both paths.
+    See `add_ookla_multi_features` to generate the features of several types and years at once.
+    """
+    return add_ookla_multi_features(
         aoi,
-        type_,
-        year,
+        [type_],
+        [year],
+        ookla_data_manager,
         use_cache=use_cache,
         use_aoi_quadkey=use_aoi_quadkey,
         aoi_quadkey_col=aoi_quadkey_col,
+        metric_crs=metric_crs,
+        inplace=inplace,
+        use_yearly_index=use_yearly_index,
+        use_quadkey_aggregation=use_quadkey_aggregation,
+        yearly_aggregations=yearly_aggregations,
+        aoi_aggregations=aoi_aggregations,
+    )
+
+
+def add_ookla_multi_features(
+    aoi,
+    types,
+    years,
+    ookla_data_manager,
+    use_cache=True,
+    use_aoi_quadkey=False,
+    aoi_quadkey_col="quadkey",
+    metric_crs="epsg:3123",
+    inplace=False,
+    use_yearly_index=False,
+    use_quadkey_aggregation=False,
+    yearly_aggregations=None,
+    aoi_aggregations=None,
+    n_workers=4,
+):
+    """Generates the yearly aggregate features of `add_ookla_features` for several types (fixed, mobile) and years at once,
+    as `{type}_{year}_*` columns.
+
+    Args:
+        yearly_aggregations: Agg specs combining the quarterly data into yearly features per Ookla tile
+            (see `aggregate_ookla_yearly`). Defaults to `DEFAULT_OOKLA_YEARLY_AGGREGATIONS`
+        aoi_aggregations: Agg specs combining the yearly features into AOI features, with funcs among `OOKLA_AOI_FUNCS`
+            (and percentiles for quadkey AOIs). Defaults to the area weighted `mean` of every yearly feature
+        n_workers: Number of type and year datasets loaded concurrently
+    """
+    yearly_aggregations = _fix_ookla_aggs(
+        yearly_aggregations or DEFAULT_OOKLA_YEARLY_AGGREGATIONS, OOKLA_YEARLY_FUNCS
+    )
+    yearly_outputs = [agg["output"] for agg in yearly_aggregations]
+    if aoi_aggregations is None:
+        aoi_aggregations = [dict(column=col, func="mean") for col in yearly_outputs]
+    aoi_aggregations = _fix_ookla_aggs(aoi_aggregations, OOKLA_AOI_FUNCS)
+    for agg in aoi_aggregations:
+        for col in [agg["column"], agg.get("weights")]:
+            if col is not None and col not in yearly_outputs:
+                raise ValueError(
+                    f"{col} in aoi_aggregations is not an output of the yearly aggregations {yearly_outputs}"
+                )
+    use_quadkey_aggregation = use_quadkey_aggregation and _is_quadkey_aoi(
+        aoi, aoi_quadkey_col
+    )
+    if not use_quadkey_aggregation:
+        for agg in aoi_aggregations:
+            if _parse_percentile(agg["func"]) is not None:
+                raise ValueError(
+                    f"Percentile func {agg['func']} in aoi_aggregations is only supported for quadkey AOIs aggregated by quadkey prefix, not with an area overlay"
+                )
+
+    aoi_quadkeys = get_aoi_filter_quadkeys(aoi, use_aoi_quadkey, aoi_quadkey_col)
+
+    def load_ookla_yearly(type_, year):
+        # Combine quarterly data from Ookla into yearly aggregate data
+        if use_yearly_index:
+            ookla_yearly = ookla_data_manager.load_type_year_index(
+                aoi,
+                type_,
+                year,
+                use_cache=use_cache,
+                aoi_quadkeys=aoi_quadkeys,
+                aggregations=yearly_aggregations,
+            )
+        else:
+            ookla = ookla_data_manager.load_type_year_data(
+                aoi,
+                type_,
+                year,
+                use_cache=use_cache,
+                columns=_ookla_agg_input_columns(yearly_aggregations),
+                aoi_quadkeys=aoi_quadkeys,
+            )
+            ookla_yearly = aggregate_ookla_yearly(ookla, yearly_aggregations)
+        return ookla_yearly
+
+    type_years = [(type_, year) for type_ in types for year in years]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        yearly_dfs = list(
+            executor.map(lambda args: load_ookla_yearly(*args), type_years)
+        )
+
+    # Combine the features of all types and years into one table of Ookla tiles,
+    # adding the type_year prefix to feature names
+    ookla_yearly = functools.reduce(
+        lambda left, right: left.merge(right, on="quadkey", how="outer"),
+        [
+            yearly_df[["quadkey", *yearly_outputs]].rename(
+                columns={col: f"{type_}_{year}_{col}" for col in yearly_outputs}
+            )
+            for (type_, year), yearly_df in zip(type_years, yearly_dfs)
+        ],
+    )
+    tiles = pd.concat([yearly_df[["quadkey", "tile"]] for yearly_df in yearly_dfs])
+    ookla_yearly = ookla_yearly.merge(
+        tiles.drop_duplicates("quadkey"), on="quadkey", how="left"
     )
+    aoi_aggregations = [
+        dict(
+            agg,
+            column=f"{type_}_{year}_{agg['column']}",
+            output=f"{type_}_{year}_{agg['output']}",
+            weights=agg.get("weights") and f"{type_}_{year}_{agg['weights']}",
+        )
+        for type_, year in type_years
+        for agg in aoi_aggregations
+    ]
 
     # Create a copy of the AOI gdf if not inplace to avoid modifying the original gdf
     if not inplace:
         aoi = aoi.copy()
 
-    # Combine quarterly data from Ookla into yearly aggregate data
-    # Geometries are stored separately and rejoined after aggregation by quadkey
-    # TODO: incorporate parametrized aggregations, take inspiration from GeoWrangler agg spec
-    ookla_geoms = ookla[["quadkey", "tile"]].drop_duplicates().reset_index(drop=True)
-    ookla_yearly = (
-        ookla.groupby("quadkey")
-        .agg(
-            mean_avg_d_kbps=("avg_d_kbps", "mean"),
-            mean_avg_u_kbps=("avg_u_kbps", "mean"),
-            mean_avg_lat_ms=("avg_lat_ms", "mean"),
-            mean_num_tests=("tests", "mean"),
-            mean_num_devices=("devices", "mean"),
-        )
-        .reset_index()
-    )
-    # Add type_year prefix to feature names
-    ookla_yearly = ookla_yearly.rename(
-        {
-            col: f"{type_}_{year}_" + col
-            for col in ookla_yearly.columns[~ookla_yearly.columns.isin(["quadkey"])]
-        },
-        axis=1,
-    )
-    ookla_yearly = ookla_yearly.merge(ookla_geoms, on="quadkey", how="left")
+    # The AOI tiles contain whole Ookla tiles, so they can be aggregated by quadkey prefix
+    if use_quadkey_aggregation:
+        logger.debug(
+            f"Aggregating Ookla features to the aoi by the quadkeys in {aoi_quadkey_col}"
+        )
+        aoi_features = aggregate_ookla_by_quadkey(
+            aoi[aoi_quadkey_col], ookla_yearly, aoi_aggregations
+        )
+        aoi[aoi_features.columns] = aoi_features
+        return aoi
+
     ookla_yearly = gpd.GeoDataFrame(
         ookla_yearly,
         geometry=gpd.GeoSeries.from_wkt(ookla_yearly["tile"], crs="epsg:4326"),
     )
 
+    # Weighted means are the ratio of the area apportioned sums of weighted values and weights
+    feature_aggregrations = []
+    for agg in aoi_aggregations:
+        if agg["func"] == "weighted_mean":
+            values, weights = _masked_weights(
+                ookla_yearly[agg["column"]], ookla_yearly[agg["weights"]]
+            )
+            ookla_yearly[f"{agg['output']}__values"] = values
+            ookla_yearly[f"{agg['output']}__weights"] = weights
+            feature_aggregrations += [
+                dict(column=f"{agg['output']}__{col}", func=["sum"])
+                for col in ["values", "weights"]
+            ]
+        else:
+            feature_aggregrations.append(
+                dict(column=agg["column"], func=[agg["func"]], output=[agg["output"]])
+            )
+
     # GeoWrangler: area zonal stats of features per AOI
-    features = ookla_yearly.columns[
-        ~ookla_yearly.columns.isin(["quadkey", "tile", "geometry"])
-    ]
-    agg_funcs = ["mean"]
-    feature_aggregrations = [
-        dict(func=agg_funcs, column=feature) for feature in features
-    ]
     aoi = azs.create_area_zonal_stats(
         aoi.to_crs(metric_crs), ookla_yearly.to_crs(metric_crs), feature_aggregrations
     ).to_crs("epsg:4326")
+    for agg in aoi_aggregations:
+        if agg["func"] == "weighted_mean":
+            values_col = f"{agg['output']}__values_sum"
+            weights_col = f"{agg['output']}__weights_sum"
+            aoi[agg["output"]] = aoi[values_col] / aoi[weights_col].replace(0, np.nan)
+            aoi = aoi.drop([values_col, weights_col], axis=1)
 
     # Clean up columns
     drop_cols = ["intersect_area_sum"]
@@ -340,34 +863,428 @@ def add_ookla_features(
     return aoi
 
 
+def _fix_ookla_aggs(aggregations, supported_funcs):
+    "Expand agg specs into one dict(column, func, output, weights) per func, validating the funcs"
+    fixed_aggs = []
+    for agg in aggregations:
+        if isinstance(agg, str):
+            agg = dict(column=agg, func="mean")
+        funcs = [agg["func"]] if isinstance(agg["func"], str) else list(agg["func"])
+        outputs = agg.get("output")
+        if outputs is None:
+            outputs = [f"{agg['column']}_{func}" for func in funcs]
+        elif isinstance(outputs, str):
+            outputs = (
+                [outputs]
+                if len(funcs) == 1
+                else [f"{outputs}_{func}" for func in funcs]
+            )
+        if len(outputs) != len(funcs):
+            raise ValueError(f"Expected {len(funcs)} outputs in agg spec {agg}")
+        for func, output in zip(funcs, outputs):
+            if func not in supported_funcs and _parse_percentile(func) is None:
+                raise ValueError(
+                    f"Unsupported func {func} in agg spec {agg}, expected one of {supported_funcs}"
+                )
+            if func == "weighted_mean" and agg.get("weights") is None:
+                raise ValueError(f"weighted_mean requires weights in agg spec {agg}")
+            fixed_aggs.append(
+                dict(
+                    column=agg["column"],
+                    func=func,
+                    output=output,
+                    weights=agg.get("weights"),
+                )
+            )
+    return fixed_aggs
+
+
+def _parse_percentile(func):
+    "Get the quantile of percentile funcs such as 'p90', or None for other funcs"
+    match = re.fullmatch(r"p(\d{1,2}(\.\d+)?)", func)
+    return None if match is None else float(match.group(1)) / 100
+
+
+def _ookla_agg_input_columns(aggregations):
+    "Get the Ookla columns needed to compute the aggregations"
+    columns = ["quadkey", "tile"]
+    for agg in aggregations:
+        for col in [agg["column"], agg["weights"]]:
+            if col is not None and col not in columns:
+                columns.append(col)
+    return columns
+
+
+def _masked_weights(values, weights):
+    "Get the weighted values and the weights, ignoring rows where either is missing"
+    mask = values.notna() & weights.notna()
+    return (values * weights).where(mask), weights.where(mask)
+
+
+def _grouped_aggregate(df, groups, aggregations, value_func=None):
+    """Compute `aggregations` of the columns of `df` by `groups` in a single groupby,
+    transforming the values of each aggregation with `value_func(agg, values)` if given
+    """
+    columns = {}
+    named_aggs = {}
+    quantiles = {}
+    for i, agg in enumerate(aggregations):
+        values = df[agg["column"]]
+        if value_func is not None:
+            values = value_func(agg, values)
+        if agg["func"] == "weighted_mean":
+            weighted_values, weights = _masked_weights(values, df[agg["weights"]])
+            columns[f"v{i}"], columns[f"w{i}"] = weighted_values, weights
+            named_aggs[f"v{i}"] = (f"v{i}", "sum")
+            named_aggs[f"w{i}"] = (f"w{i}", "sum")
+        elif _parse_percentile(agg["func"]) is not None:
+            columns[f"v{i}"] = values
+            quantiles.setdefault(_parse_percentile(agg["func"]), []).append(i)
+        else:
+            columns[f"v{i}"] = values
+            named_aggs[f"v{i}"] = (f"v{i}", agg["func"])
+
+    grouped = pd.DataFrame(columns, index=df.index).groupby(groups, sort=True)
+    results = grouped.agg(**named_aggs) if named_aggs else grouped.size().to_frame()[[]]
+    for q, idxs in quantiles.items():
+        quantile_results = grouped[[f"v{i}" for i in idxs]].quantile(q)
+        results[quantile_results.columns] = quantile_results
+
+    output = pd.DataFrame(index=results.index)
+    for i, agg in enumerate(aggregations):
+        if agg["func"] == "weighted_mean":
+            output[agg["output"]] = results[f"v{i}"] / results[f"w{i}"].replace(
+                0, np.nan
+            )
+        else:
+            output[agg["output"]] = results[f"v{i}"]
+    return output
+
+
+def _is_quadkey_aoi(aoi, aoi_quadkey_col):
+    "Check if the aoi is made of tiles at a single zoom level no finer than the Ookla tiles"
+    if aoi_quadkey_col not in aoi.columns or len(aoi) == 0:
+        return False
+    zoom_lvls = aoi[aoi_quadkey_col].astype(str).str.len().unique()
+    return len(zoom_lvls) == 1 and zoom_lvls[0] <= OOKLA_ZOOM_LEVEL
+
+
+def quadkey_to_tile_xy(quadkeys):
+    "Get the tile x and y arrays of quadkeys at the same zoom level"
+    quadkeys = np.asarray(quadkeys, dtype=str)
+    zoom = len(quadkeys[0]) if len(quadkeys) > 0 else 0
+    digits = np.frombuffer(
+        quadkeys.astype(f"S{zoom}").tobytes(), dtype=np.uint8
+    ).reshape(-1, zoom).astype(np.int64) - ord("0")
+    bits = 1 << np.arange(zoom - 1, -1, -1, dtype=np.int64)
+    x = ((digits & 1) * bits).sum(axis=1)
+    y = ((digits >> 1) * bits).sum(axis=1)
+    return x, y
+
+
+def _tile_sin_lat_span(y, zoom):
+    "Difference of the sine of the top and bottom latitudes of tiles, proportional to their area"
+    # sin(lat) = tanh(pi * (1 - 2y / 2^zoom)) for the web mercator tile edge at y
+    n = 2.0**zoom
+    return np.tanh(np.pi * (1 - 2 * y / n)) - np.tanh(np.pi * (1 - 2 * (y + 1) / n))
+
+
+def aggregate_ookla_by_quadkey(aoi_quadkeys, ookla, aggregations):
+    """Aggregate the Ookla tile features to the aoi tiles of `aoi_quadkeys` (same or coarser zoom level),
+    same as `geowrangler.area_zonal_stats.create_area_zonal_stats` with tile areas computed on the sphere
+    (including its `fix_min`: min is 0 for aoi tiles not fully covered by Ookla tiles).
+
+    Args:
+        aggregations: Agg specs (see `add_ookla_multi_features`), or feature names as a shorthand for their mean
+    Returns:
+        A dataframe of the output columns indexed like `aoi_quadkeys`
+    """
+    aggregations = _fix_ookla_aggs(aggregations, OOKLA_AOI_FUNCS)
+    aoi_quadkeys = aoi_quadkeys.astype(str)
+    aoi_zoom = len(aoi_quadkeys.iloc[0])
+    output_cols = [agg["output"] for agg in aggregations]
+    if len(ookla) == 0:
+        aoi_features = pd.DataFrame(
+            np.nan, index=aoi_quadkeys.index, columns=output_cols
+        )
+        return _fix_quadkey_min(aoi_features, aggregations, 0.0)
+
+    ookla_quadkeys = ookla["quadkey"].astype(str)
+    _, ookla_y = quadkey_to_tile_xy(ookla_quadkeys)
+    ookla_zoom = len(ookla_quadkeys.iloc[0])
+    parent_y = ookla_y >> (ookla_zoom - aoi_zoom)
+    # Longitude spans are a fixed fraction of the parent's, only the latitude span varies
+    area_fraction = _tile_sin_lat_span(ookla_y, ookla_zoom) / (
+        _tile_sin_lat_span(parent_y, aoi_zoom) * 2 ** (ookla_zoom - aoi_zoom)
+    )
+
+    def apportion(agg, values):
+        return values * area_fraction if agg["func"] == "mean" else values
+
+    parent_quadkeys = ookla_quadkeys.str[:aoi_zoom].to_numpy()
+    aoi_features = _grouped_aggregate(
+        ookla, parent_quadkeys, aggregations, value_func=apportion
+    )
+    aoi_features = aoi_features.reindex(aoi_quadkeys.to_numpy())
+    aoi_features.index = aoi_quadkeys.index
+    coverage = (
+        pd.Series(np.asarray(area_fraction))
+        .groupby(parent_quadkeys)
+        .sum()
+        .reindex(aoi_quadkeys.to_numpy(), fill_value=0.0)
+    )
+    return _fix_quadkey_min(aoi_features, aggregations, coverage.to_numpy())
+
+
+def _fix_quadkey_min(aoi_features, aggregations, coverage):
+    "Set the min features to 0 where the area fraction of the aoi tiles covered by Ookla tiles is below 1, like `fix_min` of the overlay"
+    for agg in aggregations:
+        if agg["func"] == "min":
+            aoi_features[agg["output"]] = aoi_features[agg["output"]].where(
+                np.isclose(coverage, 1.0), 0.0
+            )
+    return aoi_features
+
+
+def aggregate_ookla_yearly(ookla, aggregations=None):
+    """Combine quarterly Ookla data into yearly aggregates per quadkey, sorted by quadkey.
+
+    Args:
+        aggregations: GeoWrangler style agg specs with the Ookla `column`, the `func` (or list of funcs)
+            among `OOKLA_YEARLY_FUNCS` or a percentile such as "p90", the `output` column name(s)
+            (defaults to `{column}_{func}`) and the `weights` column for `weighted_mean`,
+            e.g. `dict(column="avg_d_kbps", func="weighted_mean", weights="tests")`.
+            Defaults to `DEFAULT_OOKLA_YEARLY_AGGREGATIONS`
+    """
+    aggregations = _fix_ookla_aggs(
+        aggregations or DEFAULT_OOKLA_YEARLY_AGGREGATIONS, OOKLA_YEARLY_FUNCS
+    )
+    ookla_yearly = _grouped_aggregate(ookla, ookla["quadkey"], aggregations)
+    ookla_yearly.insert(0, "tile", ookla.groupby("quadkey", sort=True)["tile"].first())
+    ookla_yearly.index.name = "quadkey"
+    return ookla_yearly.reset_index()
+
+
+def build_ookla_yearly_index(
+    type_,
+    year,
+    cache_dir,
+    use_cache=True,
+    partition_zoom=DEFAULT_INDEX_PARTITION_ZOOM,
+    row_group_size=DEFAULT_INDEX_ROW_GROUP_SIZE,
+    aggregations=None,
+    repartition=False,
+):
+    """Build the global yearly index of the `aggregations` of Ookla data (see `aggregate_ookla_yearly`)
+    for a type (fixed or mobile) and year, with one parquet file sorted by quadkey per zoom `partition_zoom` prefix
+    """
+    index_name = str(year)
+    if aggregations is not None and _fix_ookla_aggs(
+        aggregations, OOKLA_YEARLY_FUNCS
+    ) != _fix_ookla_aggs(DEFAULT_OOKLA_YEARLY_AGGREGATIONS, OOKLA_YEARLY_FUNCS):
+        # Indexes of non default aggregations are kept separately
+        spec_hash = hashlib.md5(
+            json.dumps(_fix_ookla_aggs(aggregations, OOKLA_YEARLY_FUNCS)).encode()
+        ).hexdigest()
+        index_name = f"{year}_{spec_hash[:8]}"
+    index_dir = os.path.join(cache_dir, "ookla", "index", type_, index_name)
+    if os.path.exists(index_dir) and use_cache:
+        logger.debug(
+            f"Ookla Data: Yearly index for {type_} and {year} found at {index_dir}"
+        )
+        return index_dir
+
+    type_year_cache_dir = download_ookla_year_data(
+        type_, year, cache_dir=cache_dir, use_cache=use_cache, repartition=repartition
+    )
+    columns = [
+        col
+        for col in _ookla_agg_input_columns(
+            _fix_ookla_aggs(
+                aggregations or DEFAULT_OOKLA_YEARLY_AGGREGATIONS, OOKLA_YEARLY_FUNCS
+            )
+        )
+        if col != "quarter"
+    ]
+
+    logger.info(
+        f"Ookla Data: Building yearly index for {type_} and {year} at {index_dir}..."
+    )
+    # Write to a temp dir first so an interrupted build is never mistaken for an index
+    tmp_index_dir = f"{index_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_index_dir, ignore_errors=True)
+    Path(tmp_index_dir).mkdir(parents=True)
+    # Split each quarter by partition once, then aggregate each partition over the quarters
+    split_dir = os.path.join(tmp_index_dir, "quarters")
+    for i, (quarter, filepath) in enumerate(
+        list_ookla_quarter_files(type_year_cache_dir)
+    ):
+        _split_ookla_quarter_file(
+            filepath, f"{quarter}_{i}", split_dir, partition_zoom, columns=columns
+        )
+    prefixes = sorted(os.listdir(split_dir)) if os.path.exists(split_dir) else []
+    for prefix in prefixes:
+        prefix_dir = os.path.join(split_dir, prefix)
+        partition_df = pd.concat(
+            [
+                pd.read_parquet(os.path.join(prefix_dir, filename)).assign(
+                    quarter=np.int8(filename.split("_")[0])
+                )
+                for filename in sorted(os.listdir(prefix_dir))
+            ],
+            ignore_index=True,
+        )
+        aggregate_ookla_yearly(partition_df, aggregations).to_parquet(
+            os.path.join(tmp_index_dir, f"{prefix}.parquet"),
+            index=False,
+            compression="zstd",
+            row_group_size=row_group_size,
+        )
+        del partition_df
+        shutil.rmtree(prefix_dir)
+        gc.collect()
+    shutil.rmtree(split_dir, ignore_errors=True)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_index_dir, index_dir)
+    logger.info(
+        f"Ookla Data: Successfully built yearly index for {type_} and {year} at {index_dir}!"
+    )
+    return index_dir
+
+
+def _split_ookla_quarter_file(filepath, name, split_dir, partition_zoom, columns):
+    "Stream a quarterly Ookla file into `{split_dir}/{quadkey prefix}/{name}.parquet` files"
+    if _ookla_store_partition_zoom(filepath) is None:
+        dataset = ds.dataset(filepath, format="parquet")
+    else:
+        dataset = ds.dataset(
+            filepath, format="parquet", partitioning=_ookla_store_partitioning()
+        )
+    writers = {}
+    try:
+        for batch in dataset.to_batches(columns=columns):
+            prefixes = pc.utf8_slice_codeunits(batch["quadkey"], 0, partition_zoom)
+            for prefix in pc.unique(prefixes).to_pylist():
+                if prefix not in writers:
+                    prefix_dir = os.path.join(split_dir, prefix)
+                    Path(prefix_dir).mkdir(parents=True, exist_ok=True)
+                    writers[prefix] = pq.ParquetWriter(
+                        os.path.join(prefix_dir, f"{name}.parquet"), batch.schema
+                    )
+                writers[prefix].write_batch(batch.filter(pc.equal(prefixes, prefix)))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def quadkey_ranges(quadkeys, zoom=OOKLA_ZOOM_LEVEL, max_ranges=None):
+    """Convert quadkeys (of any zoom level up to `zoom`) into a sorted list of disjoint `(first, last)` ranges
+    of the zoom `zoom` quadkeys they contain.
+
+    Args:
+        max_ranges: If set, merge the ranges separated by the smallest gaps until there are at most `max_ranges`
+    """
+    quadkeys = pd.unique(pd.Series(quadkeys, dtype=str))
+    if len(quadkeys) == 0:
+        return []
+    lengths = np.array([len(q) for q in quadkeys])
+    if lengths.max() > zoom:
+        raise ValueError(f"Quadkeys should be at zoom level {zoom} or lower")
+    # A zoom z quadkey q contains the zoom `zoom` quadkeys [q00..0, q33..3], which are
+    # consecutive integers when read as base 4 numbers
+    widths = 4 ** (zoom - lengths).astype(np.int64)
+    starts = (
+        np.array([int(q, 4) if q else 0 for q in quadkeys], dtype=np.int64) * widths
+    )
+    ends = starts + widths
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], np.maximum.accumulate(ends[order])
+
+    # Start a new range wherever there is a gap with all the previous ranges
+    is_new_range = np.ones(len(starts), dtype=bool)
+    is_new_range[1:] = starts[1:] > ends[:-1]
+    if max_ranges is not None and is_new_range.sum() > max_ranges:
+        gaps = np.where(is_new_range[1:], starts[1:] - ends[:-1], -1)
+        keep = np.argsort(-gaps, kind="stable")[: max_ranges - 1]
+        is_new_range[1:] = False
+        is_new_range[keep + 1] = True
+    range_ids = np.cumsum(is_new_range) - 1
+    n_ranges = range_ids[-1] + 1
+    range_starts = np.full(n_ranges, np.iinfo(np.int64).max)
+    np.minimum.at(range_starts, range_ids, starts)
+    range_ends = np.zeros(n_ranges, dtype=np.int64)
+    np.maximum.at(range_ends, range_ids, ends)
+
+    return [
+        (_int_to_quadkey(first, zoom), _int_to_quadkey(last - 1, zoom))
+        for first, last in zip(range_starts, range_ends)
+    ]
+
+
+def _int_to_quadkey(value, zoom):
+    return np.base_repr(value, base=4).zfill(zoom)
+
+
+def quadkey_range_filter(ranges, quadkey_col="quadkey"):
+    "Build a pyarrow dataset filter expression matching the quadkeys in `ranges` (see `quadkey_ranges`)"
+    field = ds.field(quadkey_col)
+    return functools.reduce(
+        operator.or_, [(field >= first) & (field <= last) for first, last in ranges]
+    )
+
+
 def _read_and_filter_quadkey_parquet_file(
     parquet_file,
     filter_quadkey_list,
     input_quadkey_col="quadkey",
-    batch_size=50000,
+    max_ranges=DEFAULT_MAX_QUADKEY_RANGES,
+    columns=None,
 ):
-    """Read parquet file with a quadkey in batches and filter based on given quadkey list"""
-    parquet_file = pq.ParquetFile(parquet_file)
+    """Read parquet file (or directory of parquet files) filtered by the quadkey ranges of the given quadkey list,
+    keeping only `columns` if set
+    """
+    partition_zoom = _ookla_store_partition_zoom(parquet_file)
+    if partition_zoom is None:
+        dataset = ds.dataset(parquet_file, format="parquet")
+    else:
+        dataset = ds.dataset(
+            parquet_file, format="parquet", partitioning=_ookla_store_partitioning()
+        )
+        if columns is None:
+            columns = [
+                col for col in dataset.schema.names if col != OOKLA_STORE_PARTITION_COL
+            ]
+    filter_quadkey_list = pd.unique(pd.Series(filter_quadkey_list, dtype=str))
+    if len(filter_quadkey_list) == 0:
+        return (
+            dataset.schema.empty_table()
+            .select(columns or dataset.schema.names)
+            .to_pandas()
+        )
 
-    # Get the zoom level of the filter quadkey list. All entries must be the same level
-    filter_quadkey_list_iter = iter(filter_quadkey_list)
-    first_key_zoom_lvl = len(next(filter_quadkey_list_iter))
-    if not all(len(key) == first_key_zoom_lvl for key in filter_quadkey_list_iter):
-        raise ValueError(
-            f"Not all items in filter_quadkey_list are of the same zoom level."
+    ranges = quadkey_ranges(
+        filter_quadkey_list, zoom=OOKLA_ZOOM_LEVEL, max_ranges=max_ranges
+    )
+    quadkey_filter = quadkey_range_filter(ranges, input_quadkey_col)
+    if partition_zoom is not None:
+        quadkey_filter = quadkey_filter & quadkey_range_filter(
+            [(first[:partition_zoom], last[:partition_zoom]) for first, last in ranges],
+            OOKLA_STORE_PARTITION_COL,
         )
-    filter_quadkey_zoom_lvl = first_key_zoom_lvl
+    output_df = dataset.to_table(columns=columns, filter=quadkey_filter).to_pandas()
 
-    batch_df_list = []
-    for batch in parquet_file.iter_batches(batch_size):
-        batch_df = batch.to_pandas()
+    # Drop the rows of other quadkeys within merged ranges
+    output_df = _filter_quadkey_df(output_df, filter_quadkey_list, input_quadkey_col)
 
-        # Create helper index column to filter out quadkeys at specified zoom level
-        filter_col = f"quadkey_at_zoom_lvl_{filter_quadkey_zoom_lvl}"
-        batch_df[filter_col] = batch_df[input_quadkey_col].str[:filter_quadkey_zoom_lvl]
-        batch_df = batch_df[batch_df[filter_col].isin(filter_quadkey_list)]
-        batch_df_list.append(batch_df)
+    return output_df
 
-    output_df = pd.concat(batch_df_list, ignore_index=True)
 
-    return output_df
+def _filter_quadkey_df(df, filter_quadkey_list, input_quadkey_col="quadkey"):
+    "Keep the rows of `df` whose quadkey is within one of the given quadkeys (of any zoom level)"
+    filter_quadkey_list = pd.unique(pd.Series(filter_quadkey_list, dtype=str))
+    quadkeys = df[input_quadkey_col]
+    keep = np.zeros(len(df), dtype=bool)
+    for zoom_lvl in np.unique([len(key) for key in filter_quadkey_list]):
+        keep |= quadkeys.str[:zoom_lvl].isin(filter_quadkey_list).to_numpy()
+    return df[keep].reset_index(drop=True)
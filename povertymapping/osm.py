@@ -1,21 +1,29 @@
 import os
+import re
 import shutil
-import uuid
 from pathlib import Path
 from typing import Union
 from urllib.request import HTTPError
 from zipfile import ZipFile
 
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
 import requests
-from geowrangler import distance_zonal_stats as dzs
-from geowrangler import vector_zonal_stats as vzs
 from geowrangler.datasets import geofabrik
 from geowrangler.datasets.geofabrik import get_download_filepath
-from geowrangler.datasets.utils import make_report_hook, urlretrieve
+from geowrangler.datasets.utils import make_report_hook
 from loguru import logger
+from pyproj import Transformer
+from shapely import STRtree
 from shapely.geometry import MultiPolygon, Polygon
 
+from povertymapping.cache import get_cache_manager
+from povertymapping.download import is_partial_download
+from povertymapping.nightlights import urlretrieve
+from povertymapping.spatial_index import PackedRTree
+
 DEFAULT_POI_TYPES = [
     "atm",
     "bank",
@@ -41,6 +49,17 @@ DEFAULT_POI_TYPES = [
     "townhall",
 ]
 
+# Columns kept in the GeoParquet copies of the Geofabrik layers (see `load_osm_layer`)
+OSM_POIS_COLUMNS = ["fclass", "geometry"]
+OSM_ROADS_COLUMNS = ["fclass", "geometry"]
+# Zoom level of the tiles used to sort the GeoParquet copies spatially
+OSM_SORT_ZOOM_LEVEL = 16
+OSM_ROW_GROUP_SIZE = 50000
+# Columns holding the bounds of each feature in the GeoParquet copies, used to filter reads by bbox
+OSM_BBOX_COLUMNS = ["bbox_minx", "bbox_miny", "bbox_maxx", "bbox_maxy"]
+# Suffix of the spatial indexes persisted next to the GeoParquet copies
+OSM_INDEX_SUFFIX = ".rtree.npz"
+
 DEFAULT_INDONESIA_GEOFABRIK_URL = (
     "https://download.geofabrik.de/asia/indonesia-210101-free.shp.zip"
 )
@@ -55,82 +74,129 @@ def add_osm_poi_features(
     metric_crs="epsg:3857",
     inplace=False,
     nearest_poi_max_distance=10000,
+    use_aoi_bbox=False,
 ):
-    """Generates features for the AOI based on OSM POI data (POIs, roads, etc)."""
+    """Generates features for the AOI based on OSM POI data (POIs, roads, etc).
+    If `use_aoi_bbox`, only the POIs within `nearest_poi_max_distance` of the AOI bounds are loaded.
+    """
 
     # Load-in the OSM POIs data
-    osm = osm_data_manager.load_pois(country, use_cache=use_cache)
+    bbox = None
+    if use_aoi_bbox:
+        bbox = get_osm_bbox(aoi, buffer=nearest_poi_max_distance, metric_crs=metric_crs)
+    osm = osm_data_manager.load_pois(country, use_cache=use_cache, bbox=bbox)
 
     # Create a copy of the AOI gdf if not inplace to avoid modifying the original gdf
     if not inplace:
         aoi = aoi.copy()
 
-    # GeoWrangler: Count number of all POIs per tile
-    aoi = vzs.create_zonal_stats(
-        aoi,
-        osm,
-        overlap_method="intersects",
-        aggregations=[{"func": "count", "output": "poi_count", "fillna": True}],
+    # Count all POIs and each POI type per tile with a single spatial join
+    # The index of the country pois only matches them when they are loaded in full
+    osm_index = None if use_aoi_bbox else osm_data_manager.get_pois_index(country)
+    poi_counts = count_osm_pois(aoi, osm, poi_types, osm_index=osm_index)
+    aoi["poi_count"] = poi_counts["poi_count"].to_numpy()
+
+    # Distance to the nearest POI of each type, reprojecting the AOI and POIs once
+    poi_distances = nearest_osm_poi_distances(
+        aoi, osm, poi_types, metric_crs, max_distance=nearest_poi_max_distance
     )
 
     # Count specific aoi types
     for poi_type in poi_types:
-        # GeoWrangler: Count with vector zonal stats
-        aoi = vzs.create_zonal_stats(
-            aoi,
-            osm[osm["fclass"] == poi_type],
-            overlap_method="intersects",
-            aggregations=[
-                {"func": "count", "output": f"{poi_type}_count", "fillna": True}
-            ],
-        )
+        aoi[f"{poi_type}_count"] = poi_counts[f"{poi_type}_count"].to_numpy()
+        aoi[f"{poi_type}_nearest"] = poi_distances[f"{poi_type}_nearest"].to_numpy()
+
+    return aoi
+
+
+def count_osm_pois(aoi, osm, poi_types=DEFAULT_POI_TYPES, osm_index=None):
+    """Count the OSM POIs intersecting each AOI in total (`poi_count`) and per POI type (`{poi_type}_count`),
+    using the `PackedRTree` of the POIs `osm_index` if given. Returns float counts indexed like the AOI.
+    """
+    if not osm.crs.equals(aoi.crs):
+        osm = osm.to_crs(aoi.crs)
+        osm_index = None
+
+    # Join on positions, as the AOI index may not be unique
+    aoi_positions, osm_positions = _query_intersects(aoi, osm, osm_index)
+    fclass = osm["fclass"].to_numpy()[osm_positions]
+    type_counts = pd.crosstab(aoi_positions, fclass)
+
+    poi_counts = pd.DataFrame(
+        {"poi_count": pd.Series(aoi_positions).value_counts()},
+        index=pd.RangeIndex(len(aoi)),
+    )
+    for poi_type in poi_types:
+        if poi_type in type_counts.columns:
+            poi_counts[f"{poi_type}_count"] = type_counts[poi_type]
+        else:
+            poi_counts[f"{poi_type}_count"] = 0
+    poi_counts = poi_counts.fillna(0).astype(float)
+    poi_counts.index = aoi.index
 
-        # GeoWrangler: Distance with distance zonal stats
-        col_name = f"{poi_type}_nearest"
-        aoi = dzs.create_distance_zonal_stats(
-            aoi.to_crs(metric_crs),
-            osm[osm["fclass"] == poi_type].to_crs(metric_crs),
-            max_distance=nearest_poi_max_distance,
-            aggregations=[],
-            distance_col=col_name,
-        ).to_crs("epsg:4326")
+    return poi_counts
+
+
+def nearest_osm_poi_distances(
+    aoi, osm, poi_types=DEFAULT_POI_TYPES, metric_crs="epsg:3857", max_distance=10000
+):
+    """Get the distance from each AOI to the nearest OSM POI of each type (`{poi_type}_nearest`) in `metric_crs` units,
+    or `max_distance` if there is none within `max_distance`. Returns a dataframe indexed like the AOI.
+    """
+    aoi_geoms = np.asarray(aoi.geometry.to_crs(metric_crs))
+    osm = osm[osm["fclass"].isin(poi_types)]
+    poi_geoms = np.asarray(osm.geometry.to_crs(metric_crs))
+    poi_type_positions = osm.reset_index(drop=True).groupby("fclass").indices
+
+    poi_distances = pd.DataFrame(index=aoi.index)
+    for poi_type in poi_types:
+        distances = np.full(len(aoi), np.nan)
+        tree = STRtree(poi_geoms[poi_type_positions.get(poi_type, [])])
+        (aoi_positions, _), nearest_distances = tree.query_nearest(
+            aoi_geoms,
+            max_distance=max_distance,
+            return_distance=True,
+            all_matches=False,
+        )
+        distances[aoi_positions] = nearest_distances
 
         # If no POI was found within the distance limit, set the distance to the max distance
-        aoi[col_name] = aoi[col_name].fillna(value=nearest_poi_max_distance)
+        poi_distances[f"{poi_type}_nearest"] = np.nan_to_num(distances, nan=max_distance)
 
-    return aoi
+    return poi_distances
 
 
 def add_osm_road_features(
-    aoi, country, osm_data_manager, use_cache=True, inplace=False
+    aoi, country, osm_data_manager, use_cache=True, inplace=False, use_aoi_bbox=False
 ):
-    """Generates features for the AOI based on OSM road data"""
-    roads_gdf = osm_data_manager.load_roads(country, use_cache=use_cache)
+    """Generates features for the AOI based on OSM road data.
+    If `use_aoi_bbox`, only the roads within the AOI bounds are loaded instead of the whole country."""
+    bbox = get_osm_bbox(aoi) if use_aoi_bbox else None
+    roads_gdf = osm_data_manager.load_roads(country, use_cache=use_cache, bbox=bbox)
     assert aoi.crs == roads_gdf.crs
 
     if not inplace:
         aoi = aoi.copy()
 
-    # Create a temporary ID column to use for our processing
-    # Assign simple integer values
-    temp_id = str(uuid.uuid4())
-    aoi[temp_id] = list(range(len(aoi)))
-
-    # Get intersections between the AOIs and the roads
-    joined = gpd.sjoin(aoi, roads_gdf, how="inner", predicate="intersects")
+    # Get intersections between the AOIs and the roads, on positions as the AOI index may not be unique
+    roads_index = None if use_aoi_bbox else osm_data_manager.get_roads_index(country)
+    aoi_positions, _ = _query_intersects(aoi, roads_gdf, roads_index)
 
-    # Count the number of roads that intersected
-    road_stats_df = joined.groupby(temp_id)["index_right"].agg(road_count="count")
-    # Join back to the original AOI gdf
-    aoi = aoi.join(road_stats_df, how="left", on=temp_id)
+    # Count the number of roads that intersected,
+    # there might be AOIs that did not intersect with any roads at all
+    aoi["road_count"] = np.bincount(aoi_positions, minlength=len(aoi)).astype(float)
 
-    # There might be AOIs that did not intersect with any roads at all
-    aoi["road_count"] = aoi["road_count"].fillna(0)
+    return aoi
 
-    # Remove the temporary ID column
-    del aoi[temp_id]
 
-    return aoi
+def _query_intersects(aoi, layer, layer_index=None):
+    """Get the `(aoi_positions, layer_positions)` of the intersecting AOI and layer geometries,
+    querying the persisted `PackedRTree` of the layer if given instead of building an STRtree."""
+    aoi_geoms = np.asarray(aoi.geometry)
+    layer_geoms = np.asarray(layer.geometry)
+    if layer_index is None:
+        return STRtree(layer_geoms).query(aoi_geoms, predicate="intersects")
+    return layer_index.query(aoi_geoms, layer_geoms, predicate="intersects")
 
 
 class OsmDataManager:
@@ -140,15 +206,26 @@ class OsmDataManager:
 
     def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
         self.cache_dir = os.path.expanduser(cache_dir)
+        # The (layer, `PackedRTree` of the layer) loaded in full, by country
         self.pois_cache = {}
         self.roads_cache = {}
 
+    def get_pois_index(self, country):
+        "Get the `PackedRTree` of the pois of a country loaded in full by `load_pois`, or None"
+        return self.pois_cache.get(country, (None, None))[1]
+
+    def get_roads_index(self, country):
+        "Get the `PackedRTree` of the roads of a country loaded in full by `load_roads`, or None"
+        return self.roads_cache.get(country, (None, None))[1]
+
     # TODO: add use_dict_cache to seaprate loading into cache
-    def load_pois(self, country, use_cache=True):
+    def load_pois(self, country, use_cache=True, bbox=None):
+        """Load the OSM pois of a country. If `bbox` (minx, miny, maxx, maxy in EPSG:4326) is set,
+        only the pois whose bounds overlap it are read, and they are not cached in RAM."""
         # Get from RAM cache if already available
         if country in self.pois_cache:
             logger.debug(f"OSM POIs for {country} found in cache.")
-            return self.pois_cache[country]
+            return _slice_bbox(*self.pois_cache[country], bbox)
 
         # Otherwise, load from file and add to cache
         country_cache_dir = download_osm_country_data(
@@ -156,18 +233,25 @@ class OsmDataManager:
             cache_dir=self.cache_dir,
             use_cache=use_cache,
         )
-        osm_pois_filepath = os.path.join(country_cache_dir, "gis_osm_pois_free_1.shp")
-        logger.debug(f"OSM POIs for {country} being loaded from {osm_pois_filepath}")
-        gdf = gpd.read_file(osm_pois_filepath)
-        self.pois_cache[country] = gdf
+        logger.debug(f"OSM POIs for {country} being loaded from {country_cache_dir}")
+        gdf = load_osm_layer(
+            country_cache_dir, "gis_osm_pois_free_1", OSM_POIS_COLUMNS, use_cache, bbox=bbox
+        )
+        if bbox is None:
+            self.pois_cache[country] = (
+                gdf,
+                load_osm_layer_index(country_cache_dir, "gis_osm_pois_free_1", gdf),
+            )
 
         return gdf
 
-    def load_roads(self, country, use_cache=True):
+    def load_roads(self, country, use_cache=True, bbox=None):
+        """Load the OSM roads of a country. If `bbox` (minx, miny, maxx, maxy in EPSG:4326) is set,
+        only the roads whose bounds overlap it are read, and they are not cached in RAM."""
         # Get from RAM cache if already available
         if country in self.roads_cache:
             logger.debug(f"OSM Roads for {country} found in cache.")
-            return self.roads_cache[country]
+            return _slice_bbox(*self.roads_cache[country], bbox)
 
         # Otherwise, load from file and add to cache
         country_cache_dir = download_osm_country_data(
@@ -175,24 +259,145 @@ class OsmDataManager:
             cache_dir=self.cache_dir,
             use_cache=use_cache,
         )
-        osm_roads_filepath = os.path.join(country_cache_dir, "gis_osm_roads_free_1.shp")
-        logger.debug(f"OSM Roads for {country} being loaded from {osm_roads_filepath}")
-        gdf = gpd.read_file(osm_roads_filepath)
-        self.roads_cache[country] = gdf
+        logger.debug(f"OSM Roads for {country} being loaded from {country_cache_dir}")
+        gdf = load_osm_layer(
+            country_cache_dir, "gis_osm_roads_free_1", OSM_ROADS_COLUMNS, use_cache, bbox=bbox
+        )
+        if bbox is None:
+            self.roads_cache[country] = (
+                gdf,
+                load_osm_layer_index(country_cache_dir, "gis_osm_roads_free_1", gdf),
+            )
 
         return gdf
 
 
-def download_osm_country_data(country, cache_dir, use_cache=True):
+def load_osm_layer(country_cache_dir, layer, columns, use_cache=True, bbox=None):
+    """Load the `columns` of a Geofabrik shapefile layer (e.g. `gis_osm_roads_free_1`) in `country_cache_dir`,
+    converting it on first load to a spatially sorted GeoParquet file with only `columns` and the feature bounds.
+
+    Args:
+        bbox: If set, only read the features whose bounds overlap it (minx, miny, maxx, maxy in the layer crs)
+    """
+    shapefile_path = os.path.join(country_cache_dir, f"{layer}.shp")
+    parquet_path = os.path.join(country_cache_dir, f"{layer}.parquet")
+
+    if (
+        os.path.exists(parquet_path)
+        and use_cache
+        and set(columns + OSM_BBOX_COLUMNS) <= set(pq.read_schema(parquet_path).names)
+    ):
+        if bbox is None:
+            return gpd.read_parquet(parquet_path, columns=columns)
+        minx, miny, maxx, maxy = bbox
+        return gpd.read_parquet(
+            parquet_path,
+            columns=columns,
+            filters=[
+                ("bbox_maxx", ">=", minx),
+                ("bbox_minx", "<=", maxx),
+                ("bbox_maxy", ">=", miny),
+                ("bbox_miny", "<=", maxy),
+            ],
+        ).reset_index(drop=True)
+
+    logger.info(f"OSM Data: Converting {shapefile_path} to GeoParquet...")
+    # Only read the attribute fields in `columns`
+    gdf = gpd.read_file(
+        shapefile_path, columns=[col for col in columns if col != "geometry"]
+    )[columns]
+    gdf = gdf.iloc[np.argsort(_spatial_sort_key(gdf), kind="stable")]
+    gdf = gdf.reset_index(drop=True)
+    gdf[OSM_BBOX_COLUMNS] = gdf.geometry.bounds.to_numpy()
+
+    # Write to a temp file first so an interrupted conversion is never read
+    tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+    gdf.to_parquet(
+        tmp_path, index=False, compression="zstd", row_group_size=OSM_ROW_GROUP_SIZE
+    )
+    os.replace(tmp_path, parquet_path)
+    layer_index = PackedRTree.from_bounds(
+        gdf[OSM_BBOX_COLUMNS].to_numpy(), fingerprint=_file_fingerprint(parquet_path)
+    )
+    layer_index.save(os.path.join(country_cache_dir, f"{layer}{OSM_INDEX_SUFFIX}"))
+    return _slice_bbox(gdf[columns], layer_index, bbox)
+
+
+def load_osm_layer_index(country_cache_dir, layer, gdf):
+    """Load the `PackedRTree` of a layer loaded in full (`gdf`), rebuilding it if it is missing or out of date"""
+    index_path = os.path.join(country_cache_dir, f"{layer}{OSM_INDEX_SUFFIX}")
+    fingerprint = _file_fingerprint(os.path.join(country_cache_dir, f"{layer}.parquet"))
+    if os.path.exists(index_path):
+        layer_index = PackedRTree.load(index_path)
+        if layer_index.fingerprint == fingerprint and len(layer_index) == len(gdf):
+            return layer_index
+    logger.debug(f"Building the spatial index of {layer} at {index_path}")
+    layer_index = PackedRTree.from_geometries(gdf.geometry, fingerprint=fingerprint)
+    layer_index.save(index_path)
+    return layer_index
+
+
+def _file_fingerprint(path):
+    "Get the size and modification time of a file, which change whenever it is rewritten"
+    stat = os.stat(path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def _slice_bbox(gdf, layer_index, bbox):
+    "Get the features of `gdf` whose bounds overlap `bbox` using its `PackedRTree`, or all of them if `bbox` is None"
+    if bbox is None:
+        return gdf
+    _, feature_pos = layer_index.query_bounds([bbox])
+    return gdf.iloc[np.sort(feature_pos)].reset_index(drop=True)
+
+
+def get_osm_bbox(aoi, buffer=0, metric_crs="epsg:3857"):
+    """Get the EPSG:4326 bbox (minx, miny, maxx, maxy) of the AOI, expanded by `buffer` `metric_crs` units"""
+    if buffer == 0:
+        return tuple(aoi.to_crs("epsg:4326").total_bounds)
+    minx, miny, maxx, maxy = aoi.to_crs(metric_crs).total_bounds
+    return tuple(
+        Transformer.from_crs(metric_crs, "epsg:4326", always_xy=True).transform_bounds(
+            minx - buffer, miny - buffer, maxx + buffer, maxy + buffer
+        )
+    )
+
+
+def _spatial_sort_key(gdf, zoom=OSM_SORT_ZOOM_LEVEL):
+    "Get the quadkey (as an integer) of the zoom `zoom` tile containing the center of each geometry's bounds"
+    bounds = gdf.geometry.to_crs("epsg:4326").bounds
+    lon = ((bounds["minx"] + bounds["maxx"]) / 2).to_numpy()
+    lat = np.clip((bounds["miny"] + bounds["maxy"]) / 2, -85.05, 85.05).to_numpy()
+    n = 2**zoom
+    x = np.clip(((lon + 180) / 360 * n).astype(np.int64), 0, n - 1)
+    sin_lat = np.sin(np.radians(lat))
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * n
+    y = np.clip(y.astype(np.int64), 0, n - 1)
+
+    # Interleave the bits of x and y, same as reading the quadkey in base 4
+    key = np.zeros(len(gdf), dtype=np.int64)
+    for bit in range(zoom):
+        key |= ((x >> bit) & 1) << (2 * bit)
+        key |= ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def download_osm_country_data(
+    country, cache_dir, use_cache=True, cache_max_size=None
+):
 
     # TODO consider incorporating year or quarter to automatically avoid using stale data
     country_cache_dir = os.path.join(cache_dir, "osm", country)
 
     # Check if the cached data is valid. Otherwise, we have to re-download.
-    # Temporary quick check now is to see if the country cache folder is non-empty.
+    # Temporary quick check now is to see if the country cache folder has any finished files.
     # TODO: Can improve this later if we need more specific validity checks.
-    cached_data_available = (
-        os.path.exists(country_cache_dir) and len(os.listdir(country_cache_dir)) > 0
+    cached_filenames = (
+        os.listdir(country_cache_dir) if os.path.exists(country_cache_dir) else []
+    )
+    has_partial_download = any(map(is_partial_download, cached_filenames))
+    cached_data_available = any(
+        not is_partial_download(filename) for filename in cached_filenames
     )
 
     logger.info(
@@ -205,8 +410,10 @@ def download_osm_country_data(country, cache_dir, use_cache=True):
             f"OSM Data: Re-initializing OSM country cache dir at {country_cache_dir}..."
         )
 
-        # Re-create the country cache dir and start over to fix any corrupted states
-        shutil.rmtree(country_cache_dir, ignore_errors=True)
+        # Re-create the country cache dir and start over to fix any corrupted states,
+        # unless there is an interrupted download to resume
+        if not use_cache or not has_partial_download:
+            shutil.rmtree(country_cache_dir, ignore_errors=True)
         Path(country_cache_dir).mkdir(parents=True, exist_ok=True)
 
         # This downloads a zip file to the country cache dir
@@ -219,13 +426,13 @@ def download_osm_country_data(country, cache_dir, use_cache=True):
             logger.info(
                 f"Downloading Indonesia OSM data at {DEFAULT_INDONESIA_GEOFABRIK_URL}"
             )
-            zipfile_path = _download_indonesia_geofabrik_region(
+            zipfile_path = _download_geofabrik_region(
                 DEFAULT_INDONESIA_GEOFABRIK_URL, country_cache_dir
             )
 
         else:
-            zipfile_path = geofabrik.download_geofabrik_region(
-                country, country_cache_dir
+            zipfile_path = _download_geofabrik_region(
+                geofabrik.get_osm_download_url(country), country_cache_dir
             )
 
         # Unzip the zip file
@@ -240,20 +447,25 @@ def download_osm_country_data(country, cache_dir, use_cache=True):
             f"OSM Data: Successfully downloaded and cached OSM data for {country} at {country_cache_dir}!"
         )
 
+    # Keep the OSM cache within its size budget, without evicting this country
+    cache = get_cache_manager(cache_dir, max_size=cache_max_size)
+    cache.touch(country_cache_dir)
+    with cache.pin(country_cache_dir):
+        cache.evict()
+
     return country_cache_dir
 
 
-def _download_indonesia_geofabrik_region(
+def _download_geofabrik_region(
     url: str,
     directory: str = "data/",
     overwrite=False,
     show_progress=True,
-    chunksize=8192,
+    chunksize=1024 * 1024,
 ) -> Union[Path, None]:
-    """Download Indonesia geofabrik region to path given specified url.
-    This is meant as an internal workaround in povertmapping for
-    using indonesia in download_osm_country_data().
-    Modified from geowrangler.datasets.geofabrik.download_geofabrik_region()
+    """Download geofabrik region to path given specified url.
+    Modified from geowrangler.datasets.geofabrik.download_geofabrik_region() to use resumable ranged downloads
+    and to allow the Indonesia workaround url in download_osm_country_data().
     """
     if not os.path.isdir(directory):
         os.makedirs(directory)
@@ -265,7 +477,11 @@ def _download_indonesia_geofabrik_region(
 
         try:
             filepath, _, _ = urlretrieve(
-                url, filepath, reporthook=reporthook, chunksize=chunksize
+                url,
+                filepath,
+                reporthook=reporthook,
+                chunksize=chunksize,
+                checksum=_get_geofabrik_md5(url),
             )
         except HTTPError as err:
             if err.code == 404:
@@ -277,6 +493,21 @@ def _download_indonesia_geofabrik_region(
     return filepath
 
 
+def _get_geofabrik_md5(url):
+    """Get the md5 checksum Geofabrik publishes at `{url}.md5`, or None if there is none"""
+    try:
+        response = requests.get(f"{url}.md5", timeout=30)
+    except requests.RequestException as err:
+        logger.warning(f"Could not get the md5 checksum of {url}: {err}")
+        return None
+    # The md5 file holds "<md5>  <filename>"
+    match = response.ok and re.match(r"\s*([0-9a-fA-F]{32})\b", response.text)
+    if not match:
+        logger.debug(f"No md5 checksum published for {url}, it won't be verified")
+        return None
+    return match.group(1)
+
+
 def get_osm_extent(region):
     """Get the polygon extent file of the specifed OSM region"""
     geofabrik_info = geofabrik.list_geofabrik_regions()
@@ -1,84 +1,235 @@
+import array
+import itertools
 import osmium
+import warnings
 import yaml
 import os
 
+import fiona
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
 
+from povertymapping.nightlights import urlretrieve
 from povertymapping.utils.data_utils import get_title_url
 
+# Number of Ookla tiles read at a time by preprocess_ookla
+DEFAULT_OOKLA_CHUNKSIZE = 100_000
+
+
+# Columns of the tag genome, one row per tag of each OSM element
+TAG_GENOME_SCHEMA = pa.schema(
+    [
+        ("type", pa.string()),
+        ("id", pa.int64()),
+        ("ts", pa.timestamp("s", tz="UTC")),
+        ("version", pa.int32()),
+        ("nodes", pa.list_(pa.int64())),
+        ("lat", pa.float64()),
+        ("lon", pa.float64()),
+        ("tagkey", pa.string()),
+        ("tagvalue", pa.string()),
+    ]
+)
+TAG_GENOME_ELEM_TYPES = ["node", "way", "relation"]
+# Number of tag rows buffered by TagGenomeHandler before they are flushed
+DEFAULT_TAG_GENOME_CHUNKSIZE = 1_000_000
+
 
 # let's write a class that parses tags
 # ref: https://oslandia.com/en/2017/07/10/osm-tag-genome-how-are-osm-objects-tagged/
 class TagGenomeHandler(osmium.SimpleHandler):
-    def __init__(self):
+    """Collects the tags of OSM elements into the columns of `TAG_GENOME_SCHEMA`.
+
+    Args:
+        writer: Writer (e.g. a `pyarrow.parquet.ParquetWriter`) the tags are flushed to every `chunksize` tags,
+            if None they are kept in `self.batches`
+        tag_keys: Tag keys to keep, all if None
+    """
+
+    def __init__(
+        self, writer=None, tag_keys=None, chunksize=DEFAULT_TAG_GENOME_CHUNKSIZE
+    ):
         osmium.SimpleHandler.__init__(self)
-        self.taggenome = []
+        self.writer = writer
+        self.tag_keys = None if tag_keys is None else set(tag_keys)
+        self.chunksize = chunksize
+        self.batches = []
+        self._reset_buffers()
 
-    def str_list_way_nodes(self, way):
-        elem_nodes_refs = [x.ref for x in way.nodes]
-        return " ".join(str(x) for x in elem_nodes_refs)
+    def _reset_buffers(self):
+        # Element columns hold one entry per element, tag columns one per tag
+        self.elem_types = array.array("b")
+        self.ids = array.array("q")
+        self.timestamps = array.array("q")
+        self.versions = array.array("i")
+        self.lats = array.array("d")
+        self.lons = array.array("d")
+        self.node_refs = array.array("q")
+        self.node_offsets = array.array("i", [0])
+        self.tag_counts = array.array("q")
+        self.tag_keys_col = []
+        self.tag_values_col = []
 
     def tag_inventory(self, elem, elem_type):
+        if len(elem.tags) == 0:
+            return
+        if self.tag_keys is None:
+            tags = [(tag.k, tag.v) for tag in elem.tags]
+        else:
+            tags = [(tag.k, tag.v) for tag in elem.tags if tag.k in self.tag_keys]
+            if len(tags) == 0:
+                return
+
         lat, lon = -1, -1
-        nodes_str = ""
-        if elem_type == "node":
+        if elem_type == 0:
             lat, lon = elem.location.lat, elem.location.lon
-        elif elem_type == "way":
-            nodes_str = self.str_list_way_nodes(elem)
-
-        for tag in elem.tags:
-            self.taggenome.append(
-                [
-                    elem_type,
-                    elem.id,
-                    pd.Timestamp(elem.timestamp),
-                    elem.version,
-                    nodes_str,
-                    lat,
-                    lon,
-                    tag.k,
-                    tag.v,
-                ]
-            )
+        elif elem_type == 1:
+            self.node_refs.extend([x.ref for x in elem.nodes])
+        self.node_offsets.append(len(self.node_refs))
+
+        self.elem_types.append(elem_type)
+        self.ids.append(elem.id)
+        self.timestamps.append(int(elem.timestamp.timestamp()))
+        self.versions.append(elem.version)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.tag_counts.append(len(tags))
+        for key, value in tags:
+            self.tag_keys_col.append(key)
+            self.tag_values_col.append(value)
+
+        if len(self.tag_keys_col) >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        "Write the buffered tags as a record batch, call once more after `apply_file`"
+        if len(self.tag_keys_col) == 0:
+            return
+        # Repeat the element columns for each of their tags
+        elem_pos = np.repeat(np.arange(len(self.ids)), self.tag_counts)
+        nodes = pa.ListArray.from_arrays(
+            pa.array(np.frombuffer(self.node_offsets, dtype=np.int32)),
+            pa.array(np.frombuffer(self.node_refs, dtype=np.int64)),
+        ).take(pa.array(elem_pos))
+
+        def repeat(buffer, dtype):
+            return np.frombuffer(buffer, dtype=dtype)[elem_pos]
+
+        batch = pa.RecordBatch.from_arrays(
+            [
+                pa.array(TAG_GENOME_ELEM_TYPES).take(
+                    pa.array(repeat(self.elem_types, np.int8))
+                ),
+                pa.array(repeat(self.ids, np.int64)),
+                pa.array(repeat(self.timestamps, np.int64)).cast(
+                    TAG_GENOME_SCHEMA.field("ts").type
+                ),
+                pa.array(repeat(self.versions, np.int32)),
+                nodes,
+                pa.array(repeat(self.lats, np.float64)),
+                pa.array(repeat(self.lons, np.float64)),
+                pa.array(self.tag_keys_col, type=pa.string()),
+                pa.array(self.tag_values_col, type=pa.string()),
+            ],
+            schema=TAG_GENOME_SCHEMA,
+        )
+        if self.writer is None:
+            self.batches.append(batch)
+        else:
+            self.writer.write_batch(batch)
+        self._reset_buffers()
+
+    def to_table(self):
+        "Get the tags collected without a writer as an Arrow table"
+        self.flush()
+        return pa.Table.from_batches(self.batches, schema=TAG_GENOME_SCHEMA)
+
+    @property
+    def taggenome(self):
+        "Deprecated, use `to_table`. Get the tags collected without a writer as rows of the `nodes_str` dataframe"
+        warnings.warn(
+            "TagGenomeHandler.taggenome is deprecated, use TagGenomeHandler.to_table",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        return _with_nodes_str(self.to_table().to_pandas()).values.tolist()
+
+    def str_list_way_nodes(self, way):
+        "Deprecated, the node refs of ways are kept as lists in the `nodes` column"
+        warnings.warn(
+            "TagGenomeHandler.str_list_way_nodes is deprecated, the node refs are kept in the nodes column",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        return " ".join(str(x.ref) for x in way.nodes)
 
     def node(self, n):
-        self.tag_inventory(n, "node")
+        self.tag_inventory(n, 0)
 
     def way(self, w):
-        self.tag_inventory(w, "way")
+        self.tag_inventory(w, 1)
 
     def relation(self, r):
-        self.tag_inventory(r, "relation")
+        self.tag_inventory(r, 2)
 
 
-def preprocess_osm_pbf(config, cluster_id):
-    """Preprocess osm pbf file into dataframe"""
+def _with_nodes_str(tag_genome):
+    "Replace the `nodes` list column of a tag genome dataframe by the node refs joined in a `nodes_str` column"
+    tag_genome.insert(
+        4,
+        "nodes_str",
+        [" ".join(map(str, nodes)) for nodes in tag_genome.pop("nodes")],
+    )
+    return tag_genome
+
+
+def preprocess_osm_pbf(config, cluster_id, tag_keys=None, return_df=False):
+    """Preprocess osm pbf file into a tag genome parquet file `{country}_{cluster_id}_tag_genome.parquet`
+    in config "save_path", with the node refs of ways in a `nodes` list column
+
+    Args:
+        tag_keys: Tag keys to keep, defaults to config "osm_tag_keys" or all tag keys
+        return_df: If True, return the tag genome as a dataframe with the node refs joined
+            in a `nodes_str` column as before, which loads it all in memory. Otherwise return the parquet file path
+    """
     # extract some osm config params
     country = config["osm_country"]
+    if tag_keys is None:
+        tag_keys = config.get("osm_tag_keys")
 
-    taghandler = TagGenomeHandler()
     cluster_filename = f"{country}_{cluster_id}.osm.pbf"
     pbf_filepath = os.path.join(config["save_path"], cluster_filename)
-    taghandler.apply_file(pbf_filepath)
+    tag_genome_filepath = os.path.join(
+        config["save_path"], f"{country}_{cluster_id}_tag_genome.parquet"
+    )
+    with pq.ParquetWriter(tag_genome_filepath, TAG_GENOME_SCHEMA) as writer:
+        taghandler = TagGenomeHandler(
+            writer,
+            tag_keys=tag_keys,
+            chunksize=config.get("tag_genome_chunksize", DEFAULT_TAG_GENOME_CHUNKSIZE),
+        )
+        taghandler.apply_file(pbf_filepath)
+        taghandler.flush()
 
-    colnames = [
-        "type",
-        "id",
-        "ts",
-        "version",
-        "nodes_str",
-        "lat",
-        "lon",
-        "tagkey",
-        "tagvalue",
+    if not return_df:
+        return tag_genome_filepath
+    # Join the node refs batch by batch to avoid holding all the node lists in memory
+    parquet_file = pq.ParquetFile(tag_genome_filepath)
+    tag_genome = [
+        _with_nodes_str(batch.to_pandas()) for batch in parquet_file.iter_batches()
     ]
-    tag_genome = pd.DataFrame(taghandler.taggenome, columns=colnames)
-
-    return tag_genome
+    if len(tag_genome) == 0:
+        return _with_nodes_str(parquet_file.schema_arrow.empty_table().to_pandas())
+    return pd.concat(tag_genome, ignore_index=True)
 
 
 def preprocess_ookla(config):
+    """Extract the Ookla tiles intersecting the country boundaries, joined with the boundaries they intersect,
+    into a GeoJSON file, reading the tiles in the country bbox in chunks of config "ookla_chunksize" tiles"""
 
     repo_path = config["repo_path"]
     crs = config["crs"]
@@ -88,22 +239,52 @@ def preprocess_ookla(config):
     hdx_folder = config["hdx_folder"]
     hdx_data_path = os.path.join(repo_path, config["data_dir"], hdx_folder)
     boundary_file = config["boundary_file"]  # make this more generic
+    chunksize = config.get("ookla_chunksize", DEFAULT_OOKLA_CHUNKSIZE)
 
-    print("Downloading from s3 bucket...")
+    logger.info("Downloading from s3 bucket...")
     ookla_s3_download_url = get_title_url("fixed", year, quarter)
-    tiles = gpd.read_file(ookla_s3_download_url).to_crs(
-        crs
+    ookla_zip_path = os.path.join(
+        repo_path, config["data_dir"], os.path.basename(ookla_s3_download_url)
     )
+    if not os.path.exists(ookla_zip_path):
+        urlretrieve(ookla_s3_download_url, ookla_zip_path)
+
     boundary_file_path = os.path.join(hdx_data_path, boundary_file)
-    country_boundaries = gpd.read_file(boundary_file_path).to_crs(crs)
-    tiles_in_country = gpd.sjoin(
-        tiles, country_boundaries, how="inner", predicate="intersects"
-    ).to_crs(crs)
+    country_boundaries = gpd.read_file(boundary_file_path)
+
+    chunks = []
+    with fiona.open(f"zip://{ookla_zip_path}") as tiles_src:
+        tiles_crs = tiles_src.crs
+        tiles_columns = list(tiles_src.schema["properties"])
+        country_boundaries = country_boundaries.to_crs(tiles_crs)
+        # Build the spatial index of the boundaries once for all chunks
+        country_boundaries.sindex
+        tiles_iter = tiles_src.filter(bbox=tuple(country_boundaries.total_bounds))
+        while True:
+            features = list(itertools.islice(tiles_iter, chunksize))
+            if len(features) == 0:
+                break
+            tiles = gpd.GeoDataFrame.from_features(features, crs=tiles_crs)
+            chunks.append(
+                gpd.sjoin(
+                    tiles, country_boundaries, how="inner", predicate="intersects"
+                )
+            )
+            logger.info(f"Read {sum(len(chunk) for chunk in chunks)} tiles in country...")
+
+    if len(chunks) == 0:
+        chunks = [
+            gpd.sjoin(
+                gpd.GeoDataFrame(columns=tiles_columns, geometry=[], crs=tiles_crs),
+                country_boundaries,
+                how="inner",
+                predicate="intersects",
+            )
+        ]
+    tiles_in_country = pd.concat(chunks, ignore_index=True).to_crs(crs)
 
     # save geojson file
     merged_file_path = os.path.join(
         config["data_dir"], f"{country}_{year}_{quarter}_ookla.geojson"
     )
     tiles_in_country.to_file(merged_file_path, driver="GeoJSON")
-
-
@@ -0,0 +1,134 @@
+import os
+
+import numpy as np
+import shapely
+
+DEFAULT_NODE_SIZE = 16
+# Number of query geometries processed at a time, to bound the memory of candidate pairs
+DEFAULT_QUERY_CHUNKSIZE = 10000
+
+
+class PackedRTree:
+    """A static R-tree packed bottom-up from the bounds of (ideally spatially sorted) features,
+    which can be saved and loaded as a handful of numpy arrays.
+    """
+
+    def __init__(self, levels, node_size=DEFAULT_NODE_SIZE, fingerprint=None):
+        # levels[0] holds the (n, 4) feature bounds, each next level the bounds
+        # of the nodes grouping `node_size` items of the previous level
+        self.levels = levels
+        self.node_size = node_size
+        # Identifies the version of the indexed data, saved with the tree
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    @classmethod
+    def from_bounds(cls, bounds, node_size=DEFAULT_NODE_SIZE, fingerprint=None):
+        "Build the tree from the (n, 4) `minx, miny, maxx, maxy` bounds of the features"
+        levels = [np.asarray(bounds, dtype=np.float64).reshape(-1, 4)]
+        while len(levels[-1]) > node_size:
+            child_bounds = levels[-1]
+            starts = np.arange(0, len(child_bounds), node_size)
+            # fmin/fmax ignore the NaN bounds of empty geometries
+            levels.append(
+                np.column_stack(
+                    [
+                        np.fmin.reduceat(child_bounds[:, 0], starts),
+                        np.fmin.reduceat(child_bounds[:, 1], starts),
+                        np.fmax.reduceat(child_bounds[:, 2], starts),
+                        np.fmax.reduceat(child_bounds[:, 3], starts),
+                    ]
+                )
+            )
+        return cls(levels, node_size, fingerprint)
+
+    @classmethod
+    def from_geometries(cls, geometries, node_size=DEFAULT_NODE_SIZE, fingerprint=None):
+        return cls.from_bounds(
+            shapely.bounds(np.asarray(geometries)), node_size, fingerprint
+        )
+
+    def save(self, path):
+        # Write to a temp file first so readers never see a partially written index
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            node_size=self.node_size,
+            **({} if self.fingerprint is None else {"fingerprint": self.fingerprint}),
+            **{f"level_{i}": level for i, level in enumerate(self.levels)},
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as index_file:
+            n_levels = len(
+                [key for key in index_file.files if key.startswith("level_")]
+            )
+            levels = [index_file[f"level_{i}"] for i in range(n_levels)]
+            fingerprint = (
+                str(index_file["fingerprint"])
+                if "fingerprint" in index_file.files
+                else None
+            )
+            return cls(levels, int(index_file["node_size"]), fingerprint)
+
+    def query_bounds(self, bounds):
+        """Get the `(query_positions, feature_positions)` of the features whose bounds
+        overlap the (n, 4) query `bounds`, sorted by query position."""
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        top_level = self.levels[-1]
+        query_pos = np.repeat(np.arange(len(bounds)), len(top_level))
+        node_pos = np.tile(np.arange(len(top_level)), len(bounds))
+        for level in range(len(self.levels) - 1, -1, -1):
+            if level < len(self.levels) - 1:
+                # Descend into the children of the matching nodes
+                n_children = len(self.levels[level])
+                counts = np.minimum(
+                    self.node_size, n_children - node_pos * self.node_size
+                )
+                offsets = np.arange(counts.sum()) - np.repeat(
+                    np.cumsum(counts) - counts, counts
+                )
+                query_pos = np.repeat(query_pos, counts)
+                node_pos = np.repeat(node_pos * self.node_size, counts) + offsets
+            node_bounds = self.levels[level][node_pos]
+            query_bounds = bounds[query_pos]
+            overlaps = (
+                (node_bounds[:, 0] <= query_bounds[:, 2])
+                & (node_bounds[:, 2] >= query_bounds[:, 0])
+                & (node_bounds[:, 1] <= query_bounds[:, 3])
+                & (node_bounds[:, 3] >= query_bounds[:, 1])
+            )
+            query_pos, node_pos = query_pos[overlaps], node_pos[overlaps]
+        return query_pos, node_pos
+
+    def query(
+        self,
+        geometries,
+        tree_geometries,
+        predicate=None,
+        chunksize=DEFAULT_QUERY_CHUNKSIZE,
+    ):
+        """Get the `(query_positions, feature_positions)` pairs of `geometries` and tree features with overlapping bounds,
+        like `shapely.STRtree.query`, keeping those for which `shapely.{predicate}(geometry, feature)` holds if set.
+        `tree_geometries` are the feature geometries the tree was built from.
+        """
+        geometries = np.asarray(geometries)
+        tree_geometries = np.asarray(tree_geometries)
+        query_pos_chunks, feature_pos_chunks = [], []
+        for start in range(0, len(geometries), chunksize):
+            chunk = geometries[start : start + chunksize]
+            query_pos, feature_pos = self.query_bounds(shapely.bounds(chunk))
+            if predicate is not None:
+                keep = getattr(shapely, predicate)(
+                    chunk[query_pos], tree_geometries[feature_pos]
+                )
+                query_pos, feature_pos = query_pos[keep], feature_pos[keep]
+            query_pos_chunks.append(query_pos + start)
+            feature_pos_chunks.append(feature_pos)
+        if len(query_pos_chunks) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.concatenate(query_pos_chunks), np.concatenate(feature_pos_chunks)
@@ -0,0 +1,109 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from povertymapping.cache import (
+    CacheManager,
+    MemoryCache,
+    get_cache_manager,
+    parse_size,
+)
+from povertymapping.nightlights import get_nightlights_cache
+
+
+def make_cache_file(path, size, mtime):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"0" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_parse_size():
+    assert parse_size(None) is None
+    assert parse_size(1024) == 1024
+    assert parse_size("500MB") == 500_000_000
+    assert parse_size("1.5 gb") == 1_500_000_000
+
+
+def test_evict_least_recently_used(tmp_path):
+    now = time.time()
+    oldest = make_cache_file(tmp_path / "clip" / "a.tif", 100, now - 300)
+    make_cache_file(tmp_path / "clip" / "a.metadata.json", 10, now - 300)
+    middle = make_cache_file(tmp_path / "clip" / "b.tif", 100, now - 200)
+    newest = make_cache_file(tmp_path / "global" / "c.tif", 100, now - 100)
+    cache = CacheManager(tmp_path, ["global", "clip"], max_size=250)
+
+    # accessing the oldest entry makes it the most recently used one
+    cache.touch(oldest)
+    evicted = cache.evict()
+
+    assert evicted == ["clip/b"]
+    assert oldest.exists() and newest.exists() and not middle.exists()
+
+
+def test_evict_skips_pinned_entries(tmp_path, mocker):
+    now = time.time()
+    oldest = make_cache_file(tmp_path / "hrsl" / "a.tif", 100, now - 200)
+    newest = make_cache_file(tmp_path / "hrsl" / "b.tif", 100, now - 100)
+    cache = CacheManager(tmp_path, ["hrsl"], max_size=100)
+    mocker.spy(cache, "_locked")
+
+    with cache.pin(oldest):
+        assert cache.evict() == ["hrsl/b"]
+        # pins are written under the same lock as evictions
+        assert cache._locked.call_count == 2
+
+    assert oldest.exists() and not newest.exists()
+
+
+def test_in_flight_downloads_share_the_entry_key(tmp_path):
+    now = time.time()
+    final_file = tmp_path / "global" / "a.dat.tif"
+    part = make_cache_file(tmp_path / "global" / "a.dat.tif.gz.part", 100, now - 200)
+    journal = make_cache_file(
+        tmp_path / "global" / "a.dat.tif.gz.part.json", 10, now - 200
+    )
+    journal_tmp = make_cache_file(
+        tmp_path / "global" / "a.dat.tif.gz.part.json.tmp", 10, now - 200
+    )
+    make_cache_file(tmp_path / "global" / "b.tif", 100, now - 100)
+    cache = CacheManager(tmp_path, ["global"], max_size=100)
+
+    paths = [final_file, part, journal, journal_tmp]
+    assert {cache.entry_key(path) for path in paths} == {"global/a.dat"}
+    with cache.pin(final_file):
+        assert cache.evict() == ["global/b"]
+
+    assert part.exists() and journal.exists()
+
+
+def test_module_caches_share_one_budget(tmp_path):
+    now = time.time()
+    oldest = make_cache_file(tmp_path / "osm" / "philippines" / "a.shp", 100, now - 300)
+    os.utime(oldest.parent, (now - 300, now - 300))
+    middle = make_cache_file(tmp_path / "hrsl" / "phl.tif", 100, now - 200)
+    newest = make_cache_file(
+        tmp_path / "nightlights" / "clip" / "c.tif", 100, now - 100
+    )
+
+    cache = get_nightlights_cache(tmp_path / "nightlights", max_size=150)
+    assert cache.evict() == ["osm/philippines", "hrsl/phl"]
+
+    assert not oldest.exists() and not middle.exists() and newest.exists()
+    assert get_cache_manager(tmp_path).size() == 100
+
+
+def test_memory_cache_drops_least_recently_used():
+    frames = {key: pd.DataFrame(dict(x=np.arange(100, dtype="int64"))) for key in "abc"}
+    cache = MemoryCache(max_size=2000)
+
+    cache["a"] = frames["a"]
+    cache["b"] = frames["b"]
+    # reading "a" makes "b" the least recently used item
+    assert cache.get("a") is frames["a"]
+    cache["c"] = frames["c"]
+
+    assert "a" in cache and "c" in cache and "b" not in cache
+    assert cache.size() <= 2000
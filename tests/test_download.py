@@ -0,0 +1,192 @@
+import hashlib
+import io
+import json
+import re
+from email.message import Message
+from urllib.error import ContentTooShortError, HTTPError
+
+import pytest
+
+from povertymapping.download import DownloadAuthError, ranged_urlretrieve
+
+CONTENT = bytes(range(256)) * 40
+
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, content, status, headers):
+        super().__init__(content)
+        self.status = status
+        self.headers = Message()
+        for k, v in headers.items():
+            self.headers[k] = v
+
+    def info(self):
+        return self.headers
+
+
+def make_fake_urlopen(content=CONTENT, accept_ranges=True, requests=None, etag=None):
+    def fake_urlopen(url, data=None, headers=None, timeout=None):
+        range_header = (headers or {}).get("Range")
+        if requests is not None:
+            requests.append(range_header)
+        if accept_ranges and range_header is not None:
+            start, end = map(
+                int, re.fullmatch(r"bytes=(\d+)-(\d+)", range_header).groups()
+            )
+            headers = {"Content-Range": f"bytes {start}-{end}/{len(content)}"}
+            if etag is not None:
+                headers["ETag"] = etag
+            return FakeResponse(content[start : end + 1], 206, headers)
+        return FakeResponse(content, 200, {"Content-Length": str(len(content))})
+
+    return fake_urlopen
+
+
+def test_ranged_urlretrieve(tmp_path, mocker):
+    requests = []
+    mocker.patch(
+        "povertymapping.download.urlopen",
+        side_effect=make_fake_urlopen(requests=requests),
+    )
+    dest = tmp_path / "file.bin"
+
+    filename, _, _ = ranged_urlretrieve(
+        "https://example.com/file.bin",
+        dest,
+        part_size=1000,
+        n_connections=3,
+        checksum=hashlib.md5(CONTENT).hexdigest(),
+    )
+
+    assert filename == dest
+    assert dest.read_bytes() == CONTENT
+    # probe + 11 parts
+    assert len(requests) == 12
+    assert not (tmp_path / "file.bin.part").exists()
+    assert not (tmp_path / "file.bin.part.json").exists()
+
+
+def test_ranged_urlretrieve_resumes(tmp_path, mocker):
+    requests = []
+    mocker.patch(
+        "povertymapping.download.urlopen",
+        side_effect=make_fake_urlopen(requests=requests, etag='"v1"'),
+    )
+    dest = tmp_path / "file.bin"
+    # the first 2 parts were downloaded by an interrupted run
+    part = bytearray(len(CONTENT))
+    part[:2000] = CONTENT[:2000]
+    (tmp_path / "file.bin.part").write_bytes(bytes(part))
+    journal = dict(
+        url="https://example.com/file.bin",
+        size=len(CONTENT),
+        part_size=1000,
+        version='"v1"',
+        done=[0, 1],
+        written=2000,
+    )
+    (tmp_path / "file.bin.part.json").write_text(json.dumps(journal))
+
+    ranged_urlretrieve("https://example.com/file.bin", dest, part_size=1000)
+
+    assert dest.read_bytes() == CONTENT
+    assert "bytes=0-999" not in requests and "bytes=1000-1999" not in requests
+    assert "bytes=2000-2999" in requests
+
+
+def test_ranged_urlretrieve_restarts_when_the_remote_file_changed(tmp_path, mocker):
+    requests = []
+    mocker.patch(
+        "povertymapping.download.urlopen",
+        side_effect=make_fake_urlopen(requests=requests, etag='"v2"'),
+    )
+    dest = tmp_path / "file.bin"
+    (tmp_path / "file.bin.part").write_bytes(bytes(len(CONTENT)))
+    journal = dict(
+        url="https://example.com/file.bin",
+        size=len(CONTENT),
+        part_size=1000,
+        version='"v1"',
+        done=[0, 1],
+        written=2000,
+    )
+    (tmp_path / "file.bin.part.json").write_text(json.dumps(journal))
+
+    ranged_urlretrieve("https://example.com/file.bin", dest, part_size=1000)
+
+    assert dest.read_bytes() == CONTENT
+    assert "bytes=0-999" in requests
+
+
+def test_ranged_urlretrieve_checks_the_written_bytes(tmp_path, mocker):
+    mocker.patch(
+        "povertymapping.download.urlopen",
+        side_effect=make_fake_urlopen(),
+    )
+    dest = tmp_path / "file.bin"
+    # a journal claiming every part is done, without the matching byte count
+    (tmp_path / "file.bin.part").write_bytes(bytes(len(CONTENT)))
+    journal = dict(
+        url="https://example.com/file.bin",
+        size=len(CONTENT),
+        part_size=1000,
+        version=None,
+        done=list(range(11)),
+        written=5000,
+    )
+    (tmp_path / "file.bin.part.json").write_text(json.dumps(journal))
+
+    with pytest.raises(ContentTooShortError):
+        ranged_urlretrieve(
+            "https://example.com/file.bin", dest, part_size=1000, max_retries=0
+        )
+    assert not (tmp_path / "file.bin.part").exists()
+    assert not (tmp_path / "file.bin.part.json").exists()
+
+
+def test_ranged_urlretrieve_without_range_support(tmp_path, mocker):
+    mocker.patch(
+        "povertymapping.download.urlopen",
+        side_effect=make_fake_urlopen(accept_ranges=False),
+    )
+    dest = tmp_path / "file.bin"
+
+    ranged_urlretrieve("https://example.com/file.bin", dest, part_size=1000)
+    assert dest.read_bytes() == CONTENT
+
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        ranged_urlretrieve(
+            "https://example.com/file.bin", dest, checksum="0" * 32, max_retries=0
+        )
+
+
+def test_ranged_urlretrieve_stops_when_the_credentials_are_rejected(tmp_path, mocker):
+    fake_urlopen = make_fake_urlopen(etag='"v1"')
+
+    def expiring_urlopen(url, data=None, headers=None, timeout=None):
+        # the access token expires after the first 2 parts
+        start = int(re.match(r"bytes=(\d+)-", headers["Range"]).group(1))
+        if start >= 2000:
+            raise HTTPError(url, 401, "Unauthorized", Message(), None)
+        return fake_urlopen(url, data=data, headers=headers, timeout=timeout)
+
+    mocker.patch("povertymapping.download.urlopen", side_effect=expiring_urlopen)
+    dest = tmp_path / "file.bin"
+
+    with pytest.raises(DownloadAuthError):
+        ranged_urlretrieve(
+            "https://example.com/file.bin", dest, part_size=1000, n_connections=1
+        )
+
+    journal = json.loads((tmp_path / "file.bin.part.json").read_text())
+    assert sorted(journal["done"]) == [0, 1]
+
+    requests = []
+    mocker.patch(
+        "povertymapping.download.urlopen",
+        side_effect=make_fake_urlopen(requests=requests, etag='"v1"'),
+    )
+    ranged_urlretrieve("https://example.com/file.bin", dest, part_size=1000)
+
+    assert dest.read_bytes() == CONTENT
+    assert "bytes=0-999" not in requests and "bytes=2000-2999" in requests
@@ -0,0 +1,408 @@
+import base64
+import json
+import re
+import time
+from email.message import Message
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+from povertymapping.download import ranged_urlretrieve
+from povertymapping.nightlights import (
+    EOG_ENV_VAR,
+    EOG_LISTING_TTL,
+    EOG_PASSWORD_ENV_VAR,
+    EOG_USERNAME_ENV_VAR,
+    compute_stacked_zonal_stats,
+    compute_tile_zonal_stats,
+    compute_trend_slope,
+    download_url,
+    generate_monthly_nightlights_feature,
+    generate_nightlights_feature,
+    generate_nightlights_multitype_feature,
+    get_aoi_clusters,
+    generate_nightlights_timeseries_feature,
+    get_cached_eog_access_token,
+    get_eog_access_token,
+    is_tile_aligned,
+    make_monthly_url,
+    _list_eog_directory,
+)
+
+
+def write_raster(path, data, transform, nodata=-999):
+    with rio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=data.shape[0],
+        width=data.shape[1],
+        count=1,
+        dtype=data.dtype,
+        crs="epsg:4326",
+        transform=transform,
+        nodata=nodata,
+    ) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def make_aoi():
+    return gpd.GeoDataFrame(
+        dict(tile_id=[0, 1]),
+        geometry=[box(0, 2, 2, 4), box(2, 0, 4, 2)],
+        crs="epsg:4326",
+    )
+
+
+def test_compute_stacked_zonal_stats():
+    transform = from_origin(0, 4, 1, 1)
+    layer = np.arange(16, dtype=np.float64).reshape(4, 4)
+    layer[0, 0] = -999
+    stack = np.stack([layer, layer * 2])
+
+    results = compute_stacked_zonal_stats(
+        make_aoi().geometry.values, stack, transform, ["min", "max", "mean", "count"]
+    )
+
+    assert results.shape == (2, 2, 4)
+    np.testing.assert_allclose(results[0, 0], [1, 5, 10 / 3, 3])
+    np.testing.assert_allclose(results[1, 1], [2 * 10, 2 * 15, 2 * 12.5, 4])
+
+
+def test_compute_tile_zonal_stats_matches_geometry_zonal_stats():
+    rng = np.random.default_rng(42)
+    transform = from_origin(0, 10, 0.25, 0.25)
+    stack = rng.gamma(1, 2, (2, 40, 40))
+    stack[rng.random(stack.shape) < 0.1] = -999
+    tiles = [box(x, y, x + 0.8, y + 0.6) for x in range(9) for y in range(9)]
+    funcs = ["min", "max", "mean", "median", "std", "sum", "count"]
+
+    assert is_tile_aligned(tiles, transform)
+    assert not is_tile_aligned([box(0, 0, 1, 1).buffer(0.1)], transform)
+
+    for all_touched in [False, True]:
+        # the extra non-rectangular geometry forces the per-geometry path
+        expected = compute_stacked_zonal_stats(
+            tiles + [tiles[0].buffer(1e-9)],
+            stack,
+            transform,
+            funcs,
+            all_touched=all_touched,
+        )[:-1]
+        bounds = np.array([tile.bounds for tile in tiles])
+        results = compute_tile_zonal_stats(
+            bounds, stack, transform, funcs, all_touched=all_touched, max_pixels=50
+        )
+        np.testing.assert_allclose(results, expected)
+
+
+def test_compute_trend_slope():
+    values = np.array([[1.0, 2.0, 3.0], [np.nan, 4.0, 2.0], [np.nan, np.nan, 1.0]])
+    slope = compute_trend_slope(values, [2019, 2020, 2021])
+    np.testing.assert_allclose(slope[:2], [1.0, -2.0])
+    assert np.isnan(slope[2])
+
+
+def test_generate_nightlights_timeseries_feature(tmpdir, mocker):
+    transform = from_origin(0, 4, 1, 1)
+    rasters = {
+        year: write_raster(
+            str(tmpdir / f"{year}.tif"),
+            np.full((4, 4), float(i + 1), dtype=np.float32),
+            transform,
+        )
+        for i, year in enumerate([2019, 2020, 2021])
+    }
+    mocker.patch(
+        "povertymapping.nightlights.get_clipped_raster",
+        side_effect=lambda year, *args, **kwargs: rasters[year],
+    )
+
+    aoi = generate_nightlights_timeseries_feature(
+        make_aoi(), [2021, 2019, 2020], func=["mean"], cache_dir=str(tmpdir)
+    )
+
+    assert list(aoi["avg_rad_2019_mean"]) == [1.0, 1.0]
+    assert list(aoi["avg_rad_2021_mean"]) == [3.0, 3.0]
+    np.testing.assert_allclose(aoi["avg_rad_mean_slope"], [1.0, 1.0])
+    np.testing.assert_allclose(aoi["avg_rad_mean_change"], [2.0, 2.0])
+
+    # the trend of a func that is not requested adds no yearly columns
+    aoi = generate_nightlights_timeseries_feature(
+        make_aoi(), [2019, 2021], func=["max"], trend_func="min", cache_dir=str(tmpdir)
+    )
+    assert [col for col in aoi.columns if col.startswith("avg_rad_")] == [
+        "avg_rad_2019_max",
+        "avg_rad_2021_max",
+        "avg_rad_min_slope",
+        "avg_rad_min_change",
+    ]
+    np.testing.assert_allclose(aoi["avg_rad_min_change"], [2.0, 2.0])
+
+
+def make_jwt(expiry):
+    payload = base64.urlsafe_b64encode(json.dumps(dict(exp=expiry)).encode())
+    return f"header.{payload.decode().rstrip('=')}.signature"
+
+
+def test_get_eog_access_token_reuses_valid_saved_token(tmpdir, mocker, monkeypatch):
+    monkeypatch.setenv(EOG_ENV_VAR, "")
+    api_call = mocker.patch(
+        "povertymapping.nightlights._get_eog_access_token_from_api",
+        return_value=make_jwt(time.time() + 3600),
+    )
+    save_path = tmpdir / "eog_access_token.txt"
+
+    first = get_eog_access_token("user", "pass", save_token=True, save_path=save_path)
+    second = get_eog_access_token("user", "pass", save_token=True, save_path=save_path)
+
+    assert first == second
+    assert api_call.call_count == 1
+
+
+def test_get_eog_access_token_refreshes_expired_token(tmpdir, mocker, monkeypatch):
+    save_path = tmpdir / "eog_access_token.txt"
+    save_path.write(make_jwt(time.time() - 60))
+    monkeypatch.setenv(EOG_ENV_VAR, "")
+    new_token = make_jwt(time.time() + 3600)
+    mocker.patch(
+        "povertymapping.nightlights._get_eog_access_token_from_api",
+        return_value=new_token,
+    )
+
+    assert get_cached_eog_access_token(creds_file=save_path) is None
+    assert get_eog_access_token("user", "pass", save_path=save_path) == new_token
+
+
+def test_download_url_refreshes_the_token_partway_through(tmpdir, mocker, monkeypatch):
+    content = bytes(range(256)) * 20
+    old_token = make_jwt(time.time() + 3600)
+    new_token = make_jwt(time.time() + 7200)
+    monkeypatch.setenv(EOG_ENV_VAR, old_token)
+    monkeypatch.setenv(EOG_USERNAME_ENV_VAR, "user")
+    monkeypatch.setenv(EOG_PASSWORD_ENV_VAR, "pass")
+    api_call = mocker.patch(
+        "povertymapping.nightlights._get_eog_access_token_from_api",
+        return_value=new_token,
+    )
+    requests = []
+
+    def fake_urlopen(url, data=None, headers=None, timeout=None):
+        start, end = map(
+            int, re.fullmatch(r"bytes=(\d+)-(\d+)", headers["Range"]).groups()
+        )
+        requests.append((headers["Authorization"], start))
+        response_headers = Message()
+        if headers["Authorization"] == f"Bearer {old_token}" and start >= 2000:
+            # EOG redirects to its login page once the token is rejected
+            response_headers["Cache-Control"] = "no-cache, must-revalidate"
+            response = BytesIO(b"<html>login</html>")
+            response.status = 200
+        else:
+            response_headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+            response = BytesIO(content[start : end + 1])
+            response.status = 206
+        response.info = lambda: response_headers
+        return response
+
+    mocker.patch("povertymapping.download.urlopen", side_effect=fake_urlopen)
+    mocker.patch(
+        "povertymapping.nightlights.ranged_urlretrieve",
+        partial(ranged_urlretrieve, part_size=1000),
+    )
+    dest = Path(tmpdir) / "file.bin"
+
+    download_url(
+        "https://example.com/file.bin",
+        dest,
+        show_progress=False,
+        n_connections=1,
+        creds_file=Path(tmpdir) / "eog_access_token.txt",
+    )
+
+    assert dest.read_bytes() == content
+    assert api_call.call_count == 1
+    # the parts downloaded with the old token are not downloaded again
+    assert (f"Bearer {new_token}", 1000) not in requests
+    assert (f"Bearer {new_token}", 2000) in requests
+
+
+def test_get_eog_access_token_is_cached_per_user(tmpdir, mocker, monkeypatch):
+    monkeypatch.setenv(EOG_ENV_VAR, "")
+    tokens = {
+        "user": make_jwt(time.time() + 3600),
+        "other": make_jwt(time.time() + 7200),
+    }
+    api_call = mocker.patch(
+        "povertymapping.nightlights._get_eog_access_token_from_api",
+        side_effect=lambda username, password: tokens[username],
+    )
+    save_path = tmpdir / "eog_access_token.txt"
+
+    get_eog_access_token("user", "pass", save_token=True, save_path=save_path)
+    other = get_eog_access_token("other", "pass", save_token=True, save_path=save_path)
+
+    assert other == tokens["other"]
+    assert api_call.call_count == 2
+    assert get_cached_eog_access_token(creds_file=save_path, username="user") is None
+    assert (
+        get_cached_eog_access_token(creds_file=save_path, username="other")
+        == tokens["other"]
+    )
+
+
+def test_generate_nightlights_multitype_feature_with_lit_mask(tmpdir, mocker):
+    transform = from_origin(0, 4, 1, 1)
+    lit = np.zeros((4, 4), dtype=np.float32)
+    lit[:, :2] = 1
+    layers = {
+        "average": np.arange(16, dtype=np.float32).reshape(4, 4),
+        "median_masked": np.full((4, 4), 5.0, dtype=np.float32),
+        "lit_mask": lit,
+    }
+    rasters = {
+        data_type: write_raster(str(tmpdir / f"{data_type}.tif"), layer, transform)
+        for data_type, layer in layers.items()
+    }
+    mocker.patch(
+        "povertymapping.nightlights.get_clipped_raster",
+        side_effect=lambda year, bounds, viirs_data_type, **kwargs: rasters[
+            viirs_data_type
+        ],
+    )
+
+    aoi = generate_nightlights_multitype_feature(
+        make_aoi(),
+        2021,
+        viirs_data_types=["average", "median_masked"],
+        func=["mean", "count"],
+        lit_mask=True,
+        cache_dir=str(tmpdir),
+    )
+
+    assert aoi["avg_rad_mean"][0] == 2.5
+    assert np.isnan(aoi["avg_rad_mean"][1])
+    assert list(aoi["avg_rad_count"]) == [4, 0]
+    assert list(aoi["median_masked_count"]) == [4, 0]
+    assert "lit_mask_mean" not in aoi.columns
+
+
+def test_get_aoi_clusters():
+    aoi = gpd.GeoDataFrame(
+        geometry=[
+            box(120.0, 14.0, 120.1, 14.1),
+            box(125.0, 7.0, 125.1, 7.1),
+            box(120.1, 14.0, 120.2, 14.1),
+            box(121.5, 14.0, 121.6, 14.1),
+        ],
+        crs="epsg:4326",
+    )
+
+    # zoom 8 tiles are ~1.4 degrees wide so the first, third and fourth boxes touch
+    labels = get_aoi_clusters(aoi, 8)
+
+    assert labels[0] == labels[2] == labels[3]
+    assert labels[1] != labels[0]
+
+
+def test_generate_nightlights_feature_per_cluster(tmpdir, mocker):
+    get_clipped_raster = mocker.patch(
+        "povertymapping.nightlights.get_clipped_raster",
+        return_value=Path(
+            write_raster(
+                str(tmpdir / "clip.tif"),
+                np.arange(16, dtype=np.float32).reshape(4, 4),
+                from_origin(0, 4, 1, 1),
+            )
+        ),
+    )
+    aoi = make_aoi()
+    aoi.index = [10, 20]
+
+    result = generate_nightlights_feature(
+        aoi, 2021, func=["mean"], cache_dir=str(tmpdir), cluster_zoom=1
+    )
+
+    assert get_clipped_raster.call_count == 1
+    assert list(result.index) == [10, 20]
+    assert list(result["avg_rad_mean"]) == [2.5, 12.5]
+
+
+def test_make_monthly_url(mocker):
+    listing = """
+    <a href="SVDNB_npp_20220101-20220131_global_vcmslcfg_v10_c202202012200.avg_rade9h.tif">
+    <a href="SVDNB_npp_20220101-20220131_global_vcmslcfg_v10_c202202012200.cf_cvg.tif">
+    """
+    mocker.patch("povertymapping.nightlights._list_eog_directory", return_value=listing)
+
+    url = make_monthly_url(2022, 1, viirs_data_type="cf_cvg")
+
+    assert url.endswith("/v10/2022/202201/vcmslcfg/" + listing.split('"')[3])
+
+
+def test_eog_directory_listing_expires(mocker):
+    mocker.patch.dict("povertymapping.nightlights._eog_listings", clear=True)
+    clock = mocker.patch("povertymapping.nightlights.time")
+    clock.monotonic.return_value = 0
+    get = mocker.patch(
+        "povertymapping.nightlights.requests.get",
+        return_value=mocker.Mock(status_code=200, text="listing"),
+    )
+    dir_url = "https://example.com/v10/2022/202201/vcmslcfg/"
+
+    assert _list_eog_directory(dir_url) == "listing"
+    clock.monotonic.return_value = EOG_LISTING_TTL - 1
+    _list_eog_directory(dir_url)
+    assert get.call_count == 1
+
+    clock.monotonic.return_value = EOG_LISTING_TTL + 1
+    _list_eog_directory(dir_url)
+    assert get.call_count == 2
+
+
+def test_generate_monthly_nightlights_feature(tmpdir, mocker):
+    transform = from_origin(0, 4, 1, 1)
+    rasters = {}
+    for month in [1, 2, 3]:
+        cf_cvg = np.full((4, 4), float(month), dtype=np.float32)
+        # no cloud free observations for the second tile in March
+        if month == 3:
+            cf_cvg[2:, 2:] = 0
+        for data_type, layer in [
+            ("avg_rade9h", np.full((4, 4), month * 10.0, dtype=np.float32)),
+            ("cf_cvg", cf_cvg),
+        ]:
+            rasters[month, data_type] = write_raster(
+                str(tmpdir / f"{month}_{data_type}.tif"), layer, transform
+            )
+    mocker.patch(
+        "povertymapping.nightlights.get_clipped_monthly_raster",
+        side_effect=lambda year, month, bounds, viirs_data_type, **kwargs: rasters[
+            month, viirs_data_type
+        ],
+    )
+
+    aoi = generate_monthly_nightlights_feature(
+        make_aoi(),
+        2022,
+        months=[1, 2, 3],
+        seasons=dict(early=[1, 2]),
+        n_workers=2,
+        cache_dir=str(tmpdir),
+    )
+
+    np.testing.assert_allclose(aoi["avg_rad_2022_all_months_mean"], [20, 15])
+    np.testing.assert_allclose(aoi["avg_rad_2022_all_months_max"], [30, 20])
+    np.testing.assert_allclose(
+        aoi["avg_rad_2022_all_months_cvg_weighted_mean"], [140 / 6, 50 / 3]
+    )
+    np.testing.assert_allclose(aoi["avg_rad_2022_early_mean"], [15, 15])
+    # only 3 of the 12 months, so the features are not labelled annual
+    assert not any("annual" in col for col in aoi.columns)
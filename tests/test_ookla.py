@@ -0,0 +1,478 @@
+import os
+from collections import namedtuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from geowrangler import grids
+from shapely.geometry import Polygon, box
+
+from povertymapping import ookla
+from povertymapping.ookla import (
+    OoklaDataManager,
+    _filter_quadkey_df,
+    _read_and_filter_quadkey_parquet_file,
+    aggregate_ookla_by_quadkey,
+    aggregate_ookla_yearly,
+    compact_quadkeys,
+    quadkey_covering,
+    quadkey_ranges,
+    repartition_ookla_file,
+)
+
+FakeOoklaFile = namedtuple("FakeOoklaFile", ["type_", "year", "quarter"])
+
+
+def make_quarter_data(quadkeys):
+    return pd.DataFrame(
+        dict(
+            quadkey=quadkeys,
+            tile=[box(0, 0, 1, 1).wkt] * len(quadkeys),
+            avg_d_kbps=[1000] * len(quadkeys),
+            avg_u_kbps=[500] * len(quadkeys),
+            avg_lat_ms=[10] * len(quadkeys),
+            tests=[3] * len(quadkeys),
+            devices=[2] * len(quadkeys),
+        )
+    )
+
+
+def setup_ookla_data(tmp_path, mocker):
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+    make_quarter_data(
+        ["0120000000000000", "0123000000000000", "3210000000000000"]
+    ).to_parquet(raw_dir / "q1.parquet")
+    mocker.patch(
+        "povertymapping.ookla.download_ookla_year_data", return_value=str(raw_dir)
+    )
+    mocker.patch(
+        "povertymapping.ookla.get_OoklaFile",
+        return_value=FakeOoklaFile("fixed", "2020", "1"),
+    )
+    aoi = gpd.GeoDataFrame(
+        dict(quadkey=["0120000000", "0123000000"]),
+        geometry=[box(0, 0, 1, 1)] * 2,
+        crs="epsg:4326",
+    )
+    return aoi
+
+
+def test_load_type_year_data_block_cache(tmp_path, mocker):
+    aoi = setup_ookla_data(tmp_path, mocker)
+    manager = OoklaDataManager(cache_dir=tmp_path / "cache")
+    df = manager.load_type_year_data(aoi, "fixed", 2020, use_aoi_quadkey=True)
+
+    assert sorted(df["quadkey"]) == ["0120000000000000", "0123000000000000"]
+    block_dir = os.path.join(manager.processed_cache_dir, "fixed", "2020")
+    assert sorted(os.listdir(block_dir)) == ["01200000.parquet", "01230000.parquet"]
+
+    # a new manager reads an overlapping aoi from the cached blocks only,
+    # with only the requested columns
+    read_spy = mocker.spy(ookla, "_read_and_filter_quadkey_parquet_file")
+    manager = OoklaDataManager(cache_dir=tmp_path / "cache")
+    cached = manager.load_type_year_data(
+        aoi.iloc[:1], "fixed", 2020, use_aoi_quadkey=True, columns=["quadkey", "tests"]
+    )
+    assert list(cached.columns) == ["quadkey", "tests"]
+    assert cached["quadkey"].tolist() == ["0120000000000000"]
+    assert read_spy.call_count == 0
+
+    # only the missing block is processed for an incremental aoi
+    extended_aoi = pd.concat(
+        [
+            aoi,
+            gpd.GeoDataFrame(
+                dict(quadkey=["3210000000"]), geometry=[box(0, 0, 1, 1)], crs=aoi.crs
+            ),
+        ]
+    )
+    df = manager.load_type_year_data(extended_aoi, "fixed", 2020, use_aoi_quadkey=True)
+    assert len(df) == 3
+    assert read_spy.call_args.args[1] == ["32100000"]
+
+
+def test_load_type_year_data_with_geometry(tmp_path, mocker):
+    aoi = setup_ookla_data(tmp_path, mocker)
+    manager = OoklaDataManager(cache_dir=tmp_path / "cache")
+
+    gdf = manager.load_type_year_data(
+        aoi, "fixed", 2020, use_aoi_quadkey=True, return_geometry=True
+    )
+
+    assert isinstance(gdf, gpd.GeoDataFrame) and gdf.crs == "epsg:4326"
+    assert gdf.geometry.equals(gpd.GeoSeries.from_wkt(gdf["tile"], crs="epsg:4326"))
+    block_dir = os.path.join(manager.processed_cache_dir, "fixed", "2020")
+    assert "01200000.geo.parquet" in os.listdir(block_dir)
+
+    # the geometries are read back from the GeoParquet blocks, not parsed again
+    wkt_spy = mocker.spy(gpd.GeoSeries, "from_wkt")
+    manager = OoklaDataManager(cache_dir=tmp_path / "cache")
+    cached = manager.load_type_year_data(
+        aoi, "fixed", 2020, use_aoi_quadkey=True, return_geometry=True
+    )
+    assert cached.geometry.equals(gdf.geometry)
+    assert wkt_spy.call_count == 0
+
+
+def test_quadkey_ranges():
+    assert quadkey_ranges(["0123", "0120", "0121", "0122", "3"], zoom=5) == [
+        ("01200", "01233"),
+        ("30000", "33333"),
+    ]
+    # nested quadkeys are merged
+    assert quadkey_ranges(["01", "012"], zoom=3) == [("010", "013")]
+    assert quadkey_ranges(["00", "02", "3"], zoom=2, max_ranges=2) == [
+        ("00", "02"),
+        ("30", "33"),
+    ]
+
+
+def test_compact_quadkeys():
+    assert compact_quadkeys(["0120", "0121", "0122", "0123", "013", "02"]) == [
+        "012",
+        "013",
+        "02",
+    ]
+    # complete siblings are merged recursively
+    assert compact_quadkeys([f"1{i}" for i in "0123"] + ["0", "2", "3"]) == [""]
+
+
+def test_quadkey_covering():
+    polygon = Polygon([(121.0, 14.5), (121.2, 14.52), (121.1, 14.7)])
+    grid = grids.BingTileGridGenerator(16, return_geometry=False).generate_grid(
+        gpd.GeoDataFrame(geometry=[polygon], crs="epsg:4326")
+    )
+
+    covering = quadkey_covering(polygon, 16)
+
+    assert len(covering) < len(grid)
+    assert {len(quadkey) for quadkey in covering} > {16}
+    # same zoom 16 tiles as the grid generator
+    assert sum(4 ** (16 - len(quadkey)) for quadkey in covering) == len(grid)
+    assert len(_filter_quadkey_df(grid, covering)) == len(grid)
+
+
+def test_read_and_filter_quadkey_parquet_file(tmp_path):
+    quadkeys = [
+        "0000000000000000",
+        "0123000000000001",
+        "0123300000000000",
+        "0130000000000000",
+        "2000000000000000",
+    ]
+    make_quarter_data(quadkeys).to_parquet(tmp_path / "q1.parquet", row_group_size=2)
+
+    df = _read_and_filter_quadkey_parquet_file(
+        tmp_path / "q1.parquet", ["0123", "2000000000000000"], max_ranges=1
+    )
+
+    assert df["quadkey"].tolist() == [
+        "0123000000000001",
+        "0123300000000000",
+        "2000000000000000",
+    ]
+
+
+def test_repartition_ookla_file(tmp_path):
+    quadkeys = [
+        "2000000000000000",
+        "0123000000000001",
+        "0000000000000000",
+        "0123300000000000",
+        "0130000000000000",
+    ]
+    make_quarter_data(quadkeys).to_parquet(tmp_path / "q1.parquet")
+    filter_quadkeys = ["0123", "2000000000000000"]
+    expected = _read_and_filter_quadkey_parquet_file(
+        tmp_path / "q1.parquet", filter_quadkeys
+    )
+
+    repartition_ookla_file(tmp_path / "q1.parquet", partition_zoom=2)
+
+    assert sorted(os.listdir(tmp_path / "q1.parquet")) == [
+        "quadkey_prefix=00",
+        "quadkey_prefix=01",
+        "quadkey_prefix=20",
+    ]
+    # the repartitioned file is sorted by quadkey
+    df = _read_and_filter_quadkey_parquet_file(tmp_path / "q1.parquet", filter_quadkeys)
+    pd.testing.assert_frame_equal(
+        df, expected.sort_values("quadkey", ignore_index=True)
+    )
+
+
+def test_interrupted_repartition_keeps_the_type_year_dir(tmp_path, mocker):
+    type_year_dir = tmp_path / "fixed" / "2020"
+    type_year_dir.mkdir(parents=True)
+    make_quarter_data(["0123000000000001"]).to_parquet(type_year_dir / "q1.parquet")
+    mocker.patch("povertymapping.ookla.pq.write_table", side_effect=KeyboardInterrupt)
+
+    with pytest.raises(KeyboardInterrupt):
+        repartition_ookla_file(type_year_dir / "q1.parquet", partition_zoom=2)
+
+    # only the original file is left in the type/year dir, and the temp dir is removed
+    assert os.listdir(type_year_dir) == ["q1.parquet"]
+    assert os.path.isfile(type_year_dir / "q1.parquet")
+    assert os.listdir(tmp_path / "fixed") == ["2020"]
+
+
+def test_load_type_year_index(tmp_path, mocker):
+    aoi = setup_ookla_data(tmp_path, mocker)
+    q2 = make_quarter_data(["0123000000000000", "1000000000000000"])
+    q2["avg_d_kbps"] = 3000
+    q2.to_parquet(tmp_path / "raw" / "q2.parquet")
+    manager = OoklaDataManager(cache_dir=tmp_path / "cache")
+    split_spy = mocker.spy(ookla, "_split_ookla_quarter_file")
+
+    indexed = manager.load_type_year_index(aoi, "fixed", 2020, use_aoi_quadkey=True)
+    expected = aggregate_ookla_yearly(
+        manager.load_type_year_data(aoi, "fixed", 2020, use_aoi_quadkey=True)
+    )
+
+    pd.testing.assert_frame_equal(indexed, expected)
+    assert indexed["mean_avg_d_kbps"].tolist() == [1000, 2000]
+    index_files = os.listdir(tmp_path / "cache" / "ookla" / "index" / "fixed" / "2020")
+    assert sorted(index_files) == ["01.parquet", "10.parquet", "32.parquet"]
+    # each quarterly file is read once
+    assert split_spy.call_count == 2
+
+
+def test_aggregate_ookla_by_quadkey():
+    region = gpd.GeoDataFrame(geometry=[box(121.0, 14.5, 121.1, 14.6)], crs="epsg:4326")
+    aoi = grids.BingTileGridGenerator(14).generate_grid(region)
+    ookla = grids.BingTileGridGenerator(16).generate_grid(region)
+    ookla = ookla.sample(frac=0.7, random_state=1).reset_index(drop=True)
+    ookla["avg_d_kbps"] = np.random.default_rng(0).random(len(ookla)) * 1000
+
+    aoi_features = aggregate_ookla_by_quadkey(aoi["quadkey"], ookla, ["avg_d_kbps"])
+
+    # reference: area weighted values from a polygon overlay, averaged per aoi tile
+    metric_aoi = aoi.to_crs("epsg:3123")
+    metric_aoi["aoi_area"] = metric_aoi.area
+    intersect = metric_aoi.overlay(ookla.to_crs("epsg:3123"), keep_geom_type=True)
+    # skip the slivers along tile edges created by the reprojection
+    intersect = intersect[intersect["quadkey_2"].str[:14] == intersect["quadkey_1"]]
+    intersect["value"] = (
+        intersect.area / intersect["aoi_area"] * intersect["avg_d_kbps"]
+    )
+    expected = intersect.groupby("quadkey_1")["value"].mean().reindex(aoi["quadkey"])
+
+    np.testing.assert_allclose(
+        aoi_features["avg_d_kbps_mean"].to_numpy(), expected.to_numpy(), rtol=1e-4
+    )
+
+
+def make_spaced_quadkey_aoi():
+    "Get zoom 14 AOI tiles that don't touch, so the overlay has no slivers of neighbouring tiles, and their yearly Ookla data"
+    region = gpd.GeoDataFrame(geometry=[box(121.0, 14.5, 121.1, 14.6)], crs="epsg:4326")
+    aoi = grids.BingTileGridGenerator(14).generate_grid(region)
+    x, y = ookla.quadkey_to_tile_xy(aoi["quadkey"])
+    aoi = aoi[(x % 2 == 0) & (y % 2 == 0)].reset_index(drop=True)
+    rng = np.random.default_rng(0)
+    quadkeys = [
+        quadkey + a + b
+        for i, quadkey in enumerate(aoi["quadkey"])
+        for a in "0123"
+        for b in "0123"
+        # the first aoi tile is fully covered and the last one has no data
+        if i == 0 or (i < len(aoi) - 1 and rng.random() < 0.7)
+    ]
+    tiles = gpd.GeoSeries(ookla._quadkey_boxes(np.array(quadkeys)))
+    yearly = pd.DataFrame(dict(quadkey=quadkeys, tile=tiles.to_wkt()))
+    for agg in ookla.DEFAULT_OOKLA_YEARLY_AGGREGATIONS:
+        yearly[agg["output"]] = rng.random(len(yearly)) * 1000
+    return aoi, yearly
+
+
+@pytest.mark.parametrize("func", ookla.OOKLA_AOI_FUNCS)
+def test_quadkey_aggregation_matches_the_overlay(mocker, func):
+    aoi, yearly = make_spaced_quadkey_aoi()
+    manager = mocker.Mock()
+    manager.load_type_year_index.return_value = yearly
+    yearly_outputs = [agg["output"] for agg in ookla.DEFAULT_OOKLA_YEARLY_AGGREGATIONS]
+    aoi_aggregations = [
+        dict(
+            column=col,
+            func=func,
+            weights="mean_num_tests" if func == "weighted_mean" else None,
+        )
+        for col in yearly_outputs
+    ]
+
+    def add_features(use_quadkey_aggregation):
+        return ookla.add_ookla_features(
+            aoi,
+            "fixed",
+            2020,
+            manager,
+            use_aoi_quadkey=True,
+            use_yearly_index=True,
+            use_quadkey_aggregation=use_quadkey_aggregation,
+            aoi_aggregations=aoi_aggregations,
+            # tile edges stay straight in web mercator, so the overlay finds the fully covered aoi tiles
+            metric_crs="epsg:3857",
+        )
+
+    by_quadkey, overlay = add_features(True), add_features(False)
+
+    feature_cols = [f"fixed_2020_{col}_{func}" for col in yearly_outputs]
+    np.testing.assert_allclose(
+        by_quadkey[feature_cols].to_numpy(dtype=float),
+        overlay[feature_cols].to_numpy(dtype=float),
+        rtol=1e-4,
+    )
+    if func == "min":
+        # only the fully covered first aoi tile keeps its min
+        assert (by_quadkey[feature_cols].iloc[1:] == 0).all(axis=None)
+        assert (by_quadkey[feature_cols].iloc[0] > 0).all()
+
+
+def test_add_ookla_multi_features(tmp_path, mocker):
+    aoi = setup_ookla_data(tmp_path, mocker)
+    mobile_dir = tmp_path / "mobile"
+    mobile_dir.mkdir()
+    make_quarter_data(["0120000000000000", "0120000000000001"]).to_parquet(
+        mobile_dir / "q1.parquet"
+    )
+    mocker.patch(
+        "povertymapping.ookla.download_ookla_year_data",
+        side_effect=lambda type_, *args, **kwargs: str(
+            tmp_path / ("raw" if type_ == "fixed" else "mobile")
+        ),
+    )
+    manager = OoklaDataManager(cache_dir=tmp_path / "cache")
+
+    kwargs = dict(use_aoi_quadkey=True, use_quadkey_aggregation=True)
+    fused = ookla.add_ookla_multi_features(
+        aoi, ["fixed", "mobile"], [2020], manager, **kwargs
+    )
+    separate = ookla.add_ookla_features(aoi, "fixed", 2020, manager, **kwargs)
+    separate = ookla.add_ookla_features(separate, "mobile", 2020, manager, **kwargs)
+
+    pd.testing.assert_frame_equal(fused, separate)
+    assert "fixed_2020_mean_avg_d_kbps_mean" in fused.columns
+    assert fused["mobile_2020_mean_num_tests_mean"].isna().tolist() == [False, True]
+
+
+def test_ookla_aggregation_spec(tmp_path, mocker):
+    aoi = setup_ookla_data(tmp_path, mocker)
+    q2 = make_quarter_data(["0123000000000000"])
+    q2["avg_d_kbps"] = 3000
+    q2["tests"] = 1
+    q2.to_parquet(tmp_path / "raw" / "q2.parquet")
+    manager = OoklaDataManager(cache_dir=tmp_path / "cache")
+    yearly_aggregations = [
+        dict(column="avg_d_kbps", func=["weighted_mean", "max"], weights="tests"),
+        dict(column="tests", func="sum", output="total_tests"),
+    ]
+
+    yearly = aggregate_ookla_yearly(
+        manager.load_type_year_data(aoi, "fixed", 2020, use_aoi_quadkey=True),
+        yearly_aggregations,
+    )
+    assert list(yearly.columns) == [
+        "quadkey",
+        "tile",
+        "avg_d_kbps_weighted_mean",
+        "avg_d_kbps_max",
+        "total_tests",
+    ]
+    assert yearly["avg_d_kbps_weighted_mean"].tolist() == [1000, 1500]
+    assert yearly["total_tests"].tolist() == [3, 4]
+
+    features = ookla.add_ookla_features(
+        aoi,
+        "fixed",
+        2020,
+        manager,
+        use_aoi_quadkey=True,
+        use_quadkey_aggregation=True,
+        yearly_aggregations=yearly_aggregations,
+        aoi_aggregations=[
+            dict(
+                column="avg_d_kbps_weighted_mean",
+                func="weighted_mean",
+                weights="total_tests",
+                output="avg_d_kbps",
+            ),
+            dict(column="total_tests", func="sum"),
+        ],
+    )
+    assert features["fixed_2020_avg_d_kbps"].tolist() == [1000, 1500]
+    assert features["fixed_2020_total_tests_sum"].tolist() == [3, 4]
+
+
+def test_ookla_overlay_rejects_percentiles(tmp_path, mocker):
+    aoi = setup_ookla_data(tmp_path, mocker)
+    manager = OoklaDataManager(cache_dir=tmp_path / "cache")
+
+    with pytest.raises(ValueError, match="Percentile func p90"):
+        ookla.add_ookla_features(
+            aoi,
+            "fixed",
+            2020,
+            manager,
+            use_aoi_quadkey=True,
+            use_quadkey_aggregation=False,
+            aoi_aggregations=[dict(column="mean_avg_d_kbps", func="p90")],
+        )
+
+
+def test_download_ookla_year_data(tmp_path, mocker):
+    available = {
+        ookla.OoklaFile("fixed", "2020", str(quarter)): f"q{quarter}.parquet"
+        for quarter in [2, 3, 4]
+    }
+    mocker.patch("povertymapping.ookla.list_ookla_files", return_value=available)
+
+    def fake_download(type_, year, quarter, directory):
+        filepath = os.path.join(directory, f"q{quarter}.parquet")
+        make_quarter_data(["0120000000000000"]).to_parquet(filepath)
+        return filepath
+
+    download_spy = mocker.patch(
+        "povertymapping.ookla._download_ookla_file", side_effect=fake_download
+    )
+
+    type_year_dir = ookla.download_ookla_year_data("fixed", 2020, tmp_path)
+
+    assert sorted(call.kwargs["quarter"] for call in download_spy.call_args_list) == [
+        "2",
+        "3",
+        "4",
+    ]
+    assert sorted(os.listdir(type_year_dir)) == [
+        "q2.parquet",
+        "q3.parquet",
+        "q4.parquet",
+    ]
+
+
+def test_download_ookla_year_data_resumes_partial_downloads(tmp_path, mocker):
+    available = {
+        ookla.OoklaFile("fixed", "2020", str(quarter)): f"q{quarter}.parquet"
+        for quarter in [1, 2]
+    }
+    mocker.patch("povertymapping.ookla.list_ookla_files", return_value=available)
+    type_year_dir = tmp_path / "ookla" / "fixed" / "2020"
+    type_year_dir.mkdir(parents=True)
+    make_quarter_data(["0120000000000000"]).to_parquet(type_year_dir / "q1.parquet")
+    # left by an interrupted download of the second quarter
+    (type_year_dir / "q2.parquet.part").write_bytes(b"0" * 10)
+    (type_year_dir / "q2.parquet.part.json").write_text("{}")
+
+    def fake_download(type_, year, quarter, directory):
+        filepath = os.path.join(directory, f"q{quarter}.parquet")
+        if not os.path.exists(filepath):
+            assert os.path.exists(filepath + ".part")
+            make_quarter_data(["0120000000000000"]).to_parquet(filepath)
+        return filepath
+
+    mocker.patch("povertymapping.ookla._download_ookla_file", side_effect=fake_download)
+
+    ookla.download_ookla_year_data("fixed", 2020, tmp_path)
+
+    assert (type_year_dir / "q1.parquet").exists()
+    assert (type_year_dir / "q2.parquet").exists()
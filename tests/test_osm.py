@@ -0,0 +1,270 @@
+import os
+import zipfile
+
+import geopandas as gpd
+import geowrangler.distance_zonal_stats as dzs
+import geowrangler.vector_zonal_stats as vzs
+import numpy as np
+from shapely.geometry import Point, box
+
+from povertymapping import osm
+
+
+def test_download_osm_country_data_resumes_partial_download(tmp_path, mocker):
+    country_dir = tmp_path / "osm" / "philippines"
+    country_dir.mkdir(parents=True)
+    # left by an interrupted download of the country zip
+    (country_dir / "philippines-latest-free.shp.zip.part").write_bytes(b"0" * 10)
+    (country_dir / "philippines-latest-free.shp.zip.part.json").write_text("{}")
+
+    def fake_download(url, directory):
+        assert os.path.exists(
+            os.path.join(directory, "philippines-latest-free.shp.zip.part")
+        )
+        zip_path = os.path.join(directory, "philippines-latest-free.shp.zip")
+        with zipfile.ZipFile(zip_path, "w") as zip_file:
+            zip_file.writestr("gis_osm_pois_free_1.shp", b"")
+        return zip_path
+
+    download_spy = mocker.patch(
+        "povertymapping.osm._download_geofabrik_region", side_effect=fake_download
+    )
+    mocker.patch(
+        "povertymapping.osm.geofabrik.get_osm_download_url",
+        return_value="https://example.com/philippines-latest-free.shp.zip",
+    )
+
+    osm.download_osm_country_data("philippines", tmp_path)
+
+    assert download_spy.call_count == 1
+    assert (country_dir / "gis_osm_pois_free_1.shp").exists()
+
+
+def test_download_geofabrik_region_checks_the_published_md5(tmp_path, mocker):
+    url = "https://example.com/philippines-latest-free.shp.zip"
+    md5_response = mocker.Mock(
+        ok=True, text=f"{'a' * 32}  philippines-latest-free.shp.zip\n"
+    )
+    requests_get = mocker.patch(
+        "povertymapping.osm.requests.get", return_value=md5_response
+    )
+    urlretrieve = mocker.patch(
+        "povertymapping.osm.urlretrieve", return_value=(tmp_path / "file", None, None)
+    )
+
+    osm._download_geofabrik_region(url, tmp_path, show_progress=False)
+
+    assert requests_get.call_args.args[0] == f"{url}.md5"
+    assert urlretrieve.call_args.kwargs["checksum"] == "a" * 32
+
+    # without a published md5, the download is not verified
+    md5_response.ok = False
+    osm._download_geofabrik_region(url, tmp_path, show_progress=False)
+    assert urlretrieve.call_args.kwargs["checksum"] is None
+
+
+def make_aoi():
+    # 3 x 2 grid of ~1km cells, with a non-unique index
+    cells = [
+        box(121 + 0.01 * x, 14 + 0.01 * y, 121 + 0.01 * (x + 1), 14 + 0.01 * (y + 1))
+        for x in range(3)
+        for y in range(2)
+    ]
+    return gpd.GeoDataFrame(
+        dict(cell=range(len(cells))),
+        geometry=cells,
+        index=[0, 0, 1, 1, 2, 2],
+        crs="epsg:4326",
+    )
+
+
+def make_pois():
+    pois = [
+        ("atm", 121.005, 14.005),
+        ("atm", 121.006, 14.004),
+        ("atm", 121.025, 14.015),
+        ("cafe", 121.015, 14.005),
+        # on the edge shared by two cells
+        ("cafe", 121.02, 14.015),
+        # far from every cell
+        ("cafe", 122.5, 15.5),
+        ("hospital", 122.5, 15.5),
+        ("school", 121.001, 14.001),
+    ]
+    return gpd.GeoDataFrame(
+        dict(fclass=[fclass for fclass, _, _ in pois]),
+        geometry=[Point(x, y) for _, x, y in pois],
+        crs="epsg:4326",
+    )
+
+
+POI_TYPES = ["atm", "cafe", "hospital", "bank"]
+
+
+def test_count_osm_pois_matches_vector_zonal_stats():
+    aoi, pois = make_aoi(), make_pois()
+
+    counts = osm.count_osm_pois(aoi, pois, POI_TYPES)
+
+    expected = vzs.create_zonal_stats(
+        aoi.reset_index(drop=True),
+        pois,
+        overlap_method="intersects",
+        aggregations=[{"func": "count", "output": "poi_count", "fillna": True}],
+    )
+    for poi_type in POI_TYPES:
+        expected = vzs.create_zonal_stats(
+            expected,
+            pois[pois["fclass"] == poi_type],
+            overlap_method="intersects",
+            aggregations=[
+                {"func": "count", "output": f"{poi_type}_count", "fillna": True}
+            ],
+        )
+    assert counts.index.equals(aoi.index)
+    assert list(counts.columns) == ["poi_count"] + [f"{t}_count" for t in POI_TYPES]
+    for col in counts.columns:
+        assert counts[col].dtype == expected[col].dtype
+        np.testing.assert_array_equal(counts[col].to_numpy(), expected[col].to_numpy())
+    assert counts["bank_count"].sum() == 0
+
+
+def test_nearest_osm_poi_distances_match_distance_zonal_stats():
+    aoi, pois = make_aoi(), make_pois()
+    max_distance = 20000
+
+    distances = osm.nearest_osm_poi_distances(
+        aoi, pois, POI_TYPES, metric_crs="epsg:3857", max_distance=max_distance
+    )
+
+    assert distances.index.equals(aoi.index)
+    # no bank at all
+    assert (distances["bank_nearest"] == max_distance).all()
+    for poi_type in ["atm", "cafe", "hospital"]:
+        expected = dzs.create_distance_zonal_stats(
+            aoi.reset_index(drop=True).to_crs("epsg:3857"),
+            pois[pois["fclass"] == poi_type].to_crs("epsg:3857"),
+            max_distance=max_distance,
+            aggregations=[],
+            distance_col="nearest",
+        )["nearest"].fillna(max_distance)
+        np.testing.assert_allclose(
+            distances[f"{poi_type}_nearest"].to_numpy(),
+            expected.to_numpy(),
+            rtol=0,
+            atol=1e-8,
+        )
+    # the only hospital is beyond max_distance of every cell
+    assert (distances["hospital_nearest"] == max_distance).all()
+    assert (distances["cafe_nearest"] < max_distance).all()
+
+
+def write_pois_shapefile(country_dir):
+    pois = make_pois()
+    pois["name"] = [f"poi {i}" for i in range(len(pois))]
+    pois.to_file(country_dir / "gis_osm_pois_free_1.shp")
+    return pois
+
+
+def test_load_osm_layer_converts_the_shapefile_once(tmp_path, mocker):
+    pois = write_pois_shapefile(tmp_path)
+    read_file_spy = mocker.spy(osm.gpd, "read_file")
+
+    first = osm.load_osm_layer(tmp_path, "gis_osm_pois_free_1", ["fclass", "geometry"])
+    second = osm.load_osm_layer(tmp_path, "gis_osm_pois_free_1", ["fclass", "geometry"])
+    projected = osm.load_osm_layer(tmp_path, "gis_osm_pois_free_1", ["geometry"])
+
+    assert read_file_spy.call_count == 1
+    # the unneeded "name" field is never read
+    assert read_file_spy.call_args.kwargs["columns"] == ["fclass"]
+    assert "name" not in read_file_spy.spy_return.columns
+    schema = osm.pq.read_schema(tmp_path / "gis_osm_pois_free_1.parquet")
+    assert "name" not in schema.names
+    assert set(osm.OSM_BBOX_COLUMNS) <= set(schema.names)
+    assert (tmp_path / f"gis_osm_pois_free_1{osm.OSM_INDEX_SUFFIX}").exists()
+    assert list(first.columns) == list(second.columns) == ["fclass", "geometry"]
+    assert list(projected.columns) == ["geometry"]
+    assert sorted(second["fclass"]) == sorted(pois["fclass"])
+    assert sorted(second.geometry.to_wkt()) == sorted(pois.geometry.to_wkt())
+
+
+def test_load_osm_layer_reconverts_a_stale_schema(tmp_path, mocker):
+    write_pois_shapefile(tmp_path)
+    # written by an older version, without the bounds columns
+    parquet_path = tmp_path / "gis_osm_pois_free_1.parquet"
+    make_pois().to_parquet(parquet_path)
+    read_file_spy = mocker.spy(osm.gpd, "read_file")
+
+    pois = osm.load_osm_layer(tmp_path, "gis_osm_pois_free_1", ["fclass", "geometry"])
+
+    assert read_file_spy.call_count == 1
+    assert set(osm.OSM_BBOX_COLUMNS) <= set(osm.pq.read_schema(parquet_path).names)
+    assert len(pois) == len(make_pois())
+
+
+def test_aoi_bbox_read_matches_the_full_load(tmp_path, mocker):
+    write_pois_shapefile(tmp_path)
+    mocker.patch(
+        "povertymapping.osm.download_osm_country_data", return_value=str(tmp_path)
+    )
+    aoi = make_aoi()
+    kwargs = dict(poi_types=POI_TYPES, nearest_poi_max_distance=20000)
+
+    full = osm.add_osm_poi_features(
+        aoi, "philippines", osm.OsmDataManager(tmp_path), **kwargs
+    )
+    # read from the GeoParquet file with the bbox filters
+    from_file = osm.add_osm_poi_features(
+        aoi, "philippines", osm.OsmDataManager(tmp_path), use_aoi_bbox=True, **kwargs
+    )
+    # sliced from the country layer cached in RAM with its persisted index
+    manager = osm.OsmDataManager(tmp_path)
+    manager.load_pois("philippines")
+    query_spy = mocker.spy(osm.PackedRTree, "query_bounds")
+    from_ram = osm.add_osm_poi_features(
+        aoi, "philippines", manager, use_aoi_bbox=True, **kwargs
+    )
+    bbox = osm.get_osm_bbox(aoi, buffer=20000)
+    assert any(np.allclose(call.args[1], [bbox]) for call in query_spy.call_args_list)
+
+    assert len(
+        osm.load_osm_layer(
+            tmp_path, "gis_osm_pois_free_1", ["fclass", "geometry"], bbox=bbox
+        )
+    ) < len(make_pois())
+    for features in [from_file, from_ram]:
+        assert list(features.columns) == list(full.columns)
+        for col in full.columns.drop(["cell", "geometry"]):
+            np.testing.assert_allclose(
+                features[col].to_numpy(), full[col].to_numpy(), rtol=0, atol=1e-8
+            )
+
+
+def test_layer_index_is_rebuilt_when_the_layer_changes(tmp_path, mocker):
+    write_pois_shapefile(tmp_path)
+    mocker.patch(
+        "povertymapping.osm.download_osm_country_data", return_value=str(tmp_path)
+    )
+    manager = osm.OsmDataManager(tmp_path)
+    pois = manager.load_pois("philippines")
+    index_path = tmp_path / f"gis_osm_pois_free_1{osm.OSM_INDEX_SUFFIX}"
+    assert manager.get_pois_index("philippines").fingerprint is not None
+    assert manager.get_pois_index("vietnam") is None
+    index_mtime = os.stat(index_path).st_mtime_ns
+
+    # reusing the persisted index as long as the layer is unchanged
+    osm.OsmDataManager(tmp_path).load_pois("philippines")
+    assert os.stat(index_path).st_mtime_ns == index_mtime
+
+    # same number of pois, moved elsewhere
+    moved = pois.copy()
+    moved["geometry"] = pois.geometry.translate(1, 1)
+    moved[osm.OSM_BBOX_COLUMNS] = moved.geometry.bounds.to_numpy()
+    moved.to_parquet(tmp_path / "gis_osm_pois_free_1.parquet")
+
+    manager = osm.OsmDataManager(tmp_path)
+    manager.load_pois("philippines")
+    layer_index = manager.get_pois_index("philippines")
+    np.testing.assert_array_equal(
+        layer_index.levels[0], moved.geometry.bounds.to_numpy()
+    )
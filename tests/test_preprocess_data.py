@@ -0,0 +1,227 @@
+import os
+import zipfile
+
+import geopandas as gpd
+import osmium
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from shapely.geometry import box
+
+from povertymapping import preprocess_data
+
+OSM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+  <node id="1" version="1" timestamp="2022-01-01T00:00:00Z" lat="14.0" lon="121.0">
+    <tag k="amenity" v="cafe"/>
+    <tag k="name" v="Cafe"/>
+  </node>
+  <node id="2" version="2" timestamp="2022-01-02T00:00:00Z" lat="14.1" lon="121.1"/>
+  <node id="3" version="1" timestamp="2022-01-03T00:00:00Z" lat="14.2" lon="121.2">
+    <tag k="name" v="Nameless"/>
+  </node>
+  <way id="10" version="3" timestamp="2022-02-01T00:00:00Z">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <nd ref="3"/>
+    <tag k="highway" v="primary"/>
+    <tag k="amenity" v="parking"/>
+  </way>
+  <way id="11" version="1" timestamp="2022-02-02T00:00:00Z">
+    <nd ref="3"/>
+    <nd ref="2"/>
+    <tag k="highway" v="residential"/>
+  </way>
+  <relation id="20" version="1" timestamp="2022-03-01T00:00:00Z">
+    <member type="way" ref="10" role="outer"/>
+    <tag k="type" v="multipolygon"/>
+  </relation>
+</osm>
+"""
+
+
+def make_osm_config(tmp_path, **kwargs):
+    xml_path = tmp_path / "philippines_0.osm"
+    xml_path.write_text(OSM_XML)
+    writer = osmium.SimpleWriter(str(tmp_path / "philippines_0.osm.pbf"))
+    for osm_object in osmium.FileProcessor(str(xml_path)):
+        writer.add(osm_object)
+    writer.close()
+    return dict(osm_country="philippines", save_path=str(tmp_path), **kwargs)
+
+
+def test_preprocess_osm_pbf_flushes_chunks_to_parquet(tmp_path):
+    config = make_osm_config(tmp_path, tag_genome_chunksize=1)
+
+    filepath = preprocess_data.preprocess_osm_pbf(config, 0)
+
+    parquet_file = pq.ParquetFile(filepath)
+    table = parquet_file.read()
+    assert table.schema.names == preprocess_data.TAG_GENOME_SCHEMA.names
+    assert table.schema.field("nodes").type.value_type == pa.int64()
+    assert table.schema.field("ts").type.tz == "UTC"
+    # flushed after each of the 5 tagged elements
+    assert parquet_file.metadata.num_row_groups == 5
+    tag_genome = table.to_pylist()
+    assert [(row["type"], row["id"], row["tagkey"]) for row in tag_genome] == [
+        ("node", 1, "amenity"),
+        ("node", 1, "name"),
+        ("node", 3, "name"),
+        ("way", 10, "highway"),
+        ("way", 10, "amenity"),
+        ("way", 11, "highway"),
+        ("relation", 20, "type"),
+    ]
+    assert [row["nodes"] for row in tag_genome] == [
+        [],
+        [],
+        [],
+        [1, 2, 3],
+        [1, 2, 3],
+        [3, 2],
+        [],
+    ]
+    assert (tag_genome[0]["lat"], tag_genome[0]["lon"]) == (14.0, 121.0)
+    assert (tag_genome[3]["lat"], tag_genome[3]["lon"]) == (-1, -1)
+    assert tag_genome[3]["version"] == 3
+
+
+def test_preprocess_osm_pbf_keeps_tag_keys(tmp_path):
+    config = make_osm_config(tmp_path, osm_tag_keys=["amenity"], tag_genome_chunksize=1)
+
+    tag_genome = preprocess_data.preprocess_osm_pbf(config, 0, return_df=True)
+
+    assert list(tag_genome.columns) == [
+        "type",
+        "id",
+        "ts",
+        "version",
+        "nodes_str",
+        "lat",
+        "lon",
+        "tagkey",
+        "tagvalue",
+    ]
+    assert tag_genome["id"].tolist() == [1, 10]
+    assert tag_genome["tagvalue"].tolist() == ["cafe", "parking"]
+    assert tag_genome["nodes_str"].tolist() == ["", "1 2 3"]
+
+
+def test_tag_genome_handler_deprecated_taggenome(tmp_path):
+    make_osm_config(tmp_path)
+    handler = preprocess_data.TagGenomeHandler(tag_keys=["highway"])
+    handler.apply_file(str(tmp_path / "philippines_0.osm.pbf"))
+
+    with pytest.warns(DeprecationWarning):
+        taggenome = handler.taggenome
+
+    assert [row[:2] + row[4:] for row in taggenome] == [
+        ["way", 10, "1 2 3", -1, -1, "highway", "primary"],
+        ["way", 11, "3 2", -1, -1, "highway", "residential"],
+    ]
+
+
+def make_ookla_config(tmp_path, monkeypatch, boundaries, **kwargs):
+    # data_dir is relative to repo_path, run from the repo root like the scripts
+    monkeypatch.chdir(tmp_path)
+    data_dir = tmp_path / "data"
+    (data_dir / "hdx").mkdir(parents=True)
+    boundaries.to_file(data_dir / "hdx" / "boundaries.geojson")
+
+    # 4 x 4 grid of tiles, zipped like the Ookla quarterly shapefiles
+    tiles = gpd.GeoDataFrame(
+        dict(
+            quadkey=[f"{x}{y}" for x in range(4) for y in range(4)],
+            avg_d_kbps=[float(i) for i in range(16)],
+        ),
+        geometry=[
+            box(121 + x, 14 + y, 121 + x + 1, 14 + y + 1)
+            for x in range(4)
+            for y in range(4)
+        ],
+        crs="epsg:4326",
+    )
+    tiles.to_file(tmp_path / "tiles.shp")
+    with zipfile.ZipFile(data_dir / "tiles.zip", "w") as zip_file:
+        for ext in ["shp", "shx", "dbf", "prj", "cpg"]:
+            zip_file.write(tmp_path / f"tiles.{ext}", f"tiles.{ext}")
+
+    return dict(
+        repo_path=str(tmp_path),
+        crs="epsg:4326",
+        country="philippines",
+        year=2022,
+        quarter=1,
+        hdx_folder="hdx",
+        data_dir="data",
+        boundary_file="boundaries.geojson",
+        **kwargs,
+    )
+
+
+def make_boundaries(*geometries):
+    return gpd.GeoDataFrame(
+        dict(ADM1_EN=[f"region {i}" for i in range(len(geometries))]),
+        geometry=list(geometries),
+        crs="epsg:4326",
+    )
+
+
+def read_ookla_output(config):
+    return gpd.read_file(
+        os.path.join(
+            config["repo_path"], config["data_dir"], "philippines_2022_1_ookla.geojson"
+        )
+    )
+
+
+def test_preprocess_ookla_reads_the_country_bbox_in_chunks(
+    tmp_path, monkeypatch, mocker
+):
+    # the second region shares tile "10" with the first
+    boundaries = make_boundaries(
+        box(121.5, 14.5, 122.5, 15.5), box(122.2, 14.2, 122.8, 14.8)
+    )
+    config = make_ookla_config(tmp_path, monkeypatch, boundaries, ookla_chunksize=1)
+    mocker.patch(
+        "povertymapping.preprocess_data.get_title_url",
+        return_value="https://example.com/tiles.zip",
+    )
+    urlretrieve = mocker.patch("povertymapping.preprocess_data.urlretrieve")
+    from_features_spy = mocker.spy(gpd.GeoDataFrame, "from_features")
+
+    preprocess_data.preprocess_ookla(config)
+
+    urlretrieve.assert_not_called()
+    # only the 4 tiles in the bbox are read, one per chunk
+    assert from_features_spy.call_count == 4
+    tiles_in_country = read_ookla_output(config)
+    assert set(tiles_in_country.columns) == {
+        "quadkey",
+        "avg_d_kbps",
+        "index_right",
+        "ADM1_EN",
+        "geometry",
+    }
+    # one row per tile and boundary it intersects
+    assert sorted(zip(tiles_in_country["quadkey"], tiles_in_country["ADM1_EN"])) == [
+        ("00", "region 0"),
+        ("01", "region 0"),
+        ("10", "region 0"),
+        ("10", "region 1"),
+        ("11", "region 0"),
+    ]
+
+
+def test_preprocess_ookla_without_tiles_in_country(tmp_path, monkeypatch, mocker):
+    boundaries = make_boundaries(box(100, 0, 101, 1))
+    config = make_ookla_config(tmp_path, monkeypatch, boundaries)
+    mocker.patch(
+        "povertymapping.preprocess_data.get_title_url",
+        return_value="https://example.com/tiles.zip",
+    )
+
+    preprocess_data.preprocess_ookla(config)
+
+    tiles_in_country = read_ookla_output(config)
+    assert len(tiles_in_country) == 0
@@ -0,0 +1,50 @@
+import numpy as np
+import shapely
+
+from povertymapping.spatial_index import PackedRTree
+
+
+def make_lines(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    starts = rng.random((n, 2)) * 10
+    ends = starts + rng.random((n, 2)) * 0.2
+    lines = shapely.linestrings(np.stack([starts, ends], axis=1))
+    # sorted spatially, as the layers the tree is built for
+    return lines[np.lexsort((starts[:, 1].round(), starts[:, 0].round()))]
+
+
+def test_packed_rtree_query():
+    lines = make_lines()
+    lines[3] = shapely.from_wkt("LINESTRING EMPTY")
+    boxes = shapely.box(
+        *np.array([[x, y, x + 1, y + 1] for x in range(10) for y in range(10)]).T
+    )
+    tree = PackedRTree.from_geometries(lines, node_size=4)
+
+    query_pos, feature_pos = tree.query(
+        boxes, lines, predicate="intersects", chunksize=7
+    )
+
+    expected = shapely.STRtree(lines).query(boxes, predicate="intersects")
+    assert set(zip(query_pos, feature_pos)) == set(zip(*expected))
+    assert len(query_pos) == len(expected[0])
+
+
+def test_packed_rtree_save_load(tmp_path):
+    lines = make_lines()
+    tree = PackedRTree.from_geometries(lines, fingerprint="123-456")
+    tree.save(tmp_path / "lines.rtree.npz")
+
+    loaded = PackedRTree.load(tmp_path / "lines.rtree.npz")
+
+    assert len(loaded) == len(lines)
+    assert loaded.node_size == tree.node_size
+    assert loaded.fingerprint == "123-456"
+    query_bounds = [[2, 2, 3, 3], [0, 0, 0.5, 0.5]]
+    for expected, actual in zip(
+        tree.query_bounds(query_bounds), loaded.query_bounds(query_bounds)
+    ):
+        np.testing.assert_array_equal(expected, actual)
+    # empty trees match nothing
+    empty = PackedRTree.from_bounds(np.empty((0, 4)))
+    assert len(empty.query(lines[:5], lines[:0])[0]) == 0